@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+
+"""
+Low stock and expiry alerts of every ingredient, kept in memory and updated one ingredient at a time as its document changes,
+so clients can get a snapshot once and then only the alerts that changed.
+An ingredient is low on stock when its stock is below warningStockAmount, expired when one of its lots has expired (as
+get_all_expired_ingredients_db and get_dashboard_summary_db) and expiring when one of its lots expires within expiring_days
+(as get_expiring_ingredients_db). An ingredient with no lot left is neither, only the documents stored before there were lots
+fall back to their expiry_date.
+"""
+class InventoryAlerts:
+    def __init__(self, ingredients: list, expiring_days: float):
+        self.expiring_days = expiring_days
+        self.alerts = {}  # sku -> alert, only for the ingredients with an active alert
+        now = datetime.now()
+        for ingredient in ingredients:
+            alert = self.alert(ingredient, now)
+            if alert:
+                self.alerts[ingredient["_id"]] = alert
+
+    """
+    Function to get the alert of one ingredient, or None when it is neither low on stock nor expiring:
+    { "_id": sku, "name", "stock", "warningStockAmount", "stock_measurement", "expiry_date", "low_stock": bool, "expiry": "expired" | "expiring" | None }
+    """
+    def alert(self, ingredient: dict, now: datetime):
+        low_stock = ingredient.get("stock", 0) < ingredient.get("warningStockAmount", 0)
+        expiry_date = ingredient.get("expiry_date")
+        soon = now + timedelta(days=self.expiring_days)
+        lots = ingredient.get("lots")
+        if lots is None:
+            expired = bool(expiry_date and expiry_date < now)
+        else:
+            expired = any(lot["expiry_date"] < now for lot in lots)
+        if expired:
+            expiry = "expired"
+        elif any(now <= lot["expiry_date"] <= soon for lot in lots or []):
+            expiry = "expiring"
+        else:
+            expiry = None
+        if not low_stock and not expiry:
+            return None
+        return {
+            "_id": ingredient["_id"],
+            "name": ingredient.get("name"),
+            "stock": ingredient.get("stock", 0),
+            "warningStockAmount": ingredient.get("warningStockAmount"),
+            "stock_measurement": ingredient.get("stock_measurement"),
+            "expiry_date": expiry_date,
+            "low_stock": low_stock,
+            "expiry": expiry
+        }
+
+    """
+    Function to apply the new document of an ingredient (None when it was deleted).
+    It returns the alert of the ingredient if it changed, with low_stock False and expiry None when its alert is cleared,
+    or None when nothing changed for the clients.
+    """
+    def update(self, sku: str, ingredient: dict = None):
+        alert = self.alert(ingredient, datetime.now()) if ingredient else None
+        previous = self.alerts.get(sku)
+        if alert == previous:
+            return None
+        if alert:
+            self.alerts[sku] = alert
+            return alert
+        del self.alerts[sku]
+        return {**previous, "low_stock": False, "expiry": None}
+
+    """
+    Function to get every active alert.
+    """
+    def snapshot(self):
+        return list(self.alerts.values())
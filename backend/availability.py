@@ -0,0 +1,61 @@
+import numpy as np
+from recipe_graph import RecipeGraph
+
+
+"""
+Menu availability: how many portions of every menu item the current stock allows and which ingredient runs out first.
+It is computed once from the recipe graph and then kept up to date incrementally: when the stock of an ingredient changes,
+only the recipes that use that ingredient are recomputed (see RecipeGraph.recipes_using and RecipeGraph.capacity).
+"""
+class MenuAvailability:
+    def __init__(self, graph: RecipeGraph, ingredients: list):
+        self.graph = graph
+        self.stock = graph.ingredient_vector(ingredients, "stock")
+        self.portions, self.limited_by = graph.capacity(self.stock)
+
+    """
+    Function to apply new stock values ({ sku: stock }), e.g. the ingredients written by one ticket.
+    It returns the entries (see entry) of the menu items whose portions or limiting ingredient changed.
+    """
+    def update_stock(self, stock: dict):
+        columns = []
+        for sku, value in stock.items():
+            column = self.graph.columns.get(sku)
+            if column is not None and self.stock[column] != value:
+                self.stock[column] = value
+                columns.append(column)
+        if not columns:
+            return []
+        rows = self.graph.recipes_using(columns)
+        portions, limited_by = self.graph.capacity(self.stock, rows)
+        changed = []
+        for row, row_portions, row_limited_by in zip(rows.tolist(), portions.tolist(), limited_by):
+            if row_portions != self.portions[row] or row_limited_by != self.limited_by[row]:
+                self.portions[row] = row_portions
+                self.limited_by[row] = row_limited_by
+                changed.append(self.entry(row))
+        return changed
+
+    """
+    Function to get the availability of one menu item:
+    { "_id", "id", "name", "category", "portions", "available", "limited_by" }
+    portions is None (and available True) when no ingredient of the recipe is known, so nothing limits it.
+    """
+    def entry(self, row: int):
+        recipe = self.graph.recipes[row]
+        portions = self.portions[row]
+        return {
+            "_id": str(recipe["_id"]),
+            "id": recipe.get("id"),
+            "name": recipe.get("name"),
+            "category": recipe.get("category"),
+            "portions": int(portions) if np.isfinite(portions) else None,
+            "available": bool(portions >= 1),
+            "limited_by": self.limited_by[row]
+        }
+
+    """
+    Function to get the availability of every menu item.
+    """
+    def snapshot(self):
+        return [self.entry(row) for row in range(self.graph.shape[0])]
@@ -0,0 +1,68 @@
+"""
+Synthetic data generator for the benchmarks.
+Scales data.json up to any number of ingredients and recipes, keeping the same structure:
+every ingredient of data.json is cloned with a numbered SKU and name, and every recipe uses 3 to 8 random generated ingredients.
+Run it from the backend directory to write a data.json-shaped file:
+    python benchmarks/generate_data.py --ingredients 100000 --recipes 10000 --output big_data.json
+"""
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+DATA_FILE = os.path.join(os.path.dirname(__file__), "..", "data.json")
+
+
+"""
+Function to generate a data.json-shaped dictionary with the given number of ingredients and recipes.
+The same seed always generates the same data.
+"""
+def generate_data(ingredient_count: int, recipe_count: int, seed: int = 0):
+    rng = random.Random(seed)
+    with open(DATA_FILE, "r") as file:
+        base = json.load(file)
+
+    today = datetime.now()
+    ingredients = []
+    for i in range(ingredient_count):
+        template = base["ingredients"][i % len(base["ingredients"])]
+        sku = f"{template['sku'][:3]}{i:06d}"
+        ingredients.append({
+            **template,
+            "_id": sku,
+            "sku": sku,
+            "name": f"{template['name']} {i}",
+            "stock": rng.randint(0, 500),
+            "expiry_date": (today + timedelta(days=rng.randint(-10, 120))).strftime("%Y-%m-%d"),
+            "warningStockAmount": rng.randint(5, 50)
+        })
+
+    categories = list(base["recipes"].keys())
+    recipes = {category: [] for category in categories}
+    for i in range(recipe_count):
+        template = base["recipes"][categories[i % len(categories)]][0]
+        recipes[categories[i % len(categories)]].append({
+            **template,
+            "id": i + 1,
+            "name": f"{template['name']} {i + 1}",
+            "ingredients": [
+                {"id": j, "name": ingredients[index]["name"], "units": "pcs", "amount": str(rng.randint(1, 5))}
+                for j, index in enumerate(rng.sample(range(ingredient_count), min(ingredient_count, rng.randint(3, 8))))
+            ]
+        })
+
+    return {"ingredients": ingredients, "recipes": recipes}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a scaled up data.json")
+    parser.add_argument("--ingredients", type=int, default=100000)
+    parser.add_argument("--recipes", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="big_data.json")
+    args = parser.parse_args()
+
+    with open(args.output, "w") as file:
+        json.dump(generate_data(args.ingredients, args.recipes, args.seed), file)
+    print(f"Wrote {args.ingredients} ingredients and {args.recipes} recipes to {args.output}")
@@ -0,0 +1,197 @@
+"""
+Load test of the FastAPI app.
+The app runs in-process (httpx ASGI transport, no server needed) against either:
+- a local mongod given with --mongo-uri (it must be a replica set for transactions and change streams, e.g. mongod --replSet rs0), or
+- mongomock-motor with --mongomock. Nothing to install, but mongomock does not implement the update pipelines used by
+  /submit-orders and /resupply-ingredient-add, so the write endpoints are skipped and only the reads are measured there.
+The database is filled with generate_data, then workers send a mix of orders, resupplies and reads concurrently.
+p50/p99 latency and throughput are reported per endpoint. With --max-p99 the script exits with 1 when an endpoint is slower
+than that or returned errors, so it can run before a deploy. Run it from the backend directory:
+    python benchmarks/load_test.py --mongo-uri mongodb://localhost:27017/?replicaSet=rs0 --ingredients 100000 --recipes 10000
+    python benchmarks/load_test.py --mongomock --ingredients 5000 --recipes 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from generate_data import generate_data
+
+
+"""
+Relative weight of every endpoint in the mixed workload: mostly orders and dashboard reads, a few deliveries.
+"""
+WORKLOAD = {
+    "POST /submit-orders": 50,
+    "POST /resupply-ingredient-add": 5,
+    "GET /get-low-stock-ingredients": 15,
+    "GET /get-expiring-ingredients": 15,
+    "GET /get-all-ingredients?limit=100": 10,
+    "GET /get-all-menu-items?limit=100": 5,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the ShelfLyfe API")
+    database = parser.add_mutually_exclusive_group(required=True)
+    database.add_argument("--mongo-uri", help="local MongoDB replica set to run against (the shelflyfe database is dropped)")
+    database.add_argument("--mongomock", action="store_true", help="run against mongomock-motor")
+    parser.add_argument("--ingredients", type=int, default=100000)
+    parser.add_argument("--recipes", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=2000, help="total number of requests")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of concurrent clients")
+    parser.add_argument("--max-p99", type=float, help="fail if an endpoint's p99 latency in ms is above this")
+    return parser.parse_args()
+
+
+"""
+Function to fill the database with the generated data, the same way startup_db_client does with data.json.
+"""
+async def seed(database, data):
+    await database.ingredients_collection.drop()
+    await database.menu_items_collection.drop()
+    await database.ingredients_collection.insert_many([
+        database.new_ingredient_document(
+            ingredient["sku"], ingredient["name"], ingredient["stock"], float(ingredient["price"]),
+            ingredient["expiry_date"], ingredient["stock_measurement"], ingredient["warningStockAmount"]
+        )
+        for ingredient in data["ingredients"]
+    ])
+    await database.menu_items_collection.insert_many([
+        {**recipe, "category": category, "location": database.DEFAULT_LOCATION} for category, recipes in data["recipes"].items() for recipe in recipes
+    ])
+    await database.ensure_indexes_db()
+
+
+"""
+Functions building a random request for an endpoint.
+"""
+def order_request(rng, data):
+    recipes = [recipe for recipes in data["recipes"].values() for recipe in rng.sample(recipes, min(len(recipes), 2))]
+    return {"json": {str(recipe["id"]): {"name": recipe["name"], "count": rng.randint(1, 4)} for recipe in recipes}}
+
+
+def resupply_request(rng, data):
+    expiry_date = (datetime.now() + timedelta(days=rng.randint(5, 60))).strftime("%Y-%m-%d")
+    return {"json": [
+        {
+            "sku": ingredient["sku"], "id": line, "isNewIngredient": False, "supplier": "Benchmark",
+            "name": ingredient["name"], "stock": rng.randint(1, 50), "price": 1.0, "expiryDate": expiry_date,
+            "customUnit": "", "threshold": ingredient["warningStockAmount"], "unit": ingredient["stock_measurement"]
+        }
+        for line, ingredient in enumerate(rng.sample(data["ingredients"], 20))
+    ]}
+
+
+def build_request(endpoint, rng, data):
+    if endpoint == "POST /submit-orders":
+        return order_request(rng, data)
+    if endpoint == "POST /resupply-ingredient-add":
+        return resupply_request(rng, data)
+    return {}
+
+
+"""
+Function running the workload (endpoint -> weight, see WORKLOAD) with concurrency workers until requests requests were sent.
+It returns the latencies (in seconds) and error count per endpoint, and the total duration.
+"""
+async def run_workload(client, data, workload, requests, concurrency):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    endpoints, weights = zip(*workload.items())
+    remaining = iter(range(requests))
+
+    async def worker(worker_id):
+        rng = random.Random(worker_id)
+        for _ in remaining:
+            endpoint = rng.choices(endpoints, weights)[0]
+            method, url = endpoint.split(" ")
+            request = build_request(endpoint, rng, data)
+            start = time.perf_counter()
+            response = await client.request(method, url, **request)
+            latencies[endpoint].append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[endpoint] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(worker_id) for worker_id in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+"""
+Function to print the results table. It returns False if an endpoint failed the --max-p99 check or returned errors.
+"""
+def report(workload, latencies, errors, duration, max_p99):
+    passed = True
+    print(f"{'endpoint':<40}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p99 ms':>9}{'req/s':>9}")
+    for endpoint in workload:
+        samples = latencies.get(endpoint, [])
+        if not samples:
+            continue
+        cuts = statistics.quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+        p50, p99 = cuts[49] * 1000, cuts[98] * 1000
+        print(f"{endpoint:<40}{len(samples):>9}{errors[endpoint]:>8}{p50:>9.1f}{p99:>9.1f}{len(samples) / duration:>9.1f}")
+        if max_p99 is not None and (p99 > max_p99 or errors[endpoint]):
+            passed = False
+    total = sum(len(samples) for samples in latencies.values())
+    print(f"{total} requests in {duration:.1f}s ({total / duration:.1f} req/s)")
+    return passed
+
+
+async def run():
+    args = parse_args()
+    if args.mongomock:
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+        os.environ["CONNECTION_STRING"] = "mongodb://mongomock"
+    else:
+        os.environ["CONNECTION_STRING"] = args.mongo_uri
+
+    import httpx
+    import database
+    import main as api
+
+    if args.mongomock:
+        # mongomock-motor returns synchronous collections from with_options, use the async ones without the write concern
+        for module in (database, api):
+            module.ingredients_collection = database.db.ingredients
+            module.menu_items_collection = database.db.menu_items
+            module.ingredients_read_collection = database.db.ingredients
+            module.menu_items_read_collection = database.db.menu_items
+        database.order_events_collection = database.db.order_events
+        database.order_tickets_collection = database.db.order_tickets
+
+    print(f"Generating {args.ingredients} ingredients and {args.recipes} recipes")
+    data = generate_data(args.ingredients, args.recipes)
+    await seed(database, data)
+    if args.mongomock:
+        # mongomock has no change streams to keep the caches coherent, so every read goes to the database
+        database.ingredients_cache.ttl = 0
+        database.menu_items_cache.ttl = 0
+    else:
+        await database.start_caches_db()
+
+    workload = WORKLOAD
+    if args.mongomock:
+        workload = {endpoint: weight for endpoint, weight in WORKLOAD.items() if not endpoint.startswith("POST ")}
+        skipped = ", ".join(endpoint for endpoint in WORKLOAD if endpoint not in workload)
+        print(f"Skipping {skipped}: mongomock does not implement their update pipelines, run with --mongo-uri to measure them")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://benchmark") as client:
+        latencies, errors, duration = await run_workload(client, data, workload, args.requests, args.concurrency)
+
+    for task in database.background_tasks:
+        task.cancel()
+    sys.exit(0 if report(workload, latencies, errors, duration, args.max_p99) else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
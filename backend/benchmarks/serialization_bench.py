@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the response and write paths.
+Compares, per document:
+- the old response path (convert_object_ids + jsonable_encoder + json.dumps) with MongoJSONResponse (one orjson call)
+- the old write path (Ingredient model + .dict()) with new_ingredient_document
+No database is needed. Run it from the backend directory:
+    python benchmarks/serialization_bench.py [number of documents]
+"""
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("CONNECTION_STRING", "mongodb://localhost:27017")  # the client is created but never used
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from database import new_ingredient_document
+from models import Ingredient
+from serialization import MongoJSONResponse
+
+
+"""
+The response path used before MongoJSONResponse
+"""
+def convert_object_ids(data):
+    if isinstance(data, list):
+        return [convert_object_ids(item) for item in data]
+    elif isinstance(data, dict):
+        return {key: convert_object_ids(value) for key, value in data.items()}
+    elif isinstance(data, ObjectId):
+        return str(data)
+    else:
+        return data
+
+
+def old_response(documents):
+    return json.dumps(jsonable_encoder(convert_object_ids(documents))).encode()
+
+
+def new_response(documents):
+    return MongoJSONResponse(documents).body
+
+
+def old_write(i):
+    ingredient = Ingredient(
+        _id=f"SKU{i}",
+        name=f"Ingredient {i}",
+        stock=100,
+        price=1.99,
+        expiry_date=datetime.strptime("2025-06-23", "%Y-%m-%d"),
+        monthIncrease="0%",
+        yearIncrease="0%",
+        orders=1,
+        stock_measurement="kgs",
+        warningStockAmount=10
+    )
+    data = ingredient.dict(by_alias=True)
+    data["sku"] = ingredient.sku
+    return data
+
+
+def new_write(i):
+    return new_ingredient_document(f"SKU{i}", f"Ingredient {i}", 100, 1.99, "2025-06-23", "kgs", 10)
+
+
+def menu_item(i):
+    return {
+        "_id": ObjectId(),
+        "id": i,
+        "name": f"Dish {i}",
+        "category": "Mains",
+        "ingredients": [{"id": j, "name": f"Ingredient {j}", "units": "pcs", "amount": "2"} for j in range(5)]
+    }
+
+
+def report(label, old, new, count):
+    print(f"{label:<28}{old / count * 1e6:>10.2f} us/doc{new / count * 1e6:>10.2f} us/doc{old / new:>8.1f}x")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    ingredients = [new_write(i) for i in range(count)]
+    menu_items = [menu_item(i) for i in range(count)]
+    assert json.loads(old_response(menu_items)) == json.loads(new_response(menu_items))
+
+    print(f"{count} documents{'before':>23}{'after':>17}{'speedup':>9}")
+    for label, documents in (("serialize ingredients", ingredients), ("serialize menu items", menu_items)):
+        old = min(timeit.repeat(lambda: old_response(documents), number=1, repeat=5))
+        new = min(timeit.repeat(lambda: new_response(documents), number=1, repeat=5))
+        report(label, old, new, count)
+    old = min(timeit.repeat(lambda: [old_write(i) for i in range(count)], number=1, repeat=5))
+    new = min(timeit.repeat(lambda: [new_write(i) for i in range(count)], number=1, repeat=5))
+    report("build ingredient document", old, new, count)
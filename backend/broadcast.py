@@ -0,0 +1,45 @@
+import asyncio
+
+
+"""
+In-process publish/subscribe channel used to push events to connected clients (Server-Sent Events).
+Every subscriber gets its own bounded queue. A client that does not keep up and lets its queue fill is disconnected
+(it receives None and its stream ends) instead of slowing down the writers or growing memory, it can reconnect to get a new snapshot.
+"""
+class Broadcaster:
+    def __init__(self, name: str, max_queue: int = 1000):
+        self.name = name
+        self.max_queue = max_queue
+        self.subscribers = set()
+        self.published = 0
+        self.disconnected = 0
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event: str, data):
+        self.published += 1
+        for queue in list(self.subscribers):
+            if queue.qsize() >= self.max_queue - 1:
+                self.unsubscribe(queue)
+                self.disconnected += 1
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait((event, data))
+
+    def close(self):
+        for queue in list(self.subscribers):
+            self.unsubscribe(queue)
+            queue.put_nowait(None)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "disconnected": self.disconnected
+        }
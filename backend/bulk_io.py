@@ -0,0 +1,252 @@
+"""
+Streaming parsers and writers for the bulk import/export of ingredients and menu items, and the command line client.
+The parsers are fed text as it arrives and return the records that are complete so far, so a file or a request body
+of any size is read with bounded memory. Supported formats:
+- ndjson: one JSON object per line
+- csv: a header line, then one record per line (fields cannot contain line breaks)
+- json: a JSON array of objects, parsed one object at a time
+The client sends a file to /import/<kind> in chunks of records (one request each) and can resume from an offset:
+    python bulk_io.py import ingredients catalog.csv --url http://localhost:8000 --chunk 10000 --offset 0
+    python bulk_io.py export ingredients ingredients.ndjson --url http://localhost:8000
+--location imports into or exports from one restaurant location (the default location of the API when it is not given).
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import urllib.parse
+import urllib.request
+
+
+"""
+Largest amount of text a parser keeps while waiting for the end of a record, so a malformed body cannot use unbounded memory.
+"""
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+
+"""
+Parser for newline delimited JSON. Blank lines are ignored.
+"""
+class NDJSONParser:
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text: str):
+        lines = (self.buffer + text).split("\n")
+        self.buffer = lines.pop()
+        if len(self.buffer) > MAX_RECORD_SIZE:
+            raise ValueError("Record too large")
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def close(self):
+        records = [json.loads(self.buffer)] if self.buffer.strip() else []
+        self.buffer = ""
+        return records
+
+
+"""
+Parser for CSV with a header line. Every record is a dictionary of strings keyed by the header, empty fields are left out.
+"""
+class CSVParser:
+    def __init__(self):
+        self.buffer = ""
+        self.header = None
+
+    def feed(self, text: str):
+        lines = (self.buffer + text).split("\n")
+        self.buffer = lines.pop()
+        if len(self.buffer) > MAX_RECORD_SIZE:
+            raise ValueError("Record too large")
+        return self._parse(lines)
+
+    def close(self):
+        records = self._parse([self.buffer])
+        self.buffer = ""
+        return records
+
+    def _parse(self, lines: list):
+        rows = list(csv.reader(line for line in lines if line.strip()))
+        if self.header is None and rows:
+            self.header = [name.strip() for name in rows.pop(0)]
+        return [{name: value for name, value in zip(self.header, row) if value != ""} for row in rows]
+
+
+"""
+Parser for a JSON array of objects ([{...}, {...}]), each object is decoded as soon as it is complete.
+"""
+class JSONArrayParser:
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, text: str):
+        self.buffer += text
+        records = []
+        position = 0
+        while not self.finished:
+            position = self._skip(position, " \t\r\n" + ("," if self.started else ""))
+            if position == len(self.buffer):
+                break
+            if not self.started:
+                if self.buffer[position] != "[":
+                    raise ValueError("Expected a JSON array")
+                self.started = True
+                position += 1
+                continue
+            if self.buffer[position] == "]":
+                self.finished = True
+                position += 1
+                break
+            if self.buffer[position] != "{":
+                raise ValueError("Expected a JSON object")
+            try:
+                record, position = self.decoder.raw_decode(self.buffer, position)
+            except json.JSONDecodeError:
+                break  # the object is not complete yet
+            records.append(record)
+        self.buffer = self.buffer[position:]
+        if len(self.buffer) > MAX_RECORD_SIZE:
+            raise ValueError("Record too large")
+        return records
+
+    def close(self):
+        if self.buffer.strip() or not self.finished:
+            raise ValueError("Unexpected end of the JSON array")
+        return []
+
+    def _skip(self, position: int, characters: str):
+        while position < len(self.buffer) and self.buffer[position] in characters:
+            position += 1
+        return position
+
+
+PARSERS = {"ndjson": NDJSONParser, "csv": CSVParser, "json": JSONArrayParser}
+
+
+"""
+Columns of the CSV exports. Menu item ingredients are written as a JSON array in their column.
+"""
+CSV_COLUMNS = {
+    "ingredients": ["sku", "name", "stock", "price", "expiry_date", "stock_measurement", "warningStockAmount"],
+    "menu-items": ["id", "name", "category", "season", "price", "description", "ingredients"],
+}
+
+
+"""
+Function to write one document as a CSV line with the given columns (dates as YYYY-MM-DD, lists and objects as JSON).
+"""
+def csv_line(document: dict, columns: list):
+    values = []
+    for column in columns:
+        value = document.get(column, "")
+        if hasattr(value, "strftime"):
+            value = value.strftime("%Y-%m-%d")
+        elif isinstance(value, (list, dict)):
+            value = json.dumps(value, default=str)
+        values.append(value)
+    line = io.StringIO()
+    csv.writer(line, lineterminator="\n").writerow(values)
+    return line.getvalue()
+
+
+"""
+Function to read a file in chunks and yield its records, skipping the first offset records.
+"""
+def read_records(path: str, format: str, offset: int = 0, chunk_size: int = 1024 * 1024):
+    parser = PARSERS[format]()
+    index = 0
+    with open(path, "r", encoding="utf-8") as file:
+        while True:
+            text = file.read(chunk_size)
+            records = parser.feed(text) if text else parser.close()
+            for record in records:
+                if index >= offset:
+                    yield record
+                index += 1
+            if not text:
+                return
+
+
+"""
+Command line import: sends the records of a file to /import/<kind> as NDJSON, chunk records per request, printing the progress.
+If a request fails the offset to resume from is printed, and --offset continues from there.
+"""
+def import_file(args):
+    format = args.format or args.path.rsplit(".", 1)[-1].lower()
+    if format not in PARSERS:
+        sys.exit(f"Unknown format '{format}', use --format with one of {', '.join(PARSERS)}")
+    query = urllib.parse.urlencode({"format": "ndjson", "batch_size": args.batch_size, **({"location": args.location} if args.location else {})})
+    url = f"{args.url}/import/{args.kind}?{query}"
+    offset = args.offset
+    totals = {"inserted": 0, "updated": 0, "errors": 0}
+    chunk = []
+
+    def send(chunk):
+        body = "".join(json.dumps(record, default=str) + "\n" for record in chunk).encode()
+        request = urllib.request.Request(url, data=body, method="POST", headers={"Content-Type": "application/x-ndjson"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                result = json.load(response)
+        except Exception as e:
+            sys.exit(f"Import failed at offset {offset}: {e}\nResume with --offset {offset}")
+        for key in totals:
+            totals[key] += result[key] if key != "errors" else len(result["errors"])
+        for error in result["errors"]:
+            print(f"  record {offset + error['offset']}: {error['error']}")
+        print(f"{offset + len(chunk)} records sent, {totals['inserted']} inserted, {totals['updated']} updated, {totals['errors']} errors")
+
+    for record in read_records(args.path, format, args.offset):
+        chunk.append(record)
+        if len(chunk) == args.chunk:
+            send(chunk)
+            offset += len(chunk)
+            chunk = []
+    if chunk:
+        send(chunk)
+
+
+"""
+Command line export: streams /export/<kind> into a file, in the format of its extension (ndjson or csv).
+"""
+def export_file(args):
+    format = args.format or args.path.rsplit(".", 1)[-1].lower()
+    query = urllib.parse.urlencode({
+        "format": format, **({"after": args.after} if args.after else {}), **({"location": args.location} if args.location else {})
+    })
+    written = 0
+    with urllib.request.urlopen(f"{args.url}/export/{args.kind}?{query}") as response, open(args.path, "ab" if args.after else "wb") as file:
+        for line in response:
+            file.write(line)
+            written += 1
+            if written % 10000 == 0:
+                print(f"{written} lines written")
+    print(f"{written} lines written to {args.path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import/export of ingredients and menu items")
+    parser.add_argument("--url", default="http://localhost:8000", help="URL of the ShelfLyfe API")
+    parser.add_argument("--location", help="restaurant location, the default location of the API when not given")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="import a CSV, NDJSON or JSON array file")
+    import_parser.add_argument("kind", choices=CSV_COLUMNS.keys())
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=PARSERS.keys(), help="by default the file extension")
+    import_parser.add_argument("--offset", type=int, default=0, help="number of records to skip, to resume an import")
+    import_parser.add_argument("--chunk", type=int, default=10000, help="records sent per request")
+    import_parser.add_argument("--batch-size", type=int, default=1000, help="records written per bulk write")
+    import_parser.set_defaults(run=import_file)
+
+    export_parser = commands.add_parser("export", help="export to a CSV or NDJSON file")
+    export_parser.add_argument("kind", choices=CSV_COLUMNS.keys())
+    export_parser.add_argument("path")
+    export_parser.add_argument("--format", choices=["ndjson", "csv"], help="by default the file extension")
+    export_parser.add_argument("--after", help="_id to resume after, the lines are appended to the file")
+    export_parser.set_defaults(run=export_file)
+
+    args = parser.parse_args()
+    args.run(args)
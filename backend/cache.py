@@ -0,0 +1,253 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+"""
+In-process read-through cache for a MongoDB collection.
+Documents are keyed by their _id (the SKU for ingredients, the menu id for menu items), expire after ttl seconds
+and the cache never holds more than max_size documents (least recently used ones are evicted first).
+When the whole collection has been loaded with put_all (passing the changes counter read before the load started), get_all can answer list queries from memory until the TTL runs out.
+Writes that know the new state of a document call put or remove, which keep the cached collection complete;
+invalidate is for writes whose result is unknown and forces the next list query back to the database.
+Documents returned by the cache are shared, callers must not mutate them.
+structure_changes only counts the writes that add or remove a document or change one of structure_fields,
+so data derived from those fields (e.g. the recipe graph) can tell when it has to be rebuilt.
+With a partition_field (e.g. the location), one partition can be loaded and listed on its own: put_all and get_all take
+the partition value, and a partition is complete either on its own or because the whole collection was loaded.
+get_version returns a version per partition to validate HTTP caches: the cluster time of the last change the change stream
+reported for the partition (or of the opening of the stream, see start_version). Every worker sees the same changes
+with the same cluster times, so they agree on the versions and an ETag from one worker validates on the others.
+A write of this process (see touch) leaves the partition without a version until its change arrives, so a client
+never gets a 304 for a list that already holds its own write.
+"""
+class CollectionCache:
+    def __init__(self, name: str, ttl: float = 60, max_size: int = 50000, structure_fields: tuple = (), partition_field: str = None):
+        self.name = name
+        self.structure_fields = structure_fields
+        self.partition_field = partition_field
+        self.ttl = ttl
+        self.max_size = max_size
+        self.documents = OrderedDict()  # key -> (expires_at, document)
+        self.partitions = {}  # partition value -> keys of its documents, in insertion order
+        self.complete_until = 0  # the whole collection is cached until this time
+        self.partitions_complete_until = {}  # partition value -> that partition is cached until this time
+        self.changes = 0  # number of writes applied, used to detect writes made during a put_all load
+        self.structure_changes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.cluster_time = None  # (seconds, increment) of the last change that may have touched every partition
+        self.partition_times = {}  # partition value -> (seconds, increment) of its last change
+        self.pending = set()  # partitions written by this process whose change has not arrived yet
+        self.pending_all = True  # no version at all until the change stream is open
+
+    def _key(self, key):
+        return str(key)
+
+    def get(self, key):
+        key = self._key(key)
+        entry = self.documents.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.documents.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, document):
+        key = self._key(key)
+        self.changes += 1
+        previous = self.documents.get(key)
+        if previous is None or any(previous[1].get(field) != document.get(field) for field in self.structure_fields):
+            self.structure_changes += 1
+        if previous:
+            self._remove(key, keep_complete=True)
+        self.documents[key] = (time.monotonic() + self.ttl, document)
+        if self.partition_field:
+            self.partitions.setdefault(document.get(self.partition_field), {})[key] = None
+        while len(self.documents) > self.max_size:
+            self._remove(next(iter(self.documents)))
+
+    def invalidate(self, key):
+        key = self._key(key)
+        self.changes += 1
+        self.structure_changes += 1
+        if key in self.documents:
+            self.invalidations += 1
+            self._remove(key)
+
+    def remove(self, key):
+        key = self._key(key)
+        self.changes += 1
+        self.structure_changes += 1
+        if key in self.documents:
+            self.invalidations += 1
+            self._remove(key, keep_complete=True)
+
+    def clear(self):
+        self.pending_all = True
+        self.changes += 1
+        self.structure_changes += 1
+        self.documents.clear()
+        self.partitions.clear()
+        self.complete_until = 0
+        self.partitions_complete_until.clear()
+
+    def get_all(self, partition=None):
+        now = time.monotonic()
+        if partition is None and self.complete_until > now:
+            self.hits += 1
+            return [document for _, document in self.documents.values()]
+        if partition is not None and max(self.complete_until, self.partitions_complete_until.get(partition, 0)) > now:
+            self.hits += 1
+            return [self.documents[key][1] for key in self.partitions.get(partition, {})]
+        self.misses += 1
+        return None
+
+    def put_all(self, documents: list, changes: int, partition=None):
+        # Skip the load if a change arrived while the documents were being read, they might be older than the cache
+        if changes != self.changes:
+            return
+        if partition is None:
+            self.clear()
+        else:
+            # Documents of the partition that are still there are overwritten, so only real changes count as structure changes
+            keys = {self._key(document["_id"]) for document in documents}
+            for key in list(self.partitions.get(partition, {})):
+                if key not in keys:
+                    self.structure_changes += 1
+                    self._remove(key, keep_complete=True)
+        if len(documents) + len(self.documents) - len(self.partitions.get(partition, {})) > self.max_size:
+            return
+        for document in documents:
+            self.put(document["_id"], document)
+        if partition is None:
+            self.complete_until = time.monotonic() + self.ttl
+        else:
+            self.partitions_complete_until[partition] = time.monotonic() + self.ttl
+
+    """
+    Function to record a write of this process to a partition, or to every partition when the partition is not known (None).
+    The partition has no version until the change stream reports a change of it.
+    """
+    def touch(self, partition=None):
+        if partition is None or not self.partition_field:
+            self.pending_all = True
+        else:
+            self.pending.add(partition)
+
+    """
+    Function to start the versions at the cluster time the change stream was opened at (a bson Timestamp),
+    the data read from then on is at least that recent.
+    """
+    def start_version(self, cluster_time):
+        self.cluster_time = (cluster_time.time, cluster_time.inc)
+        self.partition_times.clear()
+        self.pending.clear()
+        self.pending_all = False
+
+    """
+    Function to get the version of a partition (of the whole collection when partition is None) and the time it last changed
+    in seconds, e.g. ("1767225600-3", 1767225600), or None when it has no version (see touch).
+    """
+    def get_version(self, partition=None):
+        if self.pending_all or self.cluster_time is None or partition in self.pending:
+            return None
+        if partition is None or not self.partition_field:
+            if self.pending:
+                return None
+            seconds, increment = max(self.cluster_time, *self.partition_times.values())
+        else:
+            seconds, increment = max(self.cluster_time, self.partition_times.get(partition, self.cluster_time))
+        return f"{seconds}-{increment}", seconds
+
+    def _apply_version(self, change: dict, document: dict):
+        cluster_time = change.get("clusterTime")
+        partition = document.get(self.partition_field) if document and self.partition_field else None
+        if cluster_time is None:
+            self.touch(partition)
+        elif partition is None:
+            # e.g. the delete of a document that is not cached, it may be the write a partition is waiting for
+            self.cluster_time = (cluster_time.time, cluster_time.inc)
+            self.partition_times.clear()
+            self.pending.clear()
+        else:
+            self.partition_times[partition] = (cluster_time.time, cluster_time.inc)
+            self.pending.discard(partition)
+
+    def apply_change(self, change: dict):
+        key = change.get("documentKey", {}).get("_id")
+        self._apply_version(change, change.get("fullDocument") or (self.documents.get(self._key(key)) or (None, None))[1])
+        if change["operationType"] in ("insert", "update", "replace") and change.get("fullDocument"):
+            self.put(key, change["fullDocument"])
+        elif change["operationType"] in ("drop", "rename", "dropDatabase", "invalidate"):
+            self.clear()
+        elif change["operationType"] == "delete":
+            self.remove(key)
+        else:
+            self.invalidate(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.documents),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "complete": self.complete_until > time.monotonic(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "invalidations": self.invalidations
+        }
+
+    def _remove(self, key, keep_complete: bool = False):
+        _, document = self.documents.pop(key)
+        if self.partition_field:
+            partition = document.get(self.partition_field)
+            keys = self.partitions.get(partition, {})
+            keys.pop(key, None)
+            if not keys:
+                self.partitions.pop(partition, None)
+            if not keep_complete:
+                self.partitions_complete_until.pop(partition, None)
+        if not keep_complete:
+            self.complete_until = 0
+
+
+"""
+Function that keeps a cache coherent with its collection by following the collection's change stream.
+Every insert, update, replace and delete made by any worker is applied to the cache as soon as MongoDB reports it.
+If the stream breaks (network error, failover) the cache is cleared, since events may have been missed, and the stream is reopened.
+on_change, if given, is called with every change after it was applied to the cache (e.g. to update data derived from the documents),
+and on_resync is awaited when the stream is reopened after a failure so that derived data can be rebuilt.
+Change streams need a replica set, which MongoDB Atlas always provides.
+"""
+async def watch_collection(collection, cache: CollectionCache, on_change=None, on_resync=None):
+    delay = 1
+    failed = False
+    while True:
+        try:
+            # the stream starts at a known cluster time, which the versions of the cache start from
+            opened = await collection.database.command("ping")
+            async with collection.watch(full_document="updateLookup", start_at_operation_time=opened.get("operationTime")) as stream:
+                if opened.get("operationTime"):
+                    cache.start_version(opened["operationTime"])
+                delay = 1
+                if failed and on_resync:
+                    await on_resync()
+                failed = False
+                async for change in stream:
+                    cache.apply_change(change)
+                    if on_change:
+                        on_change(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Change stream on '{collection.name}' failed, clearing cache: {e}")
+            cache.clear()
+            failed = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
@@ -1,11 +1,25 @@
 import motor.motor_asyncio
-from pymongo import WriteConcern
+from bson import ObjectId
+from pymongo import WriteConcern, UpdateOne, ReturnDocument, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
 from dotenv import load_dotenv, find_dotenv
 import os
 from datetime import datetime, timedelta
 import json
+import asyncio
+import bisect
+import codecs
 from collections import defaultdict
-from models import Ingredient, MenuItem, IngredientCreate
+from cache import CollectionCache, watch_collection
+from metrics import MongoCommandListener, MongoPoolListener
+from write_buffer import WriteBuffer
+from alerts import InventoryAlerts
+from expiry import ExpiryIndex
+from search import SearchIndex
+from broadcast import Broadcaster
+from bulk_io import PARSERS
+from models import MenuItem, IngredientCreate, ResupplyIngredientCreate
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
@@ -20,113 +34,722 @@ if not connection_string:
     raise ValueError("No MongoDB connection string provided in the .env file under 'CONNECTION_STRING'.")
 
 
+"""
+Connection pool settings, read from the .env file when set (the pymongo defaults otherwise).
+The pool belongs to one worker process: with WEB_CONCURRENCY workers, the database sees up to workers x DB_MAX_POOL_SIZE connections.
+"""
+POOL_SETTINGS = {
+    "DB_MAX_POOL_SIZE": "maxPoolSize",
+    "DB_MIN_POOL_SIZE": "minPoolSize",
+    "DB_MAX_CONNECTING": "maxConnecting",
+    "DB_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "DB_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "DB_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "DB_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "DB_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+}
+pool_options = {option: int(os.environ[setting]) for setting, option in POOL_SETTINGS.items() if os.environ.get(setting)}
+
+
 """
 Connect to MongoDb Atlas and create the ingredients and menu collections
+Every command is reported to the MongoCommandListener and every pool event to the MongoPoolListener for the /metrics endpoint
+connect=False opens no connection and starts no monitoring thread until the first command (in startup_db_client),
+so a worker forked after importing this module gets its own pool instead of sharing the parent's sockets.
 """
-client = motor.motor_asyncio.AsyncIOMotorClient(connection_string) 
+client = motor.motor_asyncio.AsyncIOMotorClient(
+    connection_string,
+    connect=False,
+    event_listeners=[MongoCommandListener(), MongoPoolListener(pool_options.get("maxPoolSize", 100))],
+    **pool_options
+)
 db = client.shelflyfe
 ingredients_collection = db.ingredients.with_options(write_concern=WriteConcern("majority"))
 menu_items_collection = db.menu_items.with_options(write_concern=WriteConcern("majority"))
 
 
+"""
+Read preference of the read-only list endpoints (pages, streams and exports of the collections, sales trends and top sellers),
+which can be a little stale, so they can be served by the secondaries and leave the primary to the orders.
+DB_LIST_READ_PREFERENCE is "secondaryPreferred" by default (the primary when there is no secondary), DB_MAX_STALENESS_SECONDS
+(90 or more) skips the secondaries that are too far behind. The caches, the derived state and the writes always use the primary.
+"""
+list_read_preference = make_read_preference(
+    read_pref_mode_from_name(os.environ.get("DB_LIST_READ_PREFERENCE", "secondaryPreferred")),
+    None,
+    int(os.environ.get("DB_MAX_STALENESS_SECONDS", -1))
+)
+ingredients_read_collection = db.ingredients.with_options(read_preference=list_read_preference)
+menu_items_read_collection = db.menu_items.with_options(read_preference=list_read_preference)
+
+
+"""
+Version of the schema and seed data, stored in the meta collection as { "_id": "schema", "version", "updated_at" }.
+Startup only migrates and creates indexes when the stored version is older than SCHEMA_VERSION,
+so a restart normally costs a ping and one read. Bump it when the indexes or a backfill change
+(data.json is only seeded into a new database or an empty collection, see migrate_db).
+"""
+meta_collection = db.meta
+SCHEMA_VERSION = 5
+
+
+"""
+Startup progress reported by the /ready endpoint: the database answered, the schema is up to date, the caches are warm.
+"""
+readiness = {"database": False, "schema": False, "caches": False}
+
+
+"""
+Restaurant locations. Every ingredient, menu item, order event and rollup belongs to one location (its "location" field),
+every function takes the location it works on and every index is led by it, so a query only reads the documents of its location
+and the collections can be sharded by location (see SHARD_KEYS).
+Ingredients are unique per location by SKU: the _id is the SKU at DEFAULT_LOCATION ("main" by default, which also holds the data
+stored before there were locations) and "<location>:<SKU>" at the other ones, see ingredient_id.
+DEFAULT_LOCATION must not change once data is stored. Location names are letters, digits, "-" and "_" (LOCATION_PATTERN).
+"""
+DEFAULT_LOCATION = os.environ.get("DEFAULT_LOCATION", "main")
+LOCATION_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
+
+"""
+Helper to get the _id of the ingredient with a SKU at a location.
+"""
+def ingredient_id(location: str, sku: str):
+    return sku if location == DEFAULT_LOCATION else f"{location}:{sku}"
+
+
+"""
+Append-only ledger of every ordered line item, written by submit_orders_db.
+Events are not inventory: they are acknowledged by the primary only (w=1) instead of a majority, and written in batches
+through order_events_buffer so recording them does not slow down order entry.
+ORDER_EVENTS_BATCH_SIZE and ORDER_EVENTS_FLUSH_SECONDS can be set in the .env file.
+"""
+order_events_collection = db.order_events.with_options(write_concern=WriteConcern(w=1))
+order_events_buffer = WriteBuffer(
+    order_events_collection,
+    max_size=int(os.environ.get("ORDER_EVENTS_BATCH_SIZE", 500)),
+    flush_interval=float(os.environ.get("ORDER_EVENTS_FLUSH_SECONDS", 1)),
+    on_flush=lambda events: apply_rollups_db(events)
+)
+
+
+"""
+Idempotency keys of the submitted order tickets: { "_id": idempotency key, "ticket_id", "created_at" }.
+The key is the _id, so the unique _id index rejects a ticket applied twice. A key is kept ORDER_TICKET_KEY_TTL_DAYS days
+(7 by default, through a TTL index), a retry must come before that.
+"""
+order_tickets_collection = db.order_tickets.with_options(write_concern=WriteConcern("majority"))
+order_ticket_key_ttl_days = float(os.environ.get("ORDER_TICKET_KEY_TTL_DAYS", 7))
+MAX_TICKETS_PER_BATCH = 1000
+
+
+"""
+Pre-aggregated counters of the order events: dishes sold per menu item and amount used per ingredient,
+per hour, day and month. One document per (location, kind, key, granularity, bucket) holds the total in "value".
+They are updated every time the order events buffer is flushed, and can be rebuilt from the ledger with backfill_rollups_db.
+"""
+rollups_collection = db.sales_rollups
+rollups_read_collection = rollups_collection.with_options(read_preference=list_read_preference)
+ROLLUP_GRANULARITIES = ("hour", "day", "month")
+
+
+"""
+Log of the expiry transitions fired by the expiry sweeper: { "location", "sku", "name", "state": "expiring" | "expired", "expiry_date", "at" }.
+"""
+expiry_transitions_collection = db.expiry_transitions
+
+
+"""
+In-process caches in front of the ingredients (keyed by _id, see ingredient_id) and menu items (keyed by menu id) collections,
+partitioned by location so the documents of one location can be loaded and listed on their own.
+They are kept coherent by change stream watchers started in start_caches_db.
+The structure fields are the ones the recipe graph is compiled from.
+Every write below that changed a document marks the location it wrote to (see CollectionCache.touch), whose list has no ETag
+until the change comes back through the change stream (see CollectionCache.get_version).
+CACHE_TTL_SECONDS and CACHE_MAX_SIZE can be set in the .env file.
+"""
+cache_ttl = float(os.environ.get("CACHE_TTL_SECONDS", 300))
+cache_max_size = int(os.environ.get("CACHE_MAX_SIZE", 100000))
+ingredients_cache = CollectionCache(
+    "ingredients", ttl=cache_ttl, max_size=cache_max_size, structure_fields=("name", "stock_measurement", "location"), partition_field="location"
+)
+menu_items_cache = CollectionCache(
+    "menu_items", ttl=cache_ttl, max_size=cache_max_size, structure_fields=("id", "name", "category", "ingredients", "location"), partition_field="location"
+)
+
+
+"""
+Recipe graph of every location, compiled from its menu and its ingredients (see recipe_graph.py),
+rebuilt by get_recipe_graph_db when either changes.
+"""
+recipe_graphs = {}
+
+
+"""
+Portions of every menu item of every location the current stock allows (see availability.py), built by get_menu_availability_db
+and updated by apply_stock_changes for the recipes that use an ingredient whose stock changed.
+Every change is published to the location's broadcaster in availability_broadcasters for the clients following /menu-availability/stream.
+"""
+menu_availabilities = {}
+availability_broadcasters = {}
+
+
+"""
+Low stock and expiry alerts of every ingredient of every location (see alerts.py), built by get_inventory_alerts_db and updated by
+apply_ingredient_change, every change is published to the location's broadcaster in alerts_broadcasters for the clients following
+/inventory-alerts/stream.
+EXPIRING_ALERT_DAYS (90 by default, the window the dashboard shows) can be set in the .env file.
+"""
+inventory_alerts = {}
+alerts_broadcasters = {}
+expiring_alert_days = float(os.environ.get("EXPIRING_ALERT_DAYS", 90))
+
+
+"""
+Expiry dates of the ingredients and the min-heap of upcoming expiry instants of every location (see expiry.py), built by get_expiry_index_db.
+expiry_sweeper_loop sleeps until the first instant of any location, or until expiry_wakeup is set because an earlier one was added.
+"""
+expiry_indexes = {}
+expiry_wakeup = asyncio.Event()
+
+
+"""
+Search index of the ingredients and menu items of every location (see search.py), built by get_search_index_db
+and updated by apply_ingredient_change and apply_menu_item_change.
+"""
+search_indexes = {}
+
+
+"""
+Function to get the broadcaster of a location, creating it on first use.
+"""
+def location_broadcaster(broadcasters: dict, name: str, location: str):
+    if location not in broadcasters:
+        broadcasters[location] = Broadcaster(f"{name}:{location}")
+    return broadcasters[location]
+
+
+"""
+Background tasks (change stream watchers, rollup refresher) started at startup and cancelled at shutdown.
+"""
+background_tasks = []
+
+
+"""
+Indexes for the fields the queries filter on, all led by the location since every query is scoped to one.
+expiry_date (the earliest lot) serves the expired query, lots.expiry_date (multikey, one entry per lot) the expiring query, name is used to resolve recipe ingredients when orders are submitted,
+and is_low_stock is a flag kept up to date by every write that changes stock (see LOW_STOCK_STAGE), indexed only where it is true.
+SKUs and names are unique per location. location_keyset serves the keyset pagination of a location's list.
+Menu items are filtered by category/season and looked up (and seeded or imported) by their numeric data.json id, which is unique per location when present.
+"""
+ingredient_indexes = [
+    IndexModel([("location", ASCENDING), ("_id", ASCENDING)], name="location_keyset"),
+    IndexModel([("location", ASCENDING), ("sku", ASCENDING)], name="location_sku_unique", unique=True),
+    IndexModel([("location", ASCENDING), ("expiry_date", ASCENDING)], name="location_expiry_date"),
+    IndexModel([("location", ASCENDING), ("lots.expiry_date", ASCENDING)], name="location_lots_expiry_date"),
+    IndexModel([("location", ASCENDING), ("name", ASCENDING)], name="location_name_unique", unique=True),
+    IndexModel([("location", ASCENDING), ("is_low_stock", ASCENDING)], name="location_low_stock", partialFilterExpression={"is_low_stock": True}),
+]
+menu_item_indexes = [
+    IndexModel([("location", ASCENDING), ("_id", ASCENDING)], name="location_keyset"),
+    IndexModel([("location", ASCENDING), ("category", ASCENDING), ("season", ASCENDING)], name="location_category_season"),
+    IndexModel([("location", ASCENDING), ("id", ASCENDING)], name="location_id_unique", unique=True, partialFilterExpression={"id": {"$exists": True}}),
+]
+order_event_indexes = [
+    IndexModel([("location", ASCENDING), ("created_at", ASCENDING)], name="location_created_at"),
+]
+order_ticket_indexes = [
+    IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=int(order_ticket_key_ttl_days * 86400)),
+]
+expiry_transition_indexes = [
+    IndexModel([("location", ASCENDING), ("sku", ASCENDING), ("at", DESCENDING)], name="location_sku_at"),
+    IndexModel([("location", ASCENDING), ("at", DESCENDING)], name="location_at"),
+    IndexModel(
+        [("location", ASCENDING), ("sku", ASCENDING), ("expiry_date", ASCENDING), ("state", ASCENDING)],
+        name="location_sku_expiry_state", unique=True
+    ),
+]
+rollup_indexes = [
+    IndexModel(
+        [("location", ASCENDING), ("kind", ASCENDING), ("granularity", ASCENDING), ("key", ASCENDING), ("bucket", ASCENDING)],
+        name="location_kind_granularity_key_bucket", unique=True
+    ),
+    IndexModel(
+        [("location", ASCENDING), ("kind", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING), ("value", DESCENDING)],
+        name="location_kind_granularity_bucket_value"
+    ),
+]
+
+
+"""
+Indexes replaced by the ones above when the location was added, dropped by migrate_db once their replacements exist.
+"""
+OBSOLETE_INDEXES = {
+    "ingredients": ["expiry_date", "lots_expiry_date", "name_unique", "low_stock"],
+    "menu_items": ["id", "category_season", "id_unique"],
+    "order_events": ["created_at"],
+    "expiry_transitions": ["sku_at", "at", "sku_expiry_state"],
+    "sales_rollups": ["kind_granularity_key_bucket", "kind_granularity_bucket_value"],
+}
+
+
+"""
+Shard keys for a sharded cluster, used by shard_collections_db when SHARD_COLLECTIONS is "true".
+Every key starts with the location, so the queries of one location (which always filter on it) go to the shard holding its range,
+and every unique index above is prefixed by its collection's shard key as MongoDB requires.
+The ingredient and menu item _ids are unique across locations (see ingredient_id, menu items use ObjectIds).
+"""
+SHARD_KEYS = {
+    "ingredients": {"location": 1},
+    "menu_items": {"location": 1},
+    "order_events": {"location": 1, "created_at": 1},
+    "sales_rollups": {"location": 1, "kind": 1},
+    "expiry_transitions": {"location": 1},
+}
+
+
+"""
+Update pipeline stage that recomputes the materialized is_low_stock flag.
+It is appended to every update that changes stock or warningStockAmount.
+"""
+LOW_STOCK_STAGE = {"$set": {"is_low_stock": {"$lt": ["$stock", "$warningStockAmount"]}}}
+
+
+"""
+Update pipeline stage that sets expiry_date to the expiry of the first lot to expire.
+It is appended to every update that changes the lots. When no lot is left the previous expiry_date is kept.
+"""
+EARLIEST_EXPIRY_STAGE = {"$set": {"expiry_date": {"$ifNull": [{"$min": "$lots.expiry_date"}, "$expiry_date"]}}}
+
+
 """
 Function that gets called when the server/API shuts down.
-It drops the ingredients and menu items collections and closes the MongoDB client connection.
+It stops the background tasks, ends the Server-Sent Events streams, writes the buffered order events and closes the MongoDB client connection.
+The data is kept, the next start reuses it.
 """
 async def shutdown_db_client():
     try:
-        await ingredients_collection.drop()
-        await menu_items_collection.drop()
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        background_tasks.clear()
+        for broadcaster in [*availability_broadcasters.values(), *alerts_broadcasters.values()]:
+            broadcaster.close()
+        await order_events_buffer.close()
         client.close()
     except Exception as e:
         raise e
-    
+
 
 """
-Function that gets called when the server/API starts up.
-Populates the collections with the data from the data.json file.
+Function that gets called when the server/API starts up, see start_db.
+If MongoDB cannot be reached or the migration fails, the server still starts (/ready answers 503)
+and retry_start_db keeps trying in the background.
 """
 async def startup_db_client():
     try:
-        await client.admin.command("ping")
+        await start_db()
+    except Exception as e:
+        print(f"Failed to connect to MongoDB, retrying in the background: {e}")
+        background_tasks.append(asyncio.create_task(retry_start_db()))
+
+
+"""
+Function that opens the connection pool, brings the schema up to date if needed (see SCHEMA_VERSION) and starts the background tasks.
+The caches are warmed in the background, so the server answers right away (from the database until they are warm).
+The steps already done are skipped, so it can be called again after a failure.
+"""
+async def start_db():
+    if not readiness["database"]:
+        await warm_up_db()
+        readiness["database"] = True
         print("Connected to MongoDB")
 
-        try:
-            with open('data.json', 'r') as file:
-                data = json.load(file)
-
-            #* Check if the collections are empty before inserting data
-            ingredients_count = await ingredients_collection.count_documents({})
-            menu_items_count = await menu_items_collection.count_documents({})
-            
-            if ingredients_count == 0 and menu_items_count == 0:
-                ingredients_data = data["ingredients"]
-
-                for ingredient in ingredients_data:
-                    if "expiry_date" in ingredient and isinstance(ingredient["expiry_date"], str):
-                        try:
-                            ingredient["expiry_date"] = datetime.strptime(
-                                ingredient["expiry_date"], "%Y-%m-%d"
-                            )
-                        except ValueError:
-                            print(f"Warning: Invalid date format for ingredient {ingredient.get('name', 'unknown')}: {ingredient['expiry_date']}")
-                            ingredient["expiry_date"] = datetime.now()
-
-                await ingredients_collection.insert_many(ingredients_data)
-                print(f"Data successfully loaded into MongoDB collection '{ingredients_collection.name}'")
-
-            recipes_data = []
-            for category, recipes in data.get("recipes", {}).items():
-                for recipe in recipes:
-                    recipe["category"] = category
-                    recipes_data.append(recipe)
-            
-            if recipes_data:
-                await menu_items_collection.insert_many(recipes_data)
-                print(f"Data successfully loaded into MongoDB collection '{menu_items_collection.name}'")
+    if not readiness["schema"]:
+        schema = await meta_collection.find_one({"_id": "schema"})
+        if (schema or {}).get("version", 0) < SCHEMA_VERSION:
+            await migrate_db(seed=schema is None)
+        readiness["schema"] = True
 
-            else:
-                print(f"Collection '{ingredients_collection.name}' already contains data. Skipping import.")
-                
+        order_events_buffer.start()
+        background_tasks.append(asyncio.create_task(warm_caches_db()))
+        background_tasks.append(asyncio.create_task(refresh_ingredient_increases_loop()))
+        background_tasks.append(asyncio.create_task(expiry_sweeper_loop()))
+
+
+"""
+Background task retrying start_db after a failed startup, waiting 1 second and doubling the wait up to 60 seconds between attempts.
+"""
+async def retry_start_db():
+    delay = 1
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            await start_db()
+            return
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"Error loading data into MongoDB: {str(e)}")
-        
+            print(f"Failed to connect to MongoDB, retrying in {min(delay * 2, 60)} seconds: {e}")
+            delay = min(delay * 2, 60)
+
+
+"""
+Function to open DB_WARM_CONNECTIONS connections (4 by default) before the first request, with concurrent pings,
+so the first requests after a restart do not pay for the TCP and TLS handshakes.
+"""
+async def warm_up_db():
+    connections = int(os.environ.get("DB_WARM_CONNECTIONS", 4))
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(max(1, connections))))
+
+
+"""
+Function to bring the database up to SCHEMA_VERSION: backfill the new fields, seed data.json, clean up, create the indexes,
+drop the ones they replace and shard the collections when asked to.
+data.json is only seeded into a new database (seed, when there is no schema document yet) or into an empty collection,
+so the ingredients and menu items deleted since do not come back with a new SCHEMA_VERSION.
+Every step is idempotent, so several workers starting together, or a start interrupted halfway, are safe.
+"""
+async def migrate_db(seed: bool = False):
+    await backfill_locations_db()
+    await convert_prices_db()
+    await seed_db(seed)
+    await remove_duplicate_menu_items_db()
+    await ensure_indexes_db()
+    await drop_obsolete_indexes_db()
+    await shard_collections_db()
+    await meta_collection.update_one(
+        {"_id": "schema"},
+        {"$max": {"version": SCHEMA_VERSION}, "$set": {"updated_at": datetime.now()}},
+        upsert=True
+    )
+    print(f"Database schema updated to version {SCHEMA_VERSION}")
+
+
+"""
+Function to add the location to the documents stored before there were locations: they belong to DEFAULT_LOCATION,
+whose ingredients keep their SKU as _id. It runs before the indexes led by the location are created.
+"""
+async def backfill_locations_db():
+    for collection in (ingredients_collection, menu_items_collection, order_events_collection, rollups_collection, expiry_transitions_collection):
+        result = await collection.update_many({"location": {"$exists": False}}, {"$set": {"location": DEFAULT_LOCATION}})
+        if result.modified_count:
+            print(f"Added the location to {result.modified_count} documents of '{collection.name}'")
+    await ingredients_collection.update_many({"sku": {"$exists": False}}, [{"$set": {"sku": "$_id"}}])
+
+
+"""
+Function to store the prices of the ingredients as numbers, data.json has them as strings (e.g. "0.99").
+A price that is not a number is left as it is.
+"""
+async def convert_prices_db():
+    result = await ingredients_collection.update_many(
+        {"price": {"$type": "string"}},
+        [{"$set": {"price": {"$convert": {"input": "$price", "to": "double", "onError": "$price"}}}}]
+    )
+    if result.modified_count:
+        print(f"Converted the price of {result.modified_count} ingredients to a number")
+
+
+"""
+Function to drop the indexes listed in OBSOLETE_INDEXES, the ones that do not exist are skipped.
+"""
+async def drop_obsolete_indexes_db():
+    for name, indexes in OBSOLETE_INDEXES.items():
+        existing = await db[name].index_information()
+        for index in indexes:
+            if index in existing:
+                await db[name].drop_index(index)
+
+
+"""
+Function to shard the collections on their SHARD_KEYS when SHARD_COLLECTIONS is "true" in the .env file (the cluster must be sharded).
+The indexes supporting the shard keys exist by then (see ensure_indexes_db). A collection that is already sharded is reported and skipped.
+"""
+async def shard_collections_db():
+    if os.environ.get("SHARD_COLLECTIONS", "false").lower() != "true":
+        return
+    await client.admin.command("enableSharding", db.name)
+    for name, key in SHARD_KEYS.items():
+        try:
+            await client.admin.command("shardCollection", f"{db.name}.{name}", key=key)
+            print(f"Sharded '{name}' on {key}")
+        except PyMongoError as e:
+            print(f"Failed to shard '{name}': {e}")
+
+
+"""
+Function to seed the collections with the data from the data.json file, at DEFAULT_LOCATION.
+A collection is only seeded when force is True or it is empty.
+Every ingredient (by SKU) and recipe (by its numeric id) is upserted with $setOnInsert, so only the missing ones are added
+and data that already exists is never overwritten.
+"""
+async def seed_db(force: bool = False):
+    try:
+        with open('data.json', 'r') as file:
+            data = json.load(file)
+
+        operations = []
+        for ingredient in data.get("ingredients", []):
+            if "expiry_date" in ingredient and isinstance(ingredient["expiry_date"], str):
+                try:
+                    ingredient["expiry_date"] = datetime.strptime(ingredient["expiry_date"], "%Y-%m-%d")
+                except ValueError:
+                    print(f"Warning: Invalid date format for ingredient {ingredient.get('name', 'unknown')}: {ingredient['expiry_date']}")
+                    ingredient["expiry_date"] = datetime.now()
+            ingredient.setdefault("version", 0)
+            ingredient.setdefault("sku", ingredient["_id"])
+            ingredient["price"] = float(ingredient.get("price", 0))
+            ingredient["location"] = DEFAULT_LOCATION
+            ingredient["is_low_stock"] = ingredient["stock"] < ingredient["warningStockAmount"]
+            ingredient["lots"] = [{"quantity": ingredient["stock"], "expiry_date": ingredient["expiry_date"]}]
+            operations.append(UpdateOne({"_id": ingredient["_id"], "location": DEFAULT_LOCATION}, {"$setOnInsert": ingredient}, upsert=True))
+        if force or not await ingredients_collection.find_one({}, {"_id": 1}):
+            await seed_collection_db(ingredients_collection, operations)
+
+        operations = [
+            UpdateOne({"location": DEFAULT_LOCATION, "id": recipe["id"]}, {"$setOnInsert": {**recipe, "category": category}}, upsert=True)
+            for category, recipes in data.get("recipes", {}).items() for recipe in recipes
+        ]
+        if force or not await menu_items_collection.find_one({}, {"_id": 1}):
+            await seed_collection_db(menu_items_collection, operations)
+    except Exception as e:
+        print(f"Error loading data into MongoDB: {str(e)}")
+
+
+"""
+Function to apply the seed upserts of a collection. Duplicate key errors mean another worker inserted the same document first and are ignored.
+"""
+async def seed_collection_db(collection, operations: list):
+    if not operations:
+        return
+    try:
+        result = await collection.bulk_write(operations, ordered=False)
+        inserted = result.upserted_count
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise e
+        inserted = e.details["nUpserted"]
+    if inserted:
+        print(f"Data successfully loaded into MongoDB collection '{collection.name}' ({inserted} documents)")
+
+
+"""
+Function to delete the copies of the data.json recipes left by the previous startups, which inserted them again on every start.
+The first menu item of every numeric id of a location is kept.
+"""
+async def remove_duplicate_menu_items_db():
+    duplicates = []
+    async for group in menu_items_collection.aggregate([
+        {"$match": {"id": {"$exists": True}}},
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": {"location": "$location", "id": "$id"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]):
+        duplicates += group["ids"][1:]
+    if duplicates:
+        await menu_items_collection.delete_many({"_id": {"$in": duplicates}})
+        print(f"Removed {len(duplicates)} duplicate menu items")
+
+
+"""
+Function to warm the caches and build the derived state in the background after startup, see start_caches_db.
+"""
+async def warm_caches_db():
+    try:
+        await start_caches_db()
+        readiness["caches"] = True
     except Exception as e:
-        print(f"Failed to connect to MongoDB: {e}")
+        print(f"Failed to warm the caches: {e}")
+
+
+"""
+Function to start the change stream watchers that keep the caches coherent, to warm the caches with both collections
+and to build the recipe graph, the menu availability, the inventory alerts and the expiry index of every location.
+"""
+async def start_caches_db():
+    background_tasks.append(asyncio.create_task(watch_collection(
+        ingredients_collection, ingredients_cache, on_change=on_ingredient_change, on_resync=resync_ingredients_db
+    )))
+    background_tasks.append(asyncio.create_task(watch_collection(
+        menu_items_collection, menu_items_cache, on_change=on_menu_item_change, on_resync=resync_search_db
+    )))
+    for location in await get_locations_db():
+        await build_location_state_db(location)
+
+
+"""
+Function to build the menu availability, the inventory alerts, the expiry index and the search index of a location
+(and the recipe graph they use).
+"""
+async def build_location_state_db(location: str):
+    await get_menu_availability_db(location)
+    await get_inventory_alerts_db(location)
+    await get_expiry_index_db(location)
+    await get_search_index_db(location)
+
+
+"""
+Function to get the locations that have ingredients or menu items, DEFAULT_LOCATION always included.
+"""
+async def get_locations_db():
+    try:
+        locations = set(await ingredients_collection.distinct("location")) | set(await menu_items_collection.distinct("location"))
+        return sorted(locations | {DEFAULT_LOCATION})
+    except Exception as e:
+        raise e
+
+
+"""
+Function to make sure the indexes declared in ingredient_indexes and menu_item_indexes exist.
+create_indexes does nothing for indexes that already exist, so it is safe to call on every startup.
+Ingredients written before the is_low_stock flag or the lots existed get them computed here (their whole stock becomes one lot).
+A failing index (e.g. duplicate ingredient names already stored) is reported but does not stop the server.
+"""
+async def ensure_indexes_db():
+    await ingredients_collection.update_many({"is_low_stock": {"$exists": False}}, [LOW_STOCK_STAGE])
+    await ingredients_collection.update_many(
+        {"lots": {"$exists": False}},
+        [{"$set": {"lots": [{"quantity": "$stock", "expiry_date": "$expiry_date"}]}}]
+    )
+    for collection, indexes in (
+        (ingredients_collection, ingredient_indexes),
+        (menu_items_collection, menu_item_indexes),
+        (order_events_collection, order_event_indexes),
+        (order_tickets_collection, order_ticket_indexes),
+        (expiry_transitions_collection, expiry_transition_indexes),
+        (rollups_collection, rollup_indexes)
+    ):
+        try:
+            await collection.create_indexes(indexes)
+        except Exception as e:
+            print(f"Failed to create indexes on '{collection.name}': {e}")
+
+
+"""
+Function to build the document of a new ingredient.
+It builds the python dictionary directly instead of going through the Ingredient Pydantic model,
+the payload was already validated by FastAPI so there is nothing left to check.
+"""
+def new_ingredient_document(
+    sku: str, name: str, stock: int, price: float, expiry_date: str, stock_measurement: str, warningStockAmount: int,
+    location: str = DEFAULT_LOCATION
+):
+    expiry_date = datetime.strptime(expiry_date, "%Y-%m-%d")
+    return {
+        "_id": ingredient_id(location, sku),
+        "sku": sku,
+        "location": location,
+        "name": name,
+        "stock": stock,
+        "price": price,
+        "expiry_date": expiry_date,
+        "lots": [{"quantity": stock, "expiry_date": expiry_date}] if stock > 0 else [],
+        "monthIncrease": "0%",
+        "yearIncrease": "0%",
+        "orders": 1,
+        "stock_measurement": stock_measurement,
+        "warningStockAmount": warningStockAmount,
+        "version": 0,
+        "is_low_stock": stock < warningStockAmount
+    }
 
 
 """
 Function to create a new ingredient in the database.
-It takes an Ingredient Pydantic model object as input and inserts it into the ingredients collection.
+It takes an ingredient python dictionary (see new_ingredient_document) as input and inserts it into the ingredients collection.
 """
-async def create_ingredient_db(ingredient: Ingredient):
+async def create_ingredient_db(ingredient: dict):
     try:
-        data = ingredient.dict(by_alias=True)
-        data["sku"] = ingredient.sku
-        await ingredients_collection.insert_one(data)
+        await ingredients_collection.insert_one(ingredient)
+        ingredients_cache.touch(ingredient["location"])
+        ingredients_cache.put(ingredient["_id"], ingredient)
+        apply_ingredient_change(ingredient["_id"], ingredient)
     except Exception as e:
         raise e
 
 
 """
-Function to get an ingredient from the database by its SKU.
+Function to get an ingredient from the database by its SKU and location.
 It takes the SKU as input and returns the ingredient python dictionary.
+The ingredient is served from the cache when possible.
 """
-async def get_ingredient_db(sku: str):
+async def get_ingredient_db(sku: str, location: str = DEFAULT_LOCATION):
     try:
-        ingredient = await ingredients_collection.find_one({"_id": sku})
+        id = ingredient_id(location, sku)
+        ingredient = ingredients_cache.get(id)
+        if ingredient is None:
+            ingredient = await ingredients_collection.find_one({"_id": id, "location": location})
+            if ingredient:
+                ingredients_cache.put(id, ingredient)
         return ingredient
     except Exception as e:
         raise e
 
 
 """
-Function to delete an ingredient from the database by its SKU.
+Function to delete an ingredient from the database by its SKU and location.
 It takes the SKU as input and deletes the ingredient from the ingredients collection.
 """
-async def delete_ingredient_db(sku: str):
+async def delete_ingredient_db(sku: str, location: str = DEFAULT_LOCATION):
     try:
-        await ingredients_collection.delete_one({"_id": sku})
+        id = ingredient_id(location, sku)
+        result = await ingredients_collection.delete_one({"_id": id, "location": location})
+        if result.deleted_count:
+            ingredients_cache.touch(location)
+        ingredients_cache.remove(id)
+        apply_ingredient_change(id, None, location)
+    except Exception as e:
+        raise e
+
+
+"""
+Exception raised when an ingredient was modified by someone else between the time it was read and the time it was written.
+"""
+class VersionConflictError(Exception):
+    pass
+
+
+"""
+Number of times a versioned update is retried when another writer changes the ingredient first.
+"""
+MAX_UPDATE_RETRIES = 5
+
+
+"""
+Function to apply an optimistic-concurrency update to an ingredient.
+Every ingredient carries a "version" field that is incremented by each write.
+The current document is read, build_update(document) returns the update to apply, and the update only succeeds if the version is still the one that was read.
+If another writer got there first the whole read/build/write is retried, up to MAX_UPDATE_RETRIES times.
+If expected_version is given and does not match the stored version, the caller is working on stale data and VersionConflictError is raised right away.
+It returns the updated ingredient python dictionary.
+"""
+async def update_ingredient_versioned_db(sku: str, build_update, expected_version: int = None, location: str = DEFAULT_LOCATION):
+    try:
+        id = ingredient_id(location, sku)
+        for _ in range(MAX_UPDATE_RETRIES):
+            # Always read the stored version, the cache may be behind
+            prevIngredient = await ingredients_collection.find_one({"_id": id, "location": location})
+            if not prevIngredient:
+                raise ValueError(f"Ingredient {sku} not found")
+
+            version = prevIngredient.get("version")
+            if expected_version is not None and (version or 0) != expected_version:
+                raise VersionConflictError(f"Ingredient {sku} was modified (version {version or 0}, expected {expected_version})")
+
+            update = build_update(prevIngredient)
+            update.setdefault("$inc", {})["version"] = 1
+            updated = await ingredients_collection.find_one_and_update(
+                {"_id": id, "location": location, "version": version if version is not None else {"$exists": False}},
+                update,
+                return_document=ReturnDocument.AFTER
+            )
+            if updated:
+                ingredients_cache.touch(location)
+                ingredients_cache.put(id, updated)
+                apply_ingredient_change(id, updated)
+                return updated
+        raise VersionConflictError(f"Ingredient {sku} kept changing, gave up after {MAX_UPDATE_RETRIES} attempts")
     except Exception as e:
         raise e
 
@@ -134,112 +757,260 @@ async def delete_ingredient_db(sku: str):
 """
 Function to update an ingredient in the database by its SKU.
 It takes the SKU and an IngredientCreate Pydantic model object as input and updates the ingredient in the ingredients collection.
+Only the fields coming from the form are set, so concurrent changes to other fields are not clobbered.
+If the IngredientCreate carries a version, the update is rejected with VersionConflictError when the ingredient changed since it was loaded.
+The form only shows the earliest expiry date and the total stock, so the lots are adjusted to match:
+a new expiry date moves the first lot, less stock is taken from the lots first-expiry-first-out, more stock is added as a new lot
+or to the lot that already has that expiry date (see add_lot).
+"""
+async def update_ingredient_db(sku: str, ingredient: IngredientCreate, location: str = DEFAULT_LOCATION):
+    expiry_date = datetime.strptime(ingredient.expiry_date, "%Y-%m-%d")
+
+    def build_update(prevIngredient):
+        lots = prevIngredient.get("lots", [{"quantity": prevIngredient["stock"], "expiry_date": prevIngredient["expiry_date"]}])
+        if lots and expiry_date != prevIngredient["expiry_date"]:
+            lots = add_lot(lots[1:], lots[0]["quantity"], expiry_date)
+        if ingredient.stock < prevIngredient["stock"]:
+            lots = consume_lots(lots, prevIngredient["stock"] - ingredient.stock)
+        elif ingredient.stock > prevIngredient["stock"]:
+            lots = add_lot(lots, ingredient.stock - prevIngredient["stock"], expiry_date)
+        return {
+            "$set": {
+                "name": ingredient.name,
+                "stock": ingredient.stock,
+                "price": ingredient.price,
+                "expiry_date": lots[0]["expiry_date"] if lots else expiry_date,
+                "lots": lots,
+                "stock_measurement": ingredient.customUnit if ingredient.customUnit else ingredient.unit,
+                "warningStockAmount": ingredient.threshold,
+                "is_low_stock": ingredient.stock < ingredient.threshold,
+                "sku": sku
+            },
+            "$inc": {"orders": 1}
+        }
+
+    try:
+        return await update_ingredient_versioned_db(sku, build_update, ingredient.version, location)
+    except Exception as e:
+        raise e
+
+
+"""
+Function to build the update pipeline that adds one delivery line to an ingredient.
+The stock is increased on the server, so concurrent resupplies and orders never lose an update.
+The delivery becomes a new lot, inserted in expiry order, and expiry_date is recomputed from the lots instead of being overwritten.
+Fields that only matter for a new ingredient use $ifNull, so the same pipeline can upsert an ingredient that does not exist yet.
+Strings coming from the client are wrapped in $literal so they are never read as field paths.
 """
-async def update_ingredient_db(sku: str, ingredient: IngredientCreate):
+def resupply_pipeline(resupply: ResupplyIngredientCreate):
+    expiry_date = datetime.strptime(resupply.expiryDate, "%Y-%m-%d")
+    new_lots = [{"quantity": resupply.stock, "expiry_date": expiry_date}] if resupply.stock > 0 else []
+    return [
+        {"$set": {
+            "sku": {"$literal": resupply.sku},
+            "name": {"$ifNull": ["$name", {"$literal": resupply.name}]},
+            "stock": {"$add": [{"$ifNull": ["$stock", 0]}, resupply.stock]},
+            "orders": {"$add": [{"$ifNull": ["$orders", 0]}, 1]},
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+            "monthIncrease": {"$ifNull": ["$monthIncrease", "0%"]},
+            "yearIncrease": {"$ifNull": ["$yearIncrease", "0%"]},
+            "warningStockAmount": {"$ifNull": ["$warningStockAmount", resupply.threshold]},
+            "price": resupply.price,
+            "expiry_date": {"$ifNull": ["$expiry_date", expiry_date]},
+            "lots": {"$sortArray": {
+                "input": {"$concatArrays": [{"$ifNull": ["$lots", []]}, new_lots]},
+                "sortBy": {"expiry_date": 1}
+            }},
+            "stock_measurement": {"$literal": resupply.customUnit if resupply.customUnit else resupply.unit}
+        }},
+        EARLIEST_EXPIRY_STAGE,
+        LOW_STOCK_STAGE
+    ]
+
+
+"""
+Function to add a whole supplier delivery to the inventory of a location.
+It takes the list of ResupplyIngredientCreate lines and:
+- checks which SKUs already exist with a single $in query,
+- builds one update per line (an upsert for new ingredients),
+- applies them with a single ordered bulk_write inside a transaction, so the delivery is either fully applied or not at all.
+It returns one result per line: { "id": line id, "sku": ..., "status": "created" | "updated" | "not_found" }.
+If any line refers to an ingredient that does not exist and is not marked as new, nothing is written.
+"""
+async def resupply_ingredients_db(resupply_list: list, location: str = DEFAULT_LOCATION):
     try:
-        prevIngredient = await get_ingredient_db(sku)
-        ingredientCreate = Ingredient(
-            _id=sku,
-            name=ingredient.name,
-            stock=ingredient.stock,
-            price=ingredient.price,
-            expiry_date=datetime.strptime(ingredient.expiry_date, "%Y-%m-%d"),  
-            monthIncrease=prevIngredient["monthIncrease"],
-            yearIncrease=prevIngredient["yearIncrease"], 
-            orders=prevIngredient["orders"] + 1,
-            stock_measurement=ingredient.customUnit if ingredient.customUnit else ingredient.unit,
-            warningStockAmount=ingredient.threshold
-        )
-        data = ingredientCreate.dict(by_alias=True)
-        data["sku"] = ingredientCreate.sku
-        await ingredients_collection.replace_one({"_id":sku}, data)
+        ids = list({ingredient_id(location, resupply.sku) for resupply in resupply_list})
+        existing = {
+            ingredient["sku"] async for ingredient in ingredients_collection.find({"location": location, "_id": {"$in": ids}}, {"sku": 1})
+        }
+
+        operations = []
+        results = []
+        for resupply in resupply_list:
+            if resupply.sku in existing:
+                status = "updated"
+            elif resupply.isNewIngredient:
+                status = "created"
+                existing.add(resupply.sku)
+            else:
+                status = "not_found"
+            results.append({"id": resupply.id, "sku": resupply.sku, "status": status})
+            operations.append(UpdateOne(
+                {"_id": ingredient_id(location, resupply.sku), "location": location}, resupply_pipeline(resupply), upsert=status == "created"
+            ))
+
+        if operations and all(result["status"] != "not_found" for result in results):
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    await ingredients_collection.bulk_write(operations, ordered=True, session=session)
+            ingredients_cache.touch(location)
+        return results
     except Exception as e:
         raise e
 
 
 """
-Function to create a new menu item in the database given a MenuItem Pydantic model object.
+Function to create a new menu item at a location in the database given a MenuItem Pydantic model object.
 It takes the MenuItem object as input and inserts it into the menu_items collection.
 """
-async def create_menu_item_db(menu_item: MenuItem):
+async def create_menu_item_db(menu_item: MenuItem, location: str = DEFAULT_LOCATION):
     try:
         data = menu_item.dict(by_alias=True)
+        data["location"] = location
         await menu_items_collection.insert_one(data)
+        menu_items_cache.touch(location)
+        menu_items_cache.put(data["_id"], data)
+        apply_menu_item_change(data["_id"], data)
     except Exception as e:
         raise e
     
 
 """
-Function to get a menu item from the database by its ID.
-It takes the ID as input and returns the menu item python dictionary.
+Function to get a menu item of a location from the database by its ID.
+It takes the ID as input and returns the menu item python dictionary, None when it is not served at the location.
+The menu item is served from the cache when possible.
 """
-async def get_menu_item_db(id: str):
+async def get_menu_item_db(id: str, location: str = DEFAULT_LOCATION):
     try:
-        menu_item = await menu_items_collection.find_one({"_id": id})
+        menu_item = menu_items_cache.get(id)
+        if menu_item is None:
+            menu_item = await menu_items_collection.find_one({"_id": parse_cursor_id(id), "location": location})
+            if menu_item:
+                menu_items_cache.put(id, menu_item)
+        elif menu_item.get("location") != location:
+            return None
         return menu_item
     except Exception as e:
         raise e
     
 
 """
-Function to get all menu items from the database.
-It returns a list of all menu items in the menu_items collection.
+Function to get all menu items of a location from the database.
+It returns a list of all menu items of the location in the menu_items collection.
+The list is served from the cache when the location is cached, otherwise it is read and cached.
 """    
-async def get_all_menu_items_db():
+async def get_all_menu_items_db(location: str = DEFAULT_LOCATION):
     try:
+        menu_items = menu_items_cache.get_all(location)
+        if menu_items is not None:
+            return menu_items
+        changes = menu_items_cache.changes
         menu_items = []
-        async for menu_item in menu_items_collection.find():
+        async for menu_item in menu_items_collection.find({"location": location}):
             menu_items.append(menu_item)
+        menu_items_cache.put_all(menu_items, changes, location)
         return menu_items
     except Exception as e:
         raise e
 
 
 """
-Function to delete a menu item from the database by its ID.
-It takes the ID as input and deletes the menu item from the menu_items collection.
+Function to delete a menu item of a location from the database by its ID.
+It takes the ID as input (the string of its ObjectId, see parse_cursor_id) and deletes the menu item from the menu_items collection.
+The cache and the search index only drop the menu item when it was deleted, an ID served at another location is left alone.
+It returns True if the menu item was deleted, False if the location has no menu item with that ID.
 """
-async def delete_menu_item_db(id: str):
+async def delete_menu_item_db(id: str, location: str = DEFAULT_LOCATION):
     try:
-        await menu_items_collection.delete_one({"_id": id})
+        result = await menu_items_collection.delete_one({"_id": parse_cursor_id(id), "location": location})
+        if result.deleted_count:
+            menu_items_cache.touch(location)
+            menu_items_cache.remove(id)
+            apply_menu_item_change(id, None, location)
+        return result.deleted_count > 0
     except Exception as e:
         raise e
 
 
 """
-Function to update a menu item in the database by its ID.
+Function to update a menu item of a location in the database by its ID.
 It takes the ID and a MenuItem Pydantic model object as input and updates the menu item in the menu_items collection.
 It uses the replace_one method to replace the entire document with the new data.
 """
-async def update_menu_item_db(id: str, menu_item: MenuItem):
+async def update_menu_item_db(id: str, menu_item: MenuItem, location: str = DEFAULT_LOCATION):
     try:
-        await menu_items_collection.replace_one({"_id":id}, menu_item.dict(by_alias=True))
+        data = menu_item.dict(by_alias=True)
+        data["location"] = location
+        result = await menu_items_collection.replace_one({"_id":id, "location": location}, data)
+        if result.matched_count:
+            if result.modified_count:
+                menu_items_cache.touch(location)
+            menu_items_cache.put(id, data)
+            apply_menu_item_change(id, data)
     except Exception as e:
         raise e
 
 
 """
-Function to get all ingredients from the database.
-It returns a list of all ingredients in the ingredients collection.
+Function to get all ingredients of a location from the database.
+It returns a list of all ingredients of the location in the ingredients collection.
+The list is served from the cache when the location is cached, otherwise it is read and cached.
 """
-async def get_all_ingredients_db():
+async def get_all_ingredients_db(location: str = DEFAULT_LOCATION):
     try:
+        ingredients = ingredients_cache.get_all(location)
+        if ingredients is not None:
+            return ingredients
+        changes = ingredients_cache.changes
         ingredients = []
-        async for ingredient in ingredients_collection.find():
+        async for ingredient in ingredients_collection.find({"location": location}):
             ingredients.append(ingredient)
+        ingredients_cache.put_all(ingredients, changes, location)
         return ingredients
     except Exception as e:
         raise e
 
 
+"""
+Function to get the ingredient documents of a list of ingredient _ids of a location (see ingredient_id), in the same order.
+They come from the cache, the missing ones are read with one $in query.
+"""
+async def get_ingredients_by_skus_db(skus: list, location: str = DEFAULT_LOCATION):
+    try:
+        documents = {sku: ingredients_cache.get(sku) for sku in skus}
+        missing = [sku for sku, document in documents.items() if document is None]
+        if missing:
+            async for document in ingredients_collection.find({"location": location, "_id": {"$in": missing}}):
+                documents[document["_id"]] = document
+        return [documents[sku] for sku in skus if documents[sku] is not None]
+    except Exception as e:
+        raise e
+
+
 """
 Function to get all expired ingredients from the database.
 It returns a list of all ingredients in the ingredients collection that have an expiry date less than the current date.
+Since expiry_date is the expiry of the first lot to expire, these are the ingredients with at least one expired lot.
+An ingredient whose lots are all used up is not expired, even though its expiry_date is still the date of its last lot.
+The SKUs come from the expiry index kept by the expiry sweeper, the database is only queried before it is built.
 """
-async def get_all_expired_ingredients_db():
+async def get_all_expired_ingredients_db(location: str = DEFAULT_LOCATION):
     try:
+        now = datetime.now()
+        if location in expiry_indexes:
+            return await get_ingredients_by_skus_db(expiry_indexes[location].expired(now), location)
         ingredients = []
-        async for ingredient in ingredients_collection.find({"expiry_date": {"$lt": datetime.datetime.now()}}):
+        async for ingredient in ingredients_collection.find({"location": location, "expiry_date": {"$lt": now}, "lots": {"$ne": []}}):
             ingredients.append(ingredient)
         return ingredients
     except Exception as e:
@@ -248,18 +1019,20 @@ async def get_all_expired_ingredients_db():
 
 """
 Function to get all ingredients that are expiring soon from the database.
-It returns a list of all ingredients in the ingredients collection that have an expiry date within the next 3 days.
-It uses the datetime module to get the current date and time and adds 3 days to it.
-It then queries the ingredients collection for ingredients with an expiry date between now and soon.
-It returns a list of ingredients that are expiring soon.
+It returns a list of all ingredients in the ingredients collection that have a lot expiring within the next days (3 by default),
+soonest first. The SKUs come from the expiry index, which answers any window with a binary search.
+Before the index is built the ingredients collection is queried for a lot expiring between now and soon, using the lots.expiry_date index.
 """
-async def get_expiring_ingredients_db():
+async def get_expiring_ingredients_db(days: float = 3, location: str = DEFAULT_LOCATION):
     try:
-        ingredients = []
         now = datetime.now()
-        soon = now + timedelta(days=3)  # Adjust the number of days as needed
+        if location in expiry_indexes:
+            return await get_ingredients_by_skus_db(expiry_indexes[location].expiring(now, days), location)
+        soon = now + timedelta(days=days)
+        ingredients = []
         async for ingredient in ingredients_collection.find({
-            "expiry_date": {"$gte": now, "$lte": soon}
+            "location": location,
+            "lots": {"$elemMatch": {"expiry_date": {"$gte": now, "$lte": soon}}}
         }):
             ingredients.append(ingredient)
         return ingredients
@@ -270,14 +1043,976 @@ async def get_expiring_ingredients_db():
 """
 Function to get all ingredients that are low in stock from the database.
 It returns a list of all ingredients in the ingredients collection that have a stock amount less than the warningStockAmount.
+The ingredients are filtered in memory when the location is cached, otherwise the partial index on is_low_stock is used.
 """
-async def get_low_stock_ingredients_db():
+async def get_low_stock_ingredients_db(location: str = DEFAULT_LOCATION):
     try:
+        cached = ingredients_cache.get_all(location)
+        if cached is not None:
+            return [ingredient for ingredient in cached if ingredient["stock"] < ingredient["warningStockAmount"]]
         ingredients = []
-        async for ingredient in ingredients_collection.find({
-            "$expr": {"$lt": ["$stock", "$warningStockAmount"]}
-        }):
+        async for ingredient in ingredients_collection.find({"location": location, "is_low_stock": True}):
             ingredients.append(ingredient)
         return ingredients
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+
+"""
+Fields of the ingredients listed by the dashboard summary.
+"""
+DASHBOARD_FIELDS = {"_id": 1, "name": 1, "stock": 1, "stock_measurement": 1, "warningStockAmount": 1, "expiry_date": 1}
+
+
+"""
+Function to get everything the dashboard shows in one aggregation:
+- expired: the ingredients with a lot that has expired, oldest first
+- expiring: the ingredients with a lot expiring within the next days, soonest first
+- low_stock: the ingredients below their warningStockAmount, lowest stock compared to it first
+- counts: the number of ingredients in each list and the at-risk value, the price of the stock in lots that are expired
+  or expire within the days
+The lists hold at most limit ingredients with only the DASHBOARD_FIELDS, the counts are always exact.
+Only the ingredients with an alert are read, through the expiry_date and low_stock indexes, and $facet computes
+every list from that one scan, so the summary costs a single round trip.
+"""
+async def get_dashboard_summary_db(days: float = 3, limit: int = 50, location: str = DEFAULT_LOCATION):
+    try:
+        now = datetime.now()
+        soon = now + timedelta(days=days)
+        compact = [{"$limit": limit}, {"$project": DASHBOARD_FIELDS}]
+        result = await ingredients_collection.aggregate([
+            {"$match": {"location": location, "$or": [{"expiry_date": {"$lte": soon}}, {"is_low_stock": True}]}},
+            {"$set": {
+                # from the lots, expiry_date keeps the date of the last lot once they are all used up
+                "expired": {"$cond": [
+                    {"$isArray": "$lots"},
+                    {"$gt": [{"$size": {"$filter": {"input": "$lots", "cond": {"$lt": ["$$this.expiry_date", now]}}}}, 0]},
+                    {"$lt": ["$expiry_date", now]}
+                ]},
+                "expiring": {"$gt": [{"$size": {"$filter": {
+                    "input": {"$ifNull": ["$lots", []]},
+                    "cond": {"$and": [{"$gte": ["$$this.expiry_date", now]}, {"$lte": ["$$this.expiry_date", soon]}]}
+                }}}, 0]},
+                "at_risk_value": {"$multiply": [
+                    {"$convert": {"input": "$price", "to": "double", "onError": 0, "onNull": 0}},
+                    {"$sum": {"$map": {
+                        "input": {"$filter": {"input": {"$ifNull": ["$lots", []]}, "cond": {"$lte": ["$$this.expiry_date", soon]}}},
+                        "in": "$$this.quantity"
+                    }}}
+                ]}
+            }},
+            {"$facet": {
+                "expired": [{"$match": {"expired": True}}, {"$sort": {"expiry_date": 1, "_id": 1}}] + compact,
+                "expiring": [
+                    {"$match": {"expiring": True}},
+                    {"$set": {"next_expiry": {"$min": {"$filter": {
+                        "input": "$lots.expiry_date", "cond": {"$gte": ["$$this", now]}
+                    }}}}},
+                    {"$sort": {"next_expiry": 1, "_id": 1}}
+                ] + compact,
+                "low_stock": [
+                    {"$match": {"is_low_stock": True}},
+                    {"$set": {"ratio": {"$cond": [
+                        {"$gt": ["$warningStockAmount", 0]}, {"$divide": ["$stock", "$warningStockAmount"]}, 0
+                    ]}}},
+                    {"$sort": {"ratio": 1, "_id": 1}}
+                ] + compact,
+                "counts": [{"$group": {
+                    "_id": None,
+                    "expired": {"$sum": {"$cond": ["$expired", 1, 0]}},
+                    "expiring": {"$sum": {"$cond": ["$expiring", 1, 0]}},
+                    "low_stock": {"$sum": {"$cond": [{"$eq": ["$is_low_stock", True]}, 1, 0]}},
+                    "at_risk_value": {"$sum": "$at_risk_value"}
+                }}, {"$project": {"_id": 0}}]
+            }}
+        ]).to_list(1)
+        summary = result[0]
+        counts = summary.pop("counts")
+        summary["counts"] = counts[0] if counts else {"expired": 0, "expiring": 0, "low_stock": 0, "at_risk_value": 0}
+        summary["counts"]["at_risk_value"] = round(summary["counts"]["at_risk_value"], 2)
+        return summary
+    except Exception as e:
+        raise e
+
+
+"""
+Function to get the recipe graph of a location, compiling it from its menu and its ingredients when it is missing or out of date.
+The graph is out of date when a menu item changed or an ingredient was added, removed, renamed or changed unit
+(see the structure_fields of the caches), stock changes do not rebuild it.
+The version counts the changes of every location, so the graph of a location is rebuilt when it is next used after such a change anywhere.
+The version is read before loading, so a change made during the load rebuilds the graph again on the next call.
+"""
+async def get_recipe_graph_db(location: str = DEFAULT_LOCATION):
+    try:
+        version = (menu_items_cache.structure_changes, ingredients_cache.structure_changes)
+        recipe_graph = recipe_graphs.get(location)
+        if recipe_graph is None or recipe_graph.version != version:
+            menu_items = await get_all_menu_items_db(location)
+            ingredients = await get_all_ingredients_db(location)
+            from recipe_graph import RecipeGraph  # imported on first use, NumPy is slow to import
+            recipe_graph = recipe_graphs[location] = RecipeGraph(menu_items, ingredients, version)
+        return recipe_graph
+    except Exception as e:
+        raise e
+
+
+"""
+Function to add a lot to a list of lots sorted by expiry date.
+Lots are kept sorted so the first one is always the next to expire, the place of the new lot is found with a binary search.
+A lot with the same expiry date as an existing one is merged into it, so there is at most one lot per expiry date.
+It returns a new list, the one given is not modified.
+"""
+def add_lot(lots: list, quantity, expiry_date: datetime):
+    lots = list(lots)
+    if quantity > 0:
+        index = bisect.bisect_left(lots, expiry_date, key=lambda lot: lot["expiry_date"])
+        if index < len(lots) and lots[index]["expiry_date"] == expiry_date:
+            lots[index] = {**lots[index], "quantity": lots[index]["quantity"] + quantity}
+        else:
+            lots.insert(index, {"quantity": quantity, "expiry_date": expiry_date})
+    return lots
+
+
+"""
+Function to take an amount out of a list of lots sorted by expiry date, first-expiry-first-out.
+Lots that are used up are dropped and the first lot left is reduced by what remains.
+It returns a new list, the one given is not modified.
+"""
+def consume_lots(lots: list, amount):
+    index = 0
+    while index < len(lots) and amount >= lots[index]["quantity"]:
+        amount -= lots[index]["quantity"]
+        index += 1
+    lots = lots[index:]
+    if lots and amount > 0:
+        lots[0] = {**lots[0], "quantity": lots[0]["quantity"] - amount}
+    return lots
+
+
+"""
+Function to build the update pipeline that takes an amount out of an ingredient, first-expiry-first-out.
+This is consume_lots done on the server:
+- a $reduce walks the sorted lots and only keeps counters: how many lots are used up and what is left of the next one,
+- the used up lots are sliced off and the next lot gets its new quantity,
+- the stock is clamped at 0 and expiry_date, is_low_stock and version are updated.
+Only the lots that are actually touched are rebuilt, so an ingredient with thousands of lots costs one pass over the array.
+"""
+def fefo_depletion_pipeline(amount):
+    lots = {"$ifNull": ["$lots", []]}
+    return [
+        {"$set": {"_fefo": {"$reduce": {
+            "input": lots,
+            "initialValue": {"remaining": amount, "used_up": 0, "left": None},
+            "in": {"$switch": {
+                "branches": [
+                    {"case": {"$lte": ["$$value.remaining", 0]}, "then": "$$value"},
+                    {"case": {"$gte": ["$$value.remaining", "$$this.quantity"]}, "then": {
+                        "remaining": {"$subtract": ["$$value.remaining", "$$this.quantity"]},
+                        "used_up": {"$add": ["$$value.used_up", 1]},
+                        "left": None
+                    }}
+                ],
+                "default": {
+                    "remaining": 0,
+                    "used_up": "$$value.used_up",
+                    "left": {"$subtract": ["$$this.quantity", "$$value.remaining"]}
+                }
+            }}
+        }}}},
+        {"$set": {
+            "lots": {"$let": {
+                "vars": {"rest": {"$slice": [lots, "$_fefo.used_up", {"$max": [1, {"$size": lots}]}]}},
+                "in": {"$cond": [
+                    {"$eq": ["$_fefo.left", None]},
+                    "$$rest",
+                    {"$concatArrays": [
+                        [{"$mergeObjects": [{"$first": "$$rest"}, {"quantity": "$_fefo.left"}]}],
+                        {"$slice": ["$$rest", 1, {"$max": [1, {"$size": "$$rest"}]}]}
+                    ]}
+                ]}
+            }},
+            "stock": {"$max": [0, {"$subtract": ["$stock", amount]}]},
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+        }},
+        {"$unset": "_fefo"},
+        EARLIEST_EXPIRY_STAGE,
+        LOW_STOCK_STAGE
+    ]
+
+
+"""
+Function to get the menu availability of a location, building it from the recipe graph and the ingredients when it is missing
+or when the recipe graph was rebuilt (a menu item or an ingredient changed). A rebuild is pushed to the clients as a new snapshot.
+"""
+async def get_menu_availability_db(location: str = DEFAULT_LOCATION):
+    try:
+        graph = await get_recipe_graph_db(location)
+        menu_availability = menu_availabilities.get(location)
+        if menu_availability is None or menu_availability.graph is not graph:
+            from availability import MenuAvailability
+            menu_availability = menu_availabilities[location] = MenuAvailability(graph, await get_all_ingredients_db(location))
+            location_broadcaster(availability_broadcasters, "menu_availability", location).publish("snapshot", menu_availability.snapshot())
+        return menu_availability
+    except Exception as e:
+        raise e
+
+
+"""
+Function to apply new stock values ({ ingredient _id: stock }) to the menu availability of a location.
+Only the menu items using those ingredients are recomputed, the ones that changed are pushed to the clients.
+"""
+def apply_stock_changes(stock: dict, location: str = DEFAULT_LOCATION):
+    menu_availability = menu_availabilities.get(location)
+    if menu_availability is None:
+        return
+    changed = menu_availability.update_stock(stock)
+    if changed:
+        location_broadcaster(availability_broadcasters, "menu_availability", location).publish("update", changed)
+
+
+"""
+Function to get the inventory alerts of a location, building them from its ingredients when they are missing.
+A rebuild is pushed to the clients as a new snapshot.
+"""
+async def get_inventory_alerts_db(location: str = DEFAULT_LOCATION):
+    try:
+        if location not in inventory_alerts:
+            inventory_alerts[location] = InventoryAlerts(await get_all_ingredients_db(location), expiring_alert_days)
+            location_broadcaster(alerts_broadcasters, "inventory_alerts", location).publish("snapshot", inventory_alerts[location].snapshot())
+        return inventory_alerts[location]
+    except Exception as e:
+        raise e
+
+
+"""
+Function to get the expiry index of a location, building it from its ingredients when it is missing.
+"""
+async def get_expiry_index_db(location: str = DEFAULT_LOCATION):
+    try:
+        if location not in expiry_indexes:
+            expiry_indexes[location] = ExpiryIndex(await get_all_ingredients_db(location), expiring_alert_days)
+            expiry_wakeup.set()
+        return expiry_indexes[location]
+    except Exception as e:
+        raise e
+
+
+"""
+Function to apply the new document of an ingredient (None when it was deleted) to the menu availability, the inventory alerts,
+the expiry index and the search index of its location, pushing what changed to the clients.
+A deleted ingredient whose location is not given is removed from every location (its _id belongs to one of them only).
+The first ingredient of a new location starts its alerts, expiry index and search index once the known locations are built.
+It returns the new alert of the ingredient when it changed, None otherwise.
+"""
+def apply_ingredient_change(id: str, ingredient: dict = None, location: str = None):
+    if ingredient:
+        location = ingredient.get("location", DEFAULT_LOCATION)
+        if readiness["caches"] and location not in expiry_indexes:
+            expiry_indexes[location] = ExpiryIndex([], expiring_alert_days)
+            inventory_alerts[location] = InventoryAlerts([], expiring_alert_days)
+            search_indexes.setdefault(location, SearchIndex())
+    locations = [location] if location else set(menu_availabilities) | set(inventory_alerts) | set(expiry_indexes) | set(search_indexes)
+    changed_alert = None
+    for location in locations:
+        apply_stock_changes({id: ingredient.get("stock", 0) if ingredient else 0}, location)
+        if location in search_indexes:
+            search_indexes[location].update("ingredient", id, ingredient)
+        expiry_index = expiry_indexes.get(location)
+        if expiry_index is not None:
+            next_instant = expiry_index.next_instant()
+            expiry_index.update(id, ingredient)
+            if expiry_index.next_instant() != next_instant:
+                expiry_wakeup.set()
+        if location in inventory_alerts:
+            alert = inventory_alerts[location].update(id, ingredient)
+            if alert:
+                location_broadcaster(alerts_broadcasters, "inventory_alerts", location).publish("alert", [alert])
+                changed_alert = alert
+    return changed_alert
+
+
+"""
+Function called by the ingredients change stream watcher for every change, from this worker or any other.
+Orders, deliveries and edits all reach the menu availability and the alerts this way, with the document stored after the write.
+"""
+def on_ingredient_change(change: dict):
+    document = change.get("fullDocument")
+    if document:
+        apply_ingredient_change(document["_id"], document)
+    elif change["operationType"] == "delete":
+        apply_ingredient_change(change["documentKey"]["_id"], None)
+
+
+"""
+Function called by the ingredients change stream watcher when the stream was reopened after a failure.
+Changes may have been missed, so the menu availability, the alerts, the expiry index and the search index of every location
+are rebuilt from the database and pushed as new snapshots. The caches are reported as cold while they are rebuilt.
+"""
+async def resync_ingredients_db():
+    readiness["caches"] = False
+    menu_availabilities.clear()
+    inventory_alerts.clear()
+    expiry_indexes.clear()
+    search_indexes.clear()
+    for location in await get_locations_db():
+        await build_location_state_db(location)
+    readiness["caches"] = True
+
+
+"""
+Function to get the search index of a location, building it from its ingredients and menu items when it is missing.
+"""
+async def get_search_index_db(location: str = DEFAULT_LOCATION):
+    try:
+        if location not in search_indexes:
+            search_indexes[location] = SearchIndex(await get_all_ingredients_db(location), await get_all_menu_items_db(location))
+        return search_indexes[location]
+    except Exception as e:
+        raise e
+
+
+"""
+Function to apply the new document of a menu item (None when it was deleted) to the search index of its location.
+A deleted menu item whose location is not given is removed from every location.
+"""
+def apply_menu_item_change(id, menu_item: dict = None, location: str = None):
+    if menu_item:
+        location = menu_item.get("location", DEFAULT_LOCATION)
+        if readiness["caches"]:
+            search_indexes.setdefault(location, SearchIndex())
+    for location in [location] if location else list(search_indexes):
+        if location in search_indexes:
+            search_indexes[location].update("menu_item", id, menu_item)
+
+
+"""
+Function called by the menu items change stream watcher for every change, from this worker or any other.
+"""
+def on_menu_item_change(change: dict):
+    document = change.get("fullDocument")
+    if document:
+        apply_menu_item_change(document["_id"], document)
+    elif change["operationType"] == "delete":
+        apply_menu_item_change(change["documentKey"]["_id"], None)
+
+
+"""
+Function called by the menu items change stream watcher when the stream was reopened after a failure.
+Changes may have been missed, so the search index of every location is rebuilt from the database.
+"""
+async def resync_search_db():
+    search_indexes.clear()
+    for location in await get_locations_db():
+        await get_search_index_db(location)
+
+
+"""
+Function to re-check the ingredients of a location whose expiry instant has passed (see ExpiryIndex.due).
+Their current document is applied like any other change, so the alerts move to "expiring" or "expired" and are pushed to the clients,
+and every transition is recorded in the expiry_transitions collection.
+Every worker process runs its own sweeper, so a transition is upserted by (location, sku, expiry_date, state) and recorded only once.
+"""
+async def sweep_expiry_db(skus: set, now: datetime, location: str = DEFAULT_LOCATION):
+    try:
+        documents = {document["_id"]: document for document in await get_ingredients_by_skus_db(list(skus), location)}
+        transitions = []
+        for id in skus:
+            alert = apply_ingredient_change(id, documents.get(id), location)
+            if alert and alert["expiry"]:
+                transitions.append({
+                    "location": location,
+                    "sku": documents[id].get("sku", id),
+                    "name": alert["name"],
+                    "state": alert["expiry"],
+                    "expiry_date": alert["expiry_date"],
+                    "at": now
+                })
+        if transitions:
+            try:
+                await expiry_transitions_collection.bulk_write([
+                    UpdateOne(
+                        {
+                            "location": location,
+                            "sku": transition["sku"],
+                            "expiry_date": transition["expiry_date"],
+                            "state": transition["state"]
+                        },
+                        {"$setOnInsert": transition},
+                        upsert=True
+                    )
+                    for transition in transitions
+                ], ordered=False)
+            except BulkWriteError as e:
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise e
+        return transitions
+    except Exception as e:
+        raise e
+
+
+"""
+Background task that fires the expiry transitions when they happen.
+It sleeps until the first instant of the expiry indexes of all the locations (at most EXPIRY_SWEEP_MAX_SECONDS, 3600 by default,
+so a clock change is noticed) or until a write schedules an earlier instant or an index is built, then sweeps every instant that has passed.
+"""
+async def expiry_sweeper_loop():
+    max_sleep = float(os.environ.get("EXPIRY_SWEEP_MAX_SECONDS", 3600))
+    while True:
+        expiry_wakeup.clear()
+        timeout = max_sleep
+        try:
+            now = datetime.now()
+            next_instants = []
+            for location, index in list(expiry_indexes.items()):
+                due = index.due(now)
+                if due:
+                    await sweep_expiry_db(due, now, location)
+                if index.next_instant() is not None:
+                    next_instants.append(index.next_instant())
+            if next_instants:
+                timeout = min(max_sleep, max((min(next_instants) - datetime.now()).total_seconds(), 0))
+        except Exception as e:
+            print(f"Failed to sweep the expiry dates: {e}")
+        try:
+            await asyncio.wait_for(expiry_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+"""
+Function to subtract the used amounts from the ingredients stock of a location.
+It takes a dictionary mapping ingredient _ids to used amounts and sends every decrement in a single bulk_write.
+Each update is a pipeline (see fefo_depletion_pipeline) so the stock is clamped at 0 and the lots are consumed on the server
+instead of reading them first, and the ingredient version is bumped.
+The cached ingredients are refreshed by the change stream watcher, not here, the location is only marked as written (see CollectionCache.touch).
+"""
+async def deplete_ingredients_db(total_usage: dict, session=None, location: str = DEFAULT_LOCATION):
+    try:
+        operations = [
+            UpdateOne({"_id": sku, "location": location}, fefo_depletion_pipeline(used_amount))
+            for sku, used_amount in total_usage.items() if used_amount > 0
+        ]
+        if operations:
+            result = await ingredients_collection.bulk_write(operations, ordered=False, session=session)
+            if result.modified_count:
+                ingredients_cache.touch(location)
+    except Exception as e:
+        raise e
+
+
+"""
+Function to build the order events of a ticket, one per ordered line item.
+Each event records the dish, how many were ordered and the ingredients it used, in the ingredients' stock units:
+{ "ticket_id", "location", "created_at", "menu_item_id", "name", "category", "count", "usage": [{ "sku", "name", "amount" }] }
+where sku is the ingredient _id. Recipe ingredients that match no ingredient are recorded by name only, with the amount written in the recipe.
+"""
+def order_line_events(ticket_id: ObjectId, order_counts: dict, graph, created_at: datetime = None, location: str = DEFAULT_LOCATION):
+    created_at = created_at or datetime.now()
+    events = []
+    for recipe_id, order in order_counts.items():
+        count = order.get("count", 0)
+        row = graph.rows.get(str(recipe_id))
+        if count <= 0 or row is None:
+            continue
+        recipe = graph.recipes[row]
+        events.append({
+            "ticket_id": ticket_id,
+            "location": location,
+            "created_at": created_at,
+            "menu_item_id": str(recipe["_id"]),
+            "name": recipe.get("name"),
+            "category": recipe.get("category"),
+            "count": count,
+            "usage": graph.recipe_usage(row, count) + [
+                {"name": ingredient["name"], "amount": ingredient["amount"] * count}
+                for ingredient in graph.unresolved.get(row, [])
+            ]
+        })
+    return events
+
+
+"""
+Function to apply a whole ticket to the inventory of a location.
+The ordered dishes become a vector over the recipes of the location's compiled recipe graph, and the ingredient usage of the whole ticket
+is one sparse matrix-vector product. It is applied with one bulk_write, so a ticket costs a single round trip
+no matter how many dishes it contains (the graph comes from memory unless the menu changed).
+Every line item is then recorded in the order events ledger through the write buffer, which adds no round trip.
+It returns the ticket id and the total usage per ingredient name.
+"""
+async def submit_orders_db(order_counts: dict, location: str = DEFAULT_LOCATION):
+    try:
+        ticket_id = ObjectId()
+        if not any(order.get("count", 0) > 0 for order in order_counts.values()):
+            return ticket_id, {}
+        graph = await get_recipe_graph_db(location)
+        usage = graph.usage(graph.order_vector(order_counts))
+        await deplete_ingredients_db(graph.by_ingredient(usage, "sku"), location=location)
+        order_events_buffer.extend(order_line_events(ticket_id, order_counts, graph, location=location))
+        return ticket_id, graph.by_ingredient(usage, "name")
+    except Exception as e:
+        raise e
+
+
+"""
+Function to apply a batch of order tickets of a location (e.g. queued by a POS while it was offline) at most once each.
+Idempotency keys are global, a key already used at another location is a duplicate.
+The tickets whose idempotency key is already stored, or repeated earlier in the batch, are not applied again.
+The usage of all the new tickets is summed into one depletion, written in one transaction with their keys,
+so a batch costs the same few round trips as a single ticket and a retry after a lost response changes nothing.
+If another request stores one of the keys first, the transaction fails on the unique _id and the batch is checked again.
+The ticket created_at, when given, dates its order events so the rollups count it in the hour it was taken.
+It returns one { "idempotency_key", "status": "applied" | "duplicate", "ticket_id" } per ticket, in order,
+and the usage per ingredient name of the applied tickets.
+"""
+async def submit_order_batch_db(tickets: list, location: str = DEFAULT_LOCATION):
+    try:
+        for attempt in range(3):
+            keys = list(dict.fromkeys(ticket.idempotency_key for ticket in tickets))
+            stored = {document["_id"]: document["ticket_id"] async for document in order_tickets_collection.find({"_id": {"$in": keys}})}
+            new_tickets = {}
+            for ticket in tickets:
+                if ticket.idempotency_key not in stored:
+                    new_tickets.setdefault(ticket.idempotency_key, (ObjectId(), ticket))
+            if not new_tickets:
+                updated = {}
+                break
+
+            graph = await get_recipe_graph_db(location)
+            counts = sum((graph.order_vector(ticket.orders) for _, ticket in new_tickets.values()), graph.order_vector({}))
+            usage = graph.usage(counts)
+            now = datetime.now()
+            try:
+                async with await client.start_session() as session:
+                    async with session.start_transaction():
+                        await order_tickets_collection.insert_many([
+                            {"_id": key, "ticket_id": ticket_id, "location": location, "created_at": now}
+                            for key, (ticket_id, _) in new_tickets.items()
+                        ], session=session)
+                        await deplete_ingredients_db(graph.by_ingredient(usage, "sku"), session=session, location=location)
+            except PyMongoError as e:
+                # a concurrent transaction storing the same key fails with a duplicate key or a write conflict
+                if attempt == 2 or not (is_duplicate_key_error(e) or e.has_error_label("TransientTransactionError")):
+                    raise e
+                continue
+            for ticket_id, ticket in new_tickets.values():
+                order_events_buffer.extend(order_line_events(ticket_id, ticket.orders, graph, ticket.created_at, location))
+            updated = graph.by_ingredient(usage, "name")
+            break
+
+        results = []
+        applied = set()
+        for ticket in tickets:
+            key = ticket.idempotency_key
+            if key in new_tickets and key not in applied:
+                applied.add(key)
+                results.append({"idempotency_key": key, "status": "applied", "ticket_id": new_tickets[key][0]})
+            else:
+                ticket_id = stored[key] if key in stored else new_tickets[key][0]
+                results.append({"idempotency_key": key, "status": "duplicate", "ticket_id": ticket_id})
+        return results, updated
+    except Exception as e:
+        raise e
+
+
+"""
+Helper to check whether a failed write was rejected by a unique index (error code 11000).
+"""
+def is_duplicate_key_error(error):
+    if isinstance(error, BulkWriteError):
+        return any(write_error["code"] == 11000 for write_error in error.details.get("writeErrors", []))
+    return getattr(error, "code", None) == 11000
+
+
+"""
+Function to get how many more of every menu item of a location can be made with its current stock, and what its ingredients cost.
+Both are a single sparse matrix-vector product over the recipe graph.
+It returns one entry per menu item: { "_id", "id", "name", "category", "capacity", "cost", "limited_by", "unresolved" }
+where capacity is None when no ingredient of the recipe is known, limited_by is the ingredient _id that runs out first
+and unresolved lists the recipe ingredients that match no ingredient.
+"""
+async def get_menu_capacity_db(location: str = DEFAULT_LOCATION):
+    try:
+        graph = await get_recipe_graph_db(location)
+        ingredients = await get_all_ingredients_db(location)
+        stock = graph.ingredient_vector(ingredients, "stock")
+        capacity, limited_by = graph.capacity(stock)
+        capacity = capacity.tolist()
+        cost = graph.cost(graph.ingredient_vector(ingredients, "price")).tolist()
+        return [
+            {
+                "_id": recipe["_id"],
+                "id": recipe.get("id"),
+                "name": recipe.get("name"),
+                "category": recipe.get("category"),
+                "capacity": int(capacity[row]) if capacity[row] != float("inf") else None,
+                "cost": round(cost[row], 2),
+                "limited_by": limited_by[row],
+                "unresolved": [ingredient["name"] for ingredient in graph.unresolved.get(row, [])]
+            }
+            for row, recipe in enumerate(graph.recipes)
+        ]
+    except Exception as e:
+        raise e
+
+
+"""
+Largest page that can be requested from the paginated list functions.
+"""
+MAX_PAGE_SIZE = 1000
+
+
+"""
+Helper to turn a comma separated list of fields (e.g. "sku,name,stock") into a MongoDB projection.
+It returns None when no fields are given so the whole document is returned.
+"""
+def build_projection(fields: str = None):
+    if not fields:
+        return None
+    return {field.strip(): 1 for field in fields.split(",") if field.strip()}
+
+
+"""
+Helper to convert the "after" cursor of a page back to an _id.
+Ingredients use their SKU as _id, menu items use an ObjectId.
+"""
+def parse_cursor_id(after: str):
+    return ObjectId(after) if ObjectId.is_valid(after) else after
+
+
+"""
+Function to get one page of the documents of a location using keyset pagination on _id.
+It returns at most limit documents whose _id comes after the given one, sorted by _id, with only the projected fields.
+Since the (location, _id) index is used to seek to the start of the page, every page costs the same no matter how deep it is.
+"""
+async def get_page_db(collection, after: str = None, limit: int = 100, fields: str = None, location: str = DEFAULT_LOCATION):
+    try:
+        query = {"location": location}
+        if after:
+            query["_id"] = {"$gt": parse_cursor_id(after)}
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        cursor = collection.find(query, build_projection(fields)).sort("_id", ASCENDING).limit(limit)
+        return await cursor.to_list(limit)
+    except Exception as e:
+        raise e
+
+
+"""
+Function to stream the documents of a location document by document, in _id order (starting after the given _id, if any).
+It is an async generator that yields the documents as the Motor cursor receives them in batches,
+so the collection is never held in memory all at once.
+"""
+async def stream_collection_db(collection, fields: str = None, batch_size: int = 500, after: str = None, location: str = DEFAULT_LOCATION):
+    query = {"location": location}
+    if after:
+        query["_id"] = {"$gt": parse_cursor_id(after)}
+    async for document in collection.find(query, build_projection(fields)).sort("_id", ASCENDING).batch_size(batch_size):
+        yield document
+
+
+"""
+Function to build the upsert of one imported ingredient record of a location (from a CSV line or a JSON object, so values may be strings).
+The catalog fields (name, price, unit, threshold) are always set. Stock, lots and expiry date are only used for an ingredient
+that does not exist yet, deliveries to existing ingredients go through resupply so the lots stay right.
+Strings are wrapped in $literal so they are never read as field paths.
+"""
+def ingredient_import_operation(record: dict, location: str = DEFAULT_LOCATION):
+    sku = str(record.get("sku") or record.get("_id") or "").strip()
+    if not sku or not record.get("name"):
+        raise ValueError("sku and name are required")
+    stock = int(float(record.get("stock", 0)))
+    expiry_date = record.get("expiry_date")
+    expiry_date = datetime.strptime(str(expiry_date)[:10], "%Y-%m-%d") if expiry_date else datetime.now()
+    return UpdateOne({"_id": ingredient_id(location, sku), "location": location}, [
+        {"$set": {
+            "sku": {"$literal": sku},
+            "name": {"$literal": str(record["name"])},
+            "price": float(record.get("price", 0)),
+            "stock_measurement": {"$literal": str(record.get("stock_measurement") or record.get("unit") or "")},
+            "warningStockAmount": int(float(record.get("warningStockAmount", record.get("threshold", 0)))),
+            "stock": {"$ifNull": ["$stock", stock]},
+            "lots": {"$ifNull": ["$lots", {"$literal": [{"quantity": stock, "expiry_date": expiry_date}] if stock > 0 else []}]},
+            "expiry_date": {"$ifNull": ["$expiry_date", expiry_date]},
+            "monthIncrease": {"$ifNull": ["$monthIncrease", "0%"]},
+            "yearIncrease": {"$ifNull": ["$yearIncrease", "0%"]},
+            "orders": {"$ifNull": ["$orders", 0]},
+            "version": {"$add": [{"$ifNull": ["$version", -1]}, 1]}
+        }},
+        LOW_STOCK_STAGE
+    ], upsert=True)
+
+
+"""
+Function to build the upsert of one imported menu item record of a location, matched on its numeric data.json id.
+Ingredients may be given as a JSON string (CSV column) or a list. The location of an exported record is ignored.
+"""
+def menu_item_import_operation(record: dict, location: str = DEFAULT_LOCATION):
+    if not record.get("name") or record.get("id") is None:
+        raise ValueError("id and name are required")
+    record = {key: value for key, value in record.items() if key not in ("_id", "location")}
+    record["id"] = int(record["id"])
+    if isinstance(record.get("ingredients"), str):
+        record["ingredients"] = json.loads(record["ingredients"])
+    if "price" in record:
+        record["price"] = float(record["price"])
+    return UpdateOne({"location": location, "id": record["id"]}, {"$set": record}, upsert=True)
+
+
+IMPORT_OPERATIONS = {
+    "ingredients": (ingredients_collection, ingredients_cache, ingredient_import_operation),
+    "menu-items": (menu_items_collection, menu_items_cache, menu_item_import_operation),
+}
+
+
+"""
+Function to import a stream of ingredients or menu items into a location.
+It takes the body as an async iterator of bytes chunks in one of the bulk_io formats, parses the records as the chunks arrive
+and writes them with unordered bulk upserts of batch_size records, so memory stays bounded whatever the size of the body.
+The first offset records are skipped, so an interrupted import can be sent again and resumed where it stopped.
+Invalid records are skipped and reported. It returns
+{ "processed": records read, "next_offset": offset to resume after this body, "inserted", "updated", "errors": [{ "offset", "error" }] }
+where error offsets are relative to the start of the body. The caches are refreshed by the change stream watchers.
+"""
+async def import_records_db(kind: str, chunks, format: str = "ndjson", offset: int = 0, batch_size: int = 1000, location: str = DEFAULT_LOCATION):
+    try:
+        collection, cache, build_operation = IMPORT_OPERATIONS[kind]
+        parser = PARSERS[format]()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        result = {"processed": 0, "next_offset": offset, "inserted": 0, "updated": 0, "errors": []}
+        operations = []
+        indexes = []  # offset of the record of every operation
+
+        def add_error(index, error):
+            if len(result["errors"]) < 1000:
+                result["errors"].append({"offset": index, "error": error})
+
+        async def write(operations):
+            if not operations:
+                return
+            try:
+                written = await collection.bulk_write(operations, ordered=False)
+                result["inserted"] += written.upserted_count
+                result["updated"] += written.matched_count
+                changed = written.upserted_count + written.modified_count
+            except BulkWriteError as e:
+                # e.g. a new SKU with the name of another ingredient, the rest of the batch is written
+                result["inserted"] += e.details["nUpserted"]
+                result["updated"] += e.details["nMatched"]
+                changed = e.details["nUpserted"] + e.details["nModified"]
+                for error in e.details["writeErrors"]:
+                    add_error(indexes[error["index"]], error["errmsg"])
+            if changed:
+                cache.touch(location)
+
+        async def add(records):
+            for record in records:
+                index = result["processed"]
+                result["processed"] += 1
+                if index < offset:
+                    continue
+                try:
+                    operations.append(build_operation(record, location))
+                    indexes.append(index)
+                except Exception as e:
+                    add_error(index, str(e))
+                if len(operations) >= batch_size:
+                    await write(operations)
+                    operations.clear()
+                    indexes.clear()
+                    result["next_offset"] = result["processed"]
+
+        async for chunk in chunks:
+            await add(parser.feed(decoder.decode(chunk)))
+        await add(parser.feed(decoder.decode(b"", final=True)) + parser.close())
+        await write(operations)
+        result["next_offset"] = max(offset, result["processed"])
+        return result
+    except Exception as e:
+        raise e
+
+
+"""
+Helper to truncate a date to the start of its hour, day or month.
+"""
+def truncate_date(date: datetime, granularity: str):
+    if granularity == "hour":
+        return date.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+"""
+Function to add a batch of order events to the rollups.
+The events are summed in memory first, so the batch costs one $inc upsert per touched counter, sent in a single bulk_write.
+"""
+async def apply_rollups_db(events: list):
+    try:
+        totals = defaultdict(int)
+        names = {}
+        for event in events:
+            location = event.get("location", DEFAULT_LOCATION)
+            for granularity in ROLLUP_GRANULARITIES:
+                bucket = truncate_date(event["created_at"], granularity)
+                totals[(location, "dish", event["menu_item_id"], granularity, bucket)] += event["count"]
+                names[("dish", event["menu_item_id"])] = event["name"]
+                for usage in event["usage"]:
+                    totals[(location, "ingredient", usage["name"], granularity, bucket)] += usage["amount"]
+                    names[("ingredient", usage["name"])] = usage["name"]
+        operations = [
+            UpdateOne(
+                {"location": location, "kind": kind, "key": key, "granularity": granularity, "bucket": bucket},
+                {"$inc": {"value": value}, "$set": {"name": names[(kind, key)]}},
+                upsert=True
+            )
+            for (location, kind, key, granularity, bucket), value in totals.items()
+        ]
+        if operations:
+            await rollups_collection.bulk_write(operations, ordered=False)
+    except Exception as e:
+        raise e
+
+
+"""
+Function to rebuild the rollups from the order events ledger.
+For every granularity, one aggregation groups the events by location, dish (and one by ingredient) and bucket and $merges the totals
+into the rollups, replacing the stored counters in place, so the rollups are never missing while it runs.
+Events flushed while the backfill runs may be counted twice, so it is meant for quiet hours or after a change to how rollups are computed.
+"""
+async def backfill_rollups_db():
+    try:
+        for granularity in ROLLUP_GRANULARITIES:
+            for kind, stages, key, value, name in (
+                ("dish", [], "$menu_item_id", "$count", "$name"),
+                ("ingredient", [{"$unwind": "$usage"}], "$usage.name", "$usage.amount", "$usage.name"),
+            ):
+                await order_events_collection.aggregate(stages + [
+                    {"$group": {
+                        "_id": {
+                            "location": "$location",
+                            "key": key,
+                            "bucket": {"$dateTrunc": {"date": "$created_at", "unit": granularity}}
+                        },
+                        "value": {"$sum": value},
+                        "name": {"$last": name}
+                    }},
+                    {"$project": {
+                        "_id": 0,
+                        "location": "$_id.location",
+                        "kind": {"$literal": kind},
+                        "key": "$_id.key",
+                        "granularity": {"$literal": granularity},
+                        "bucket": "$_id.bucket",
+                        "value": 1,
+                        "name": 1
+                    }},
+                    {"$merge": {
+                        "into": rollups_collection.name,
+                        "on": ["location", "kind", "granularity", "key", "bucket"],
+                        "whenMatched": "replace",
+                        "whenNotMatched": "insert"
+                    }}
+                ]).to_list(None)
+        await refresh_ingredient_increases_db()
+    except Exception as e:
+        raise e
+
+
+"""
+Function to get a trend line of a location from the rollups.
+It returns the buckets of one granularity between start and end (inclusive), sorted by date, for one key or for all of them.
+Only the buckets in the range are read, so the cost depends on the number of buckets and not on the number of orders.
+"""
+async def get_rollups_db(kind: str, granularity: str, start: datetime, end: datetime, key: str = None, location: str = DEFAULT_LOCATION):
+    try:
+        query = {"location": location, "kind": kind, "granularity": granularity, "bucket": {"$gte": truncate_date(start, granularity), "$lte": end}}
+        if key is not None:
+            query["key"] = key
+        return await rollups_read_collection.find(query, {"_id": 0}).sort([("key", ASCENDING), ("bucket", ASCENDING)]).to_list(None)
+    except Exception as e:
+        raise e
+
+
+"""
+Function to get the daily usage of every ingredient of a location over the last days, for the forecasts.
+The daily rollups are grouped per ingredient on the server, so one document per ingredient is returned instead of one per day:
+{ "_id": ingredient name, "days": [days since the first day], "values": [amount used that day] }
+It returns the history and the first day.
+"""
+async def get_daily_usage_db(days: int, location: str = DEFAULT_LOCATION):
+    try:
+        start = truncate_date(datetime.now() - timedelta(days=days - 1), "day")
+        history = await rollups_read_collection.aggregate([
+            {"$match": {"location": location, "kind": "ingredient", "granularity": "day", "bucket": {"$gte": start}}},
+            {"$group": {
+                "_id": "$key",
+                "days": {"$push": {"$dateDiff": {"startDate": start, "endDate": "$bucket", "unit": "day"}}},
+                "values": {"$push": "$value"}
+            }}
+        ]).to_list(None)
+        return history, start
+    except Exception as e:
+        raise e
+
+
+"""
+Function to get the best sellers (or the most used ingredients) of a location in one bucket from the rollups.
+It returns the limit highest counters of the bucket containing the given date.
+"""
+async def get_top_rollups_db(kind: str, granularity: str, date: datetime, limit: int = 5, location: str = DEFAULT_LOCATION):
+    try:
+        query = {"location": location, "kind": kind, "granularity": granularity, "bucket": truncate_date(date, granularity)}
+        return await rollups_read_collection.find(query, {"_id": 0}).sort("value", DESCENDING).limit(limit).to_list(limit)
+    except Exception as e:
+        raise e
+
+
+"""
+Helper to format the change between two totals as the percentage strings used by the frontend (e.g. "5%").
+"""
+def format_increase(current, previous):
+    if not previous:
+        return "0%"
+    return f"{round((current - previous) / previous * 100)}%"
+
+
+"""
+Function to compute the monthIncrease and yearIncrease of every ingredient of every location from the monthly rollups of its location,
+replacing the values seeded from data.json.
+monthIncrease compares this month's usage with last month's, yearIncrease with the same month last year.
+It reads three monthly buckets and updates the ingredients with one bulk_write per location,
+so only the locations where an increase changed are marked as written.
+"""
+async def refresh_ingredient_increases_db():
+    try:
+        this_month = truncate_date(datetime.now(), "month")
+        last_month = truncate_date(this_month - timedelta(days=1), "month")
+        last_year = this_month.replace(year=this_month.year - 1)
+        usage = defaultdict(dict)
+        async for rollup in rollups_collection.find(
+            {"kind": "ingredient", "granularity": "month", "bucket": {"$in": [this_month, last_month, last_year]}}
+        ):
+            usage[(rollup.get("location", DEFAULT_LOCATION), rollup["key"])][rollup["bucket"]] = rollup["value"]
+        operations = defaultdict(list)
+        for (location, name), months in usage.items():
+            operations[location].append(UpdateOne({"location": location, "name": name}, {"$set": {
+                "monthIncrease": format_increase(months.get(this_month, 0), months.get(last_month, 0)),
+                "yearIncrease": format_increase(months.get(this_month, 0), months.get(last_year, 0))
+            }}))
+        for location, location_operations in operations.items():
+            result = await ingredients_collection.bulk_write(location_operations, ordered=False)
+            if result.modified_count:
+                ingredients_cache.touch(location)
+    except Exception as e:
+        raise e
+
+
+"""
+Background task refreshing the ingredient increases every ROLLUP_REFRESH_SECONDS (1 hour by default).
+"""
+async def refresh_ingredient_increases_loop():
+    while True:
+        try:
+            await refresh_ingredient_increases_db()
+        except Exception as e:
+            print(f"Failed to refresh the ingredient increases: {e}")
+        await asyncio.sleep(float(os.environ.get("ROLLUP_REFRESH_SECONDS", 3600)))
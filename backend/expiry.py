@@ -0,0 +1,104 @@
+import bisect
+import heapq
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+
+"""
+In-memory index of the expiry dates of every ingredient, used by the expiry sweeper and the expiry queries.
+- dates is sorted by date with one (expiry_date, sku, is_lot) entry per lot (and one for the expiry_date of an ingredient
+  stored before there were lots, an ingredient whose lots are all used up has none), so "expired" and "expiring within N days" are binary searches for any window.
+- heap is a min-heap of the upcoming instants an ingredient changes state: a lot enters the expiring window
+  (expiry_date - expiring_days) or expires (expiry_date). The sweeper sleeps until the first one.
+Heap entries are never removed when an ingredient changes, they are only re-checked when they come due, so the heap is
+compacted when it holds many more entries than there are dates.
+"""
+class ExpiryIndex:
+    def __init__(self, ingredients: list, expiring_days: float):
+        self.expiring_days = timedelta(days=expiring_days)
+        self.dates = []
+        self.by_sku = {}  # sku -> entries of dates for that ingredient
+        self.heap = []
+        self.swept = datetime.now()  # instants before this were handled by due
+        for ingredient in ingredients:
+            for entry in self._entries(ingredient["_id"], ingredient):
+                self.dates.append(entry)
+                self.by_sku.setdefault(ingredient["_id"], []).append(entry)
+        self.dates.sort()
+        self._build_heap()
+
+    def _entries(self, sku: str, ingredient: dict):
+        # expiry_date keeps the date of the last lot once they are all used up, it only counts when there are no lots at all
+        if ingredient.get("lots") is not None:
+            return sorted({(lot["expiry_date"], sku, True) for lot in ingredient["lots"]})
+        if ingredient.get("expiry_date"):
+            return [(ingredient["expiry_date"], sku, False)]
+        return []
+
+    def _instants(self, entry: tuple):
+        expiry_date, sku, is_lot = entry
+        if is_lot:
+            yield expiry_date - self.expiring_days, sku
+        yield expiry_date, sku
+
+    def _build_heap(self):
+        self.heap = [instant for entry in self.dates for instant in self._instants(entry) if instant[0] >= self.swept]
+        heapq.heapify(self.heap)
+
+    """
+    Function to index the new document of an ingredient (None when it was deleted).
+    Only the dates that were added are scheduled, so stock changes that do not use up or add a lot cost a dictionary lookup.
+    """
+    def update(self, sku: str, ingredient: dict = None):
+        old = self.by_sku.pop(sku, [])
+        new = self._entries(sku, ingredient) if ingredient else []
+        if new == old:
+            if new:
+                self.by_sku[sku] = new
+            return
+        for entry in old:
+            index = bisect.bisect_left(self.dates, entry)
+            if index < len(self.dates) and self.dates[index] == entry:
+                del self.dates[index]
+        for entry in new:
+            bisect.insort(self.dates, entry)
+            if entry not in old:
+                for instant in self._instants(entry):
+                    if instant[0] >= self.swept:
+                        heapq.heappush(self.heap, instant)
+        if new:
+            self.by_sku[sku] = new
+        if len(self.heap) > 2 * len(self.dates) + 1000:
+            self._build_heap()
+
+    """
+    Function to get the first upcoming instant, None when nothing is scheduled.
+    """
+    def next_instant(self):
+        return self.heap[0][0] if self.heap else None
+
+    """
+    Function to take the SKUs of every instant that has passed, so they can be re-checked.
+    An instant equal to now is kept: the state only changes once it is strictly passed.
+    """
+    def due(self, now: datetime):
+        skus = set()
+        while self.heap and self.heap[0][0] < now:
+            skus.add(heapq.heappop(self.heap)[1])
+        self.swept = now
+        return {sku for sku in skus if sku in self.by_sku}
+
+    """
+    Function to get the SKUs of the ingredients whose expiry_date (earliest lot) is before now.
+    """
+    def expired(self, now: datetime):
+        end = bisect.bisect_left(self.dates, now, key=itemgetter(0))
+        return list(dict.fromkeys(sku for _, sku, _ in self.dates[:end]))
+
+    """
+    Function to get the SKUs of the ingredients with a lot expiring between now and now + days, soonest first.
+    """
+    def expiring(self, now: datetime, days: float):
+        start = bisect.bisect_left(self.dates, now, key=itemgetter(0))
+        end = bisect.bisect_right(self.dates, now + timedelta(days=days), key=itemgetter(0))
+        return list(dict.fromkeys(sku for _, sku, is_lot in self.dates[start:end] if is_lot))
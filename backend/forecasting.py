@@ -0,0 +1,105 @@
+import numpy as np
+from itertools import chain
+from statistics import NormalDist
+
+
+"""
+Demand forecasting and reorder points for every ingredient at once.
+The daily usage of all the ingredients is loaded into one 2-D array (one row per ingredient, one column per day)
+and every statistic is computed with NumPy over the whole array, so there is no Python loop per ingredient.
+"""
+
+
+"""
+Function to build the usage array from the daily usage history.
+It takes the ingredient names (one row each, in that order), the history as returned by get_daily_usage_db
+(one entry per ingredient: { "_id": name, "days": [day offsets], "values": [amounts] }) and the number of days,
+and returns an array of shape (len(names), days) with the amount used per ingredient per day (0 when nothing was used).
+"""
+def usage_matrix(names: list, history: list, days: int):
+    rows = {name: row for row, name in enumerate(names)}
+    usage = np.zeros((len(names), days))
+    history = [entry for entry in history if entry["_id"] in rows]
+    if history:
+        lengths = np.fromiter((len(entry["days"]) for entry in history), dtype=np.int64, count=len(history))
+        row_index = np.repeat(np.fromiter((rows[entry["_id"]] for entry in history), dtype=np.int64, count=len(history)), lengths)
+        day_index = np.fromiter(chain.from_iterable(entry["days"] for entry in history), dtype=np.int64, count=int(lengths.sum()))
+        values = np.fromiter(chain.from_iterable(entry["values"] for entry in history), dtype=np.float64, count=int(lengths.sum()))
+        in_range = (day_index >= 0) & (day_index < days)
+        np.add.at(usage, (row_index[in_range], day_index[in_range]), values[in_range])
+    return usage
+
+
+"""
+Function to compute the simple exponential smoothing level of every row.
+The level after the last day is a weighted sum of the days, with weight alpha * (1 - alpha)^age for each day
+and (1 - alpha)^(days - 1) for the first one, so the whole array is smoothed with one matrix-vector product.
+"""
+def exponential_smoothing(usage: np.ndarray, alpha: float):
+    days = usage.shape[1]
+    ages = np.arange(days - 1, -1, -1)
+    weights = alpha * (1 - alpha) ** ages
+    weights[0] = (1 - alpha) ** (days - 1)
+    return usage @ weights
+
+
+"""
+Function to forecast the demand of every ingredient and compute its reorder point.
+- usage: the (ingredients, days) array from usage_matrix
+- stock: the current stock of every ingredient, in the same order
+- window: number of days of the moving average
+- alpha: smoothing factor of the exponential smoothing, higher reacts faster to changes
+- lead_time: days between placing an order and receiving it
+- service_level: probability of not running out before the delivery arrives, used for the safety stock
+Returns a dictionary of arrays (one value per ingredient):
+- moving_average, forecast: average daily usage over the window and smoothed daily demand
+- days_of_cover: days until the stock runs out at the forecast demand (inf when nothing is used)
+- safety_stock, reorder_point: reorder when the stock falls to the demand during the lead time plus the safety stock
+- needs_reorder, suggested_order: whether to reorder now and how much to cover the lead time and the window after it
+"""
+def forecast_demand(usage: np.ndarray, stock: np.ndarray, window: int = 7, alpha: float = 0.3, lead_time: float = 2, service_level: float = 0.95):
+    window = max(1, min(window, usage.shape[1]))
+    moving_average = usage[:, -window:].mean(axis=1)
+    forecast = exponential_smoothing(usage, alpha) if usage.shape[1] else np.zeros(len(stock))
+    deviation = usage.std(axis=1) if usage.shape[1] else np.zeros(len(stock))
+    safety_stock = NormalDist().inv_cdf(service_level) * deviation * np.sqrt(lead_time)
+    reorder_point = forecast * lead_time + safety_stock
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_of_cover = np.where(forecast > 0, stock / forecast, np.inf)
+    return {
+        "moving_average": moving_average,
+        "forecast": forecast,
+        "days_of_cover": days_of_cover,
+        "safety_stock": safety_stock,
+        "reorder_point": reorder_point,
+        "needs_reorder": stock <= reorder_point,
+        "suggested_order": np.maximum(0, forecast * (lead_time + window) + safety_stock - stock)
+    }
+
+
+"""
+Function to forecast every ingredient from the ingredient documents and their daily usage history (see usage_matrix).
+It returns one dictionary per ingredient, ready to be sent as JSON (infinite days of cover become None).
+"""
+def forecast_ingredients(ingredients: list, history: list, days: int, **options):
+    names = [ingredient["name"] for ingredient in ingredients]
+    stock = np.fromiter((ingredient.get("stock", 0) for ingredient in ingredients), dtype=np.float64, count=len(ingredients))
+    result = forecast_demand(usage_matrix(names, history, days), stock, **options)
+
+    rounded = {key: np.round(values, 2).tolist() for key, values in result.items() if key != "needs_reorder"}
+    needs_reorder = result["needs_reorder"].tolist()
+    return [
+        {
+            "sku": ingredient.get("sku", ingredient["_id"]),
+            "name": ingredient["name"],
+            "stock": ingredient.get("stock", 0),
+            "average_daily_usage": rounded["moving_average"][i],
+            "forecast_daily_usage": rounded["forecast"][i],
+            "days_of_cover": rounded["days_of_cover"][i] if np.isfinite(rounded["days_of_cover"][i]) else None,
+            "safety_stock": rounded["safety_stock"][i],
+            "reorder_point": rounded["reorder_point"][i],
+            "needs_reorder": needs_reorder[i],
+            "suggested_order": rounded["suggested_order"][i]
+        }
+        for i, ingredient in enumerate(ingredients)
+    ]
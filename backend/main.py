@@ -1,32 +1,124 @@
-from bson import ObjectId
-from fastapi import FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
 from database import *
 from datetime import datetime, timedelta
-from models import Ingredient, IngredientCreate, ResupplyIngredientCreate, MenuItem
-from typing import List
+from email.utils import formatdate
+from models import Ingredient, IngredientCreate, ResupplyIngredientCreate, MenuItem, OrderTicket
+from typing import Annotated, List, Optional, Literal
+from serialization import MongoJSONResponse, dumps
+from metrics import measure_request, render_metrics
+from bulk_io import CSV_COLUMNS, csv_line
+from compression import CompressionMiddleware
 
 
 """
-Function to convert ObjectId to string
-This is necessary for JSON serialization
+Query parameter of the restaurant location an endpoint works on, DEFAULT_LOCATION when it is not given (see database.py)
 """
-def convert_object_ids(data):
-    if isinstance(data, list):
-        return [convert_object_ids(item) for item in data]
-    elif isinstance(data, dict):
-        return {key: convert_object_ids(value) for key, value in data.items()}
-    elif isinstance(data, ObjectId):
-        return str(data)
-    else:
-        return data
+Location = Annotated[str, Query(pattern=LOCATION_PATTERN)]
+
+
+"""
+Function to write documents as newline delimited JSON (one document per line)
+It is used to stream list endpoints without building the whole response in memory
+"""
+async def ndjson_lines(documents):
+    async for document in documents:
+        yield dumps(document) + b"\n"
+
+
+"""
+Function to write documents as CSV lines with the given columns, after a header line unless header is False
+"""
+async def csv_lines(documents, columns, header=True):
+    if header:
+        yield ",".join(columns).encode() + b"\n"
+    async for document in documents:
+        yield csv_line(document, columns).encode()
+
+
+"""
+Helper to check an If-None-Match header against the ETag of a response, with the weak comparison HTTP asks for.
+"""
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+"""
+Function to answer a list endpoint with the documents of a location
+- stream=true streams every document as NDJSON straight from the database cursor
+- after, limit or fields return one page: { "items": [...], "next": "<_id to pass as after, or null on the last page>" }
+- otherwise the whole list is returned, with an ETag and a Last-Modified header taken from the version of the cache of the collection
+  at the location (see CollectionCache.get_version), the same on every worker. A client sending that ETag back in If-None-Match
+  gets a 304 Not Modified until something is written, without the list being read or serialized.
+  While the location has no version (a write of this worker has not come back through the change stream yet) the list is sent
+  without validators. Cache-Control: no-cache makes browsers revalidate every time.
+  Pages and streams are read from the secondaries, which may lag behind the change stream, so they are not validated.
+"""
+async def list_response(request, collection, cache, get_all, after, limit, fields, stream, location):
+    if stream:
+        return StreamingResponse(ndjson_lines(stream_collection_db(collection, fields, location=location)), media_type="application/x-ndjson")
+    if after or limit or fields:
+        limit = limit or 100
+        page = await get_page_db(collection, after, limit, fields, location)
+        return MongoJSONResponse({"items": page, "next": page[-1]["_id"] if len(page) == min(limit, MAX_PAGE_SIZE) else None})
+    version = cache.get_version(location)
+    if version is None:
+        return MongoJSONResponse(await get_all(location), headers={"Cache-Control": "no-cache"})
+    version, modified = version
+    headers = {"ETag": f'W/"{location}-{version}"', "Last-Modified": formatdate(modified, usegmt=True), "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return MongoJSONResponse(await get_all(location), headers=headers)
+
+
+"""
+Seconds between two keep-alive comments on an idle Server-Sent Events stream, so proxies do not close it
+"""
+SSE_KEEP_ALIVE_SECONDS = 15
+
+
+"""
+Function to write the events of a Broadcaster queue as Server-Sent Events
+It sends the snapshot first, then every published event, until the client disconnects or falls too far behind
+"""
+async def server_sent_events(broadcaster, queue, snapshot):
+    try:
+        yield b"event: snapshot\ndata: " + dumps(snapshot) + b"\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), SSE_KEEP_ALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            if message is None:
+                return
+            event, data = message
+            yield f"event: {event}\ndata: ".encode() + dumps(data) + b"\n\n"
+    finally:
+        broadcaster.unsubscribe(queue)
+
+
+"""
+Lifecycle of the app: connect to the database (seeding it only when needed) on startup,
+stop the background tasks and close the connection on shutdown. See startup_db_client and shutdown_db_client in database.py
+"""
+@asynccontextmanager
+async def lifespan(app):
+    await startup_db_client()
+    yield
+    await shutdown_db_client()
 
 
 """
 FastAPI app setup
 """
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 origins = ['http://localhost:3000', 'http://localhost:8000']
 app.add_middleware(
     CORSMiddleware,
@@ -38,20 +130,48 @@ app.add_middleware(
 
 
 """
-Trigger the database client to start and shutdown
-This is necessary to connect to the database and insert the data from the data.json file
+Compress the responses of at least COMPRESSION_MIN_SIZE bytes (1024 by default) with brotli or gzip, see compression.py
 """
-@app.on_event("startup")
-async def startup():
-    await startup_db_client()
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.environ.get("COMPRESSION_MIN_SIZE", 1024)))
 
 
 """
-Shutdown the database client and close the connection
+Record the latency and the number of MongoDB round trips of every request for the /metrics endpoint
 """
-@app.on_event("shutdown")
-async def shutdown():
-    await shutdown_db_client()
+@app.middleware("http")
+async def metrics_middleware(request, call_next):
+    return await measure_request(request, call_next)
+
+
+"""
+Endpoint for the liveness probe, the process is up and serving requests
+"""
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+"""
+Endpoint for the readiness probe
+Returns 200 once the database answered and the schema is up to date, with "warm" telling whether the caches are loaded yet,
+and 503 before that (e.g. while the database cannot be reached), so a load balancer only sends traffic to ready workers
+"""
+@app.get("/ready")
+async def ready():
+    status = {"ready": readiness["database"] and readiness["schema"], "warm": readiness["caches"], **readiness}
+    return MongoJSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+"""
+Endpoint to get the restaurant locations, the ones with ingredients or menu items and the default one
+Every other endpoint takes a "location" query parameter (the default location when it is not given) and only sees the data of that location
+"""
+@app.get("/locations")
+async def locations():
+    try:
+        return {"default": DEFAULT_LOCATION, "locations": await get_locations_db()}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get locations: {e}")
 
 
 """
@@ -69,22 +189,20 @@ This endpoint expects a JSON payload with the following structure:
 }
 """
 @app.post("/add-ingredient")
-async def add_ingredient(ingredient: IngredientCreate):
+async def add_ingredient(ingredient: IngredientCreate, location: Location = DEFAULT_LOCATION):
     try:
-        if await get_ingredient_db(ingredient.sku):
+        if await get_ingredient_db(ingredient.sku, location):
             raise HTTPException(status_code=400, detail="Ingredient already exists")
 
-        ingredientCreate = Ingredient(
-            _id=ingredient.sku,
-            name=ingredient.name,
-            stock=ingredient.stock,
-            price=ingredient.price,
-            expiry_date=datetime.strptime(ingredient.expiry_date, "%Y-%m-%d"),
-            monthIncrease="0%",
-            yearIncrease="0%",
-            orders=1,
-            stock_measurement=ingredient.customUnit if ingredient.customUnit else ingredient.unit,
-            warningStockAmount=ingredient.threshold
+        ingredientCreate = new_ingredient_document(
+            ingredient.sku,
+            ingredient.name,
+            ingredient.stock,
+            ingredient.price,
+            ingredient.expiry_date,
+            ingredient.customUnit if ingredient.customUnit else ingredient.unit,
+            ingredient.threshold,
+            location
         )
         await create_ingredient_db(ingredientCreate)
     except Exception as e:
@@ -96,10 +214,10 @@ Endpoint to get an ingredient by SKU
 This endpoint expects a query parameter "sku" with the SKU of the ingredient
 """
 @app.get("/get-ingredient")
-async def get_ingredient(sku: str):
+async def get_ingredient(sku: str, location: Location = DEFAULT_LOCATION):
     try:
-        ingredient = await get_ingredient_db(sku)
-        return ingredient
+        ingredient = await get_ingredient_db(sku, location)
+        return MongoJSONResponse(ingredient)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to get ingredient: {e}")
 
@@ -107,12 +225,17 @@ async def get_ingredient(sku: str):
 """
 Endpoint to get all ingredients
 This endpoint returns all ingredients in the database by calling the get_all_ingredients_db function in database.py
+Optional query parameters:
+- after: _id of the last ingredient of the previous page
+- limit: page size (max 1000)
+- fields: comma separated fields to return, e.g. "sku,name,stock"
+- stream: true to stream the ingredients as NDJSON
+The whole list answers If-None-Match with 304 Not Modified when no ingredient of the location was written since (see list_response)
 """
 @app.get("/get-all-ingredients")
-async def get_all_ingredients():
+async def get_all_ingredients(request: Request, after: Optional[str] = None, limit: Optional[int] = None, fields: Optional[str] = None, stream: bool = False, location: Location = DEFAULT_LOCATION):
     try:
-        ingredients = await get_all_ingredients_db()
-        return ingredients
+        return await list_response(request, ingredients_read_collection, ingredients_cache, get_all_ingredients_db, after, limit, fields, stream, location)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to get all ingredients: {e}")
 
@@ -123,9 +246,9 @@ This endpoint expects a query parameter "sku" with the SKU of the ingredient
 Calls the delete_ingredient_db function in database.py
 """
 @app.delete("/delete-ingredient")
-async def delete_ingredient(sku: str):
+async def delete_ingredient(sku: str, location: Location = DEFAULT_LOCATION):
     try:
-        await delete_ingredient_db(sku)
+        await delete_ingredient_db(sku, location)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to delete ingredient: {e}")
 
@@ -141,13 +264,16 @@ This endpoint expects a JSON payload with the following structure:
     "expiry_date": "YYYY-MM-DD",
     "customUnit": "string",
     "threshold": 0,
-    "unit": "string"
+    "unit": "string",
+    "version": 0 (optional, the update is rejected with a 409 if the ingredient changed since this version was loaded)
 }
 """
 @app.put("/update-ingredient")
-async def update_ingredient(ingredient: IngredientCreate):
+async def update_ingredient(ingredient: IngredientCreate, location: Location = DEFAULT_LOCATION):
     try:
-        await update_ingredient_db(ingredient.sku, ingredient)
+        await update_ingredient_db(ingredient.sku, ingredient, location)
+    except VersionConflictError as e:
+        raise HTTPException(status_code=409, detail=f"Failed to update ingredient: {e}")
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to update ingredient: {e}")
 
@@ -178,10 +304,10 @@ This endpoint expects a JSON payload with the following structure:
 }
 """
 @app.post("/add-menu-item")
-async def add_menu_item(name: str, ingredients: List[Ingredient], price: float, category: str, description: str, season: str):
+async def add_menu_item(name: str, ingredients: List[Ingredient], price: float, category: str, description: str, season: str, location: Location = DEFAULT_LOCATION):
     try:
         menu_item = MenuItem(name=name, ingredients=ingredients, price=price, category=category, description=description, season=season)
-        await create_menu_item_db(menu_item)
+        await create_menu_item_db(menu_item, location)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to create menu item: {e}")
 
@@ -192,10 +318,10 @@ This endpoint expects a query parameter "id" with the ID of the menu item
 Calls the get_menu_item_db function in database.py
 """
 @app.get("/get-menu-item")
-async def get_menu_item(id: str):
+async def get_menu_item(id: str, location: Location = DEFAULT_LOCATION):
     try:
-        menu_item = await get_menu_item_db(id)
-        return menu_item
+        menu_item = await get_menu_item_db(id, location)
+        return MongoJSONResponse(menu_item)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to get menu item: {e}")
 
@@ -204,12 +330,12 @@ async def get_menu_item(id: str):
 Endpoint to get all menu items
 This endpoint returns all menu items in the database by calling the get_all_menu_items_db function in database.py
 This endpoint is used to display all menu items in the frontend
+Accepts the same after, limit, fields and stream query parameters as /get-all-ingredients
 """
 @app.get("/get-all-menu-items")
-async def get_all_menu_items():
+async def get_all_menu_items(request: Request, after: Optional[str] = None, limit: Optional[int] = None, fields: Optional[str] = None, stream: bool = False, location: Location = DEFAULT_LOCATION):
     try:
-        menu_items = await menu_items_collection.find().to_list(1000)
-        return convert_object_ids(menu_items)
+        return await list_response(request, menu_items_read_collection, menu_items_cache, get_all_menu_items_db, after, limit, fields, stream, location)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to get menu items: {e}")
 
@@ -218,13 +344,16 @@ async def get_all_menu_items():
 Endpoint to delete a menu item by ID
 This endpoint expects a query parameter "id" with the ID of the menu item
 Calls the delete_menu_item_db function in database.py
+Returns 404 if the location has no menu item with that ID
 """
 @app.delete("/delete-menu-item")
-async def delete_menu_item(id: str):
+async def delete_menu_item(id: str, location: Location = DEFAULT_LOCATION):
     try:
-        await delete_menu_item_db(id)
+        deleted = await delete_menu_item_db(id, location)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to delete menu item: {e}")
+    if not deleted:
+        raise HTTPException(status_code=404, detail=f"Menu item {id} not found")
 
 
 """
@@ -253,10 +382,10 @@ This endpoint expects a JSON payload with the following structure:
 }
 """
 @app.put("/update-menu-item")
-async def update_menu_item(id: str, name: str, ingredients: List[Ingredient], price: float, category: str, description: str, season: str):
+async def update_menu_item(id: str, name: str, ingredients: List[Ingredient], price: float, category: str, description: str, season: str, location: Location = DEFAULT_LOCATION):
     try:
         menu_item = MenuItem(id=id, name=name, ingredients=ingredients, price=price, category=category, description=description, season=season)
-        await update_menu_item_db(id, menu_item)
+        await update_menu_item_db(id, menu_item, location)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to update menu item: {e}")
 
@@ -267,30 +396,24 @@ This endpoint returns all expired ingredients in the database by calling the get
 This endpoint is used to display all expired ingredients in the frontend
 """
 @app.get("/get-all-expired-ingredients")
-async def get_all_expired_ingredients():
+async def get_all_expired_ingredients(location: Location = DEFAULT_LOCATION):
     try:
-        ingredients = await get_all_expired_ingredients_db()
-        return ingredients
+        ingredients = await get_all_expired_ingredients_db(location)
+        return MongoJSONResponse(ingredients)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to get all expired ingredients: {e}")
 
 
 """
-Endpoint to get all low stock ingredients
-This endpoint returns all low stock ingredients in the database by calling the get_low_stock_ingredients_db function in database.py
-This endpoint is used to display all low stock ingredients in the frontend
+Endpoint to get all expiring ingredients
+This endpoint returns all ingredients expiring in the next days (query parameter "days", 90 by default) by calling the get_expiring_ingredients_db function in database.py
+This endpoint is used to display all expiring ingredients in the frontend
 """
 @app.get("/get-expiring-ingredients")
-async def get_expiring_ingredients():
+async def get_expiring_ingredients(days: float = 90, location: Location = DEFAULT_LOCATION):
     try:
-        now = datetime.now()
-        three_months_later = now + timedelta(days=90)  # set to 90 for testing
-        ingredients = []
-        async for ingredient in ingredients_collection.find({
-            "expiry_date": {"$gt": now, "$lte": three_months_later}
-        }):
-            ingredients.append(ingredient)
-        return ingredients
+        ingredients = await get_expiring_ingredients_db(days=days, location=location)
+        return MongoJSONResponse(ingredients)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to get expiring ingredients: {e}")
 
@@ -301,56 +424,70 @@ This endpoint returns all low stock ingredients in the database by calling the g
 This endpoint is used to display all low stock ingredients in the frontend
 """
 @app.get("/get-low-stock-ingredients")
-async def get_low_stock_ingredients():
+async def get_low_stock_ingredients(location: Location = DEFAULT_LOCATION):
     try:
-        ingredients = await get_low_stock_ingredients_db()
-        return ingredients
+        ingredients = await get_low_stock_ingredients_db(location)
+        return MongoJSONResponse(ingredients)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to get low stock ingredients: {e}")
 
 
 """
-Endpoint to get all ingredients from a specific supplier
-This endpoint returns all ingredients from a specific supplier in the database by calling the get_ingredients_by_supplier_db function in database.py
+Endpoint to get the dashboard summary in one request
+Calls the get_dashboard_summary_db function in database.py, which computes it with one aggregation
+Query parameters:
+- days: window of the expiring list, 3 by default
+- limit: largest number of ingredients per list, 50 by default (max 1000)
+Returns { "expired": [...], "expiring": [...], "low_stock": [...], "counts": { "expired", "expiring", "low_stock", "at_risk_value" } }
+every ingredient with only its _id, name, stock, stock_measurement, warningStockAmount and expiry_date
+"""
+@app.get("/dashboard-summary")
+async def dashboard_summary(days: float = 3, limit: int = 50, location: Location = DEFAULT_LOCATION):
+    try:
+        if days < 0 or not 1 <= limit <= 1000:
+            raise ValueError("days must be positive and limit between 1 and 1000")
+        return MongoJSONResponse(await get_dashboard_summary_db(days, limit, location))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get the dashboard summary: {e}")
+
+
+"""
+Endpoint to search the ingredients and menu items of a location
+Answered from the in-memory search index kept up to date by every write, see search.py and get_search_index_db in database.py
+Query parameters:
+- q: words to look for in the SKU, name and category (menu items), prefixes and small typos match too
+- kind: "ingredient" or "menu_item", both by default
+- limit: largest number of results, 10 by default (max 100)
+Returns { "query", "results": [{ "kind", "_id", "score", ... }] } best match first
+"""
+@app.get("/search")
+async def search(q: str = Query(..., min_length=1, max_length=200), kind: Optional[Literal["ingredient", "menu_item"]] = None, limit: int = 10, location: Location = DEFAULT_LOCATION):
+    try:
+        if not 1 <= limit <= 100:
+            raise ValueError("limit must be between 1 and 100")
+        index = await get_search_index_db(location)
+        return MongoJSONResponse({"query": q, "results": index.search(q, limit, kind)})
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to search: {e}")
+
+
+"""
+Endpoint to add a supplier delivery to the inventory
+New ingredients are created and existing ones get their stock increased, all in one transaction,
+by calling the resupply_ingredients_db function in database.py
+Returns the status of every line: { "status": "success", "results": [{ "id": 1, "sku": "APL001", "status": "updated" }, ...] }
+If a line refers to an unknown ingredient nothing is applied and a 400 is returned
 """
 @app.post("/resupply-ingredient-add")
-async def resupply_ingredient_add(ingredient_list: List[ResupplyIngredientCreate]):
+async def resupply_ingredient_add(ingredient_list: List[ResupplyIngredientCreate], location: Location = DEFAULT_LOCATION):
     try:
-        for resupply in ingredient_list:
-            if resupply.isNewIngredient and not await get_ingredient_db(resupply.sku):
-                ingredientCreate = Ingredient(
-                    _id=resupply.sku,
-                    name=resupply.name,
-                    stock=resupply.stock,
-                    price=resupply.price,
-                    expiry_date=datetime.strptime(resupply.expiryDate, "%Y-%m-%d"),
-                    monthIncrease="0%",
-                    yearIncrease="0%",
-                    orders=1,
-                    stock_measurement=resupply.customUnit if resupply.customUnit else resupply.unit,
-                    warningStockAmount=resupply.threshold
-                )
-                await create_ingredient_db(ingredientCreate)
-            else:
-                ingredient = await get_ingredient_db(resupply.sku)
-                if not ingredient:
-                    raise HTTPException(status_code=400, detail="Ingredient not found")
-                updated_stock = ingredient["stock"] + resupply.stock
-                await update_ingredient_db(
-                    resupply.sku,
-                    IngredientCreate(
-                        sku=ingredient["_id"],
-                        name=ingredient["name"],
-                        stock=updated_stock,
-                        price=resupply.price,
-                        expiry_date=resupply.expiryDate,
-                        customUnit=resupply.customUnit,
-                        unit=resupply.unit,
-                        threshold=ingredient["warningStockAmount"]
-                    )
-                )
+        results = await resupply_ingredients_db(ingredient_list, location)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to resupply ingredient: {e}")
+    missing = [result["sku"] for result in results if result["status"] == "not_found"]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Failed to resupply ingredient: Ingredient not found: {', '.join(missing)}")
+    return {"status": "success", "results": results}
 
 
 """
@@ -361,48 +498,254 @@ Expects a payload with the following structure:
     "recipe_id_2": { "name": "Pasta", "count": 2 },
     ...
 }
-For each ordered recipe, this endpoint retrieves the recipe details from the menu_items_collection,
-multiplies each ingredient's "amount" (units needed per order) by the order count, then subtracts that
-total from the corresponding ingredient's stock in the inventory.
+The ingredient usage (each ingredient's "amount" multiplied by the order count, converted to its stock unit) is computed
+in memory from the compiled recipe graph, and every stock decrement is sent to the database in one bulk write
+by calling the submit_orders_db function in database.py.
+Every line item is also recorded in the order_events collection.
+With an Idempotency-Key header the ticket goes through submit_order_batch_db, so sending it again is not applied twice
+("duplicate": true and the ticket_id of the first submission are returned instead)
 """
 @app.post("/submit-orders")
-async def submit_orders(order_counts: dict):
+async def submit_orders(order_counts: dict, idempotency_key: Optional[str] = Header(None, max_length=200), location: Location = DEFAULT_LOCATION):
     try:
-        total_usage = {}
-        # For each ordered recipe, calculate total ingredient usage
-        for recipe_id, order in order_counts.items():
-            count = order.get("count", 0)
-            if count <= 0:
-                continue
-            # Retrieve the recipe details from the menu_items_collection
-            recipe = await get_menu_item_db(recipe_id)
-            if not recipe:
-                continue
-            # Assume recipe["ingredients"] is a list of dicts with at least "name" and "amount" keys
-            for ingredient in recipe.get("ingredients", []):
-                ing_name = ingredient.get("name")
-                usage_per_order = ingredient.get("amount", 0)
-                total = usage_per_order * count
-                if ing_name in total_usage:
-                    total_usage[ing_name] += total
-                else:
-                    total_usage[ing_name] = total
-
-        # Update each ingredient's inventory stock
-        for ing_name, used_amount in total_usage.items():
-            inventory_ing = await ingredients_collection.find_one({"name": ing_name})
-            if inventory_ing:
-                new_stock = inventory_ing["stock"] - used_amount
-                if new_stock < 0:
-                    new_stock = 0
-                await ingredients_collection.update_one(
-                    {"_id": inventory_ing["_id"]},
-                    {"$set": {"stock": new_stock}}
-                )
-        return {"status": "success", "updated": total_usage}
+        if idempotency_key:
+            results, total_usage = await submit_order_batch_db([OrderTicket(idempotency_key=idempotency_key, orders=order_counts)], location)
+            return MongoJSONResponse({
+                "status": "success", "ticket_id": results[0]["ticket_id"], "updated": total_usage, "duplicate": results[0]["status"] == "duplicate"
+            })
+        ticket_id, total_usage = await submit_orders_db(order_counts, location)
+        return {"status": "success", "ticket_id": str(ticket_id), "updated": total_usage}
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to submit orders: {e}")
 
+
+"""
+Endpoint to submit a batch of order tickets, e.g. the tickets a POS queued while it was offline, or a retry of a batch
+Expects a list of tickets, each with an idempotency key unique to the ticket:
+[
+    { "idempotency_key": "till-3-0042", "orders": { "recipe_id_1": { "name": "Bruschetta", "count": 4 } }, "created_at": "2025-03-01T19:42:00" },
+    ...
+]
+The tickets already submitted (same key) are skipped, the usage of the others is applied in one transaction
+by calling the submit_order_batch_db function in database.py (at most MAX_TICKETS_PER_BATCH tickets)
+Returns { "status": "success", "results": [{ "idempotency_key", "status": "applied" | "duplicate", "ticket_id" }, ...], "updated": usage per ingredient name }
+"""
+@app.post("/submit-order-batch")
+async def submit_order_batch(tickets: List[OrderTicket], location: Location = DEFAULT_LOCATION):
+    try:
+        if len(tickets) > MAX_TICKETS_PER_BATCH:
+            raise ValueError(f"At most {MAX_TICKETS_PER_BATCH} tickets per batch")
+        results, total_usage = await submit_order_batch_db(tickets, location)
+        return MongoJSONResponse({"status": "success", "results": results, "updated": total_usage})
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to submit order batch: {e}")
+
+
+"""
+Endpoint to get how many more of every menu item can be made with the current stock, and the cost of its ingredients
+Calls the get_menu_capacity_db function in database.py, which uses the compiled recipe graph
+Returns one entry per menu item with its capacity, cost, the SKU that runs out first and the recipe ingredients that match no ingredient
+"""
+@app.get("/menu-capacity")
+async def menu_capacity(location: Location = DEFAULT_LOCATION):
+    try:
+        return MongoJSONResponse(await get_menu_capacity_db(location))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get menu capacity: {e}")
+
+
+"""
+Endpoint to get which menu items can currently be made
+Returns one entry per menu item with the number of portions the current stock allows, whether at least one can be made
+and the SKU of the ingredient that runs out first. It is answered from the availability kept up to date by get_menu_availability_db
+"""
+@app.get("/menu-availability")
+async def menu_availability(location: Location = DEFAULT_LOCATION):
+    try:
+        availability = await get_menu_availability_db(location)
+        return MongoJSONResponse(availability.snapshot())
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get menu availability: {e}")
+
+
+"""
+Endpoint to follow the menu availability with Server-Sent Events
+The first event is a "snapshot" with every menu item (as /menu-availability), then every "update" event lists only the menu items
+whose portions or limiting ingredient changed. A new "snapshot" is sent when the menu changes.
+"""
+@app.get("/menu-availability/stream")
+async def menu_availability_stream(location: Location = DEFAULT_LOCATION):
+    broadcaster = location_broadcaster(availability_broadcasters, "menu_availability", location)
+    try:
+        queue = broadcaster.subscribe()
+        availability = await get_menu_availability_db(location)
+    except Exception as e:
+        broadcaster.unsubscribe(queue)
+        raise HTTPException(status_code=400, detail=f"Failed to get menu availability: {e}")
+    return StreamingResponse(server_sent_events(broadcaster, queue, availability.snapshot()), media_type="text/event-stream")
+
+
+"""
+Endpoint to get the active low stock and expiry alerts
+Returns one entry per ingredient that is low on stock, expired or expiring within EXPIRING_ALERT_DAYS, see get_inventory_alerts_db
+"""
+@app.get("/inventory-alerts")
+async def inventory_alerts_list(location: Location = DEFAULT_LOCATION):
+    try:
+        alerts = await get_inventory_alerts_db(location)
+        return MongoJSONResponse(alerts.snapshot())
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get inventory alerts: {e}")
+
+
+"""
+Endpoint to follow the low stock and expiry alerts with Server-Sent Events
+The first event is a "snapshot" with every active alert (as /inventory-alerts), then every "alert" event lists the ingredients
+whose alert changed as stock is used, delivered or edited. An entry with low_stock false and expiry null means its alert was cleared.
+"""
+@app.get("/inventory-alerts/stream")
+async def inventory_alerts_stream(location: Location = DEFAULT_LOCATION):
+    broadcaster = location_broadcaster(alerts_broadcasters, "inventory_alerts", location)
+    try:
+        queue = broadcaster.subscribe()
+        alerts = await get_inventory_alerts_db(location)
+    except Exception as e:
+        broadcaster.unsubscribe(queue)
+        raise HTTPException(status_code=400, detail=f"Failed to get inventory alerts: {e}")
+    return StreamingResponse(server_sent_events(broadcaster, queue, alerts.snapshot()), media_type="text/event-stream")
+
+
+"""
+Endpoint to import ingredients or menu items in bulk
+The request body is a CSV, NDJSON or JSON array file (query parameter "format"), read and written as it arrives
+in bulk upserts of batch_size records, so it can be as large as needed. Ingredients are matched on their SKU and menu items on their id.
+Query parameter "offset" skips the first records of the body to resume an interrupted import.
+Returns the number of records processed, inserted and updated, the offset to continue from and the records that were rejected
+The bulk_io.py command line client sends a file in chunks of records and reports the progress
+"""
+@app.post("/import/{kind}")
+async def import_records(request: Request, kind: Literal["ingredients", "menu-items"], format: Literal["ndjson", "csv", "json"] = "ndjson", offset: int = 0, batch_size: int = 1000, location: Location = DEFAULT_LOCATION):
+    try:
+        if not 1 <= batch_size <= 10000:
+            raise ValueError("batch_size must be between 1 and 10000")
+        return await import_records_db(kind, request.stream(), format, offset, batch_size, location)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to import {kind}: {e}")
+
+
+"""
+Endpoint to export all the ingredients or menu items as NDJSON or CSV (query parameter "format")
+The documents are streamed from the database cursor in _id order. Query parameter "after" resumes after an _id
+(the CSV header is then left out so the lines can be appended to the first part)
+"""
+@app.get("/export/{kind}")
+async def export_records(kind: Literal["ingredients", "menu-items"], format: Literal["ndjson", "csv"] = "ndjson", after: Optional[str] = None, location: Location = DEFAULT_LOCATION):
+    collection = ingredients_read_collection if kind == "ingredients" else menu_items_read_collection
+    documents = stream_collection_db(collection, after=after, location=location)
+    if format == "csv":
+        return StreamingResponse(csv_lines(documents, CSV_COLUMNS[kind], header=not after), media_type="text/csv")
+    return StreamingResponse(ndjson_lines(documents), media_type="application/x-ndjson")
+
+
+"""
+Endpoint to get the cache statistics
+Returns the size, hit and miss counters of the ingredients and menu items caches
+"""
+@app.get("/cache-stats")
+async def cache_stats():
+    return {
+        "ingredients": ingredients_cache.stats(),
+        "menu_items": menu_items_cache.stats()
+    }
+
+
+"""
+Endpoint to get a sales or usage trend line
+Answers from the pre-aggregated rollups by calling the get_rollups_db function in database.py
+Query parameters:
+- kind: "dish" (number of dishes sold per menu item) or "ingredient" (amount used per ingredient name)
+- granularity: "hour", "day" or "month"
+- start, end: "YYYY-MM-DD", the last 30 days by default
+- key: a menu item id or an ingredient name, all of them by default
+Returns [{ "location", "kind", "key", "name", "granularity", "bucket", "value" }, ...] sorted by key and date
+"""
+@app.get("/sales-trends")
+async def sales_trends(kind: Literal["dish", "ingredient"] = "dish", granularity: Literal["hour", "day", "month"] = "day", start: Optional[str] = None, end: Optional[str] = None, key: Optional[str] = None, location: Location = DEFAULT_LOCATION):
+    try:
+        end_date = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1) - timedelta(microseconds=1) if end else datetime.now()
+        start_date = datetime.strptime(start, "%Y-%m-%d") if start else end_date - timedelta(days=30)
+        return MongoJSONResponse(await get_rollups_db(kind, granularity, start_date, end_date, key, location))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get sales trends: {e}")
+
+
+"""
+Endpoint to get the best selling dishes (or most used ingredients) of the hour, day or month containing a date
+Query parameters: kind, granularity (as /sales-trends), date ("YYYY-MM-DD", today by default) and limit
+"""
+@app.get("/top-sellers")
+async def top_sellers(kind: Literal["dish", "ingredient"] = "dish", granularity: Literal["hour", "day", "month"] = "month", date: Optional[str] = None, limit: int = 5, location: Location = DEFAULT_LOCATION):
+    try:
+        day = datetime.strptime(date, "%Y-%m-%d") if date else datetime.now()
+        return MongoJSONResponse(await get_top_rollups_db(kind, granularity, day, limit, location))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get top sellers: {e}")
+
+
+"""
+Endpoint to rebuild the sales rollups and ingredient increases from the order events
+Calls the backfill_rollups_db function in database.py, meant to be run during quiet hours
+"""
+@app.post("/backfill-rollups")
+async def backfill_rollups():
+    try:
+        await backfill_rollups_db()
+        return {"status": "success"}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to backfill rollups: {e}")
+
+
+"""
+Endpoint to forecast the demand of every ingredient and tell which ones to reorder
+The daily usage of the last days (from the rollups) is forecast for all the ingredients at once by the forecast_ingredients function in forecasting.py
+Query parameters:
+- days: days of history to use (56 by default)
+- window: days of the moving average (7 by default)
+- alpha: exponential smoothing factor between 0 and 1 (0.3 by default)
+- lead_time: days between ordering and receiving a delivery (2 by default)
+- service_level: probability of not running out before the delivery arrives, between 0 and 1 (0.95 by default)
+Returns one entry per ingredient with its forecast daily usage, days of cover, reorder point and suggested order
+"""
+@app.get("/forecast")
+async def forecast(days: int = 56, window: int = 7, alpha: float = 0.3, lead_time: float = 2, service_level: float = 0.95, location: Location = DEFAULT_LOCATION):
+    try:
+        if days < 1 or window < 1 or not 0 < alpha <= 1 or lead_time < 0 or not 0 < service_level < 1:
+            raise ValueError("days and window must be at least 1, alpha and service_level between 0 and 1, lead_time positive")
+        ingredients = await get_all_ingredients_db(location)
+        history, _ = await get_daily_usage_db(days, location)
+        from forecasting import forecast_ingredients  # imported on first use, NumPy is slow to import
+        forecasts = forecast_ingredients(ingredients, history, days, window=window, alpha=alpha, lead_time=lead_time, service_level=service_level)
+        return MongoJSONResponse(forecasts)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to forecast: {e}")
+
+
+"""
+Endpoint to get the metrics in the Prometheus text format
+Includes the latency and MongoDB round trips per route, the MongoDB commands count and duration per collection and the cache statistics
+"""
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return render_metrics({"ingredients": ingredients_cache.stats(), "menu_items": menu_items_cache.stats()})
+
+
+"""
+Run the API with uvicorn. WEB_CONCURRENCY sets the number of worker processes (1 by default, "auto" for one per CPU core),
+every worker imports the app itself and opens its own connection pool, caches and change streams. PORT is 8000 by default.
+"""
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    workers = os.environ.get("WEB_CONCURRENCY", "1")
+    workers = (os.cpu_count() or 1) if workers == "auto" else int(workers)
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), workers=workers)
@@ -0,0 +1,299 @@
+import threading
+import time
+from contextvars import ContextVar
+from pymongo import monitoring
+
+
+"""
+Histogram metric rendered in the Prometheus text format.
+Observations are grouped by label values. Motor runs the database calls on a thread pool, so updates are protected by a lock.
+"""
+class Histogram:
+    def __init__(self, name: str, description: str, labels: list, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            series = self.series.setdefault(label_values, [0] * len(self.buckets) + [0, 0])
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = format_labels(self.labels, label_values)
+                for bucket, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bucket}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+                lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+"""
+Counter metric rendered in the Prometheus text format.
+"""
+class Counter:
+    def __init__(self, name: str, description: str, labels: list):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}  # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, count in sorted(self.series.items()):
+                lines.append(f"{self.name}{{{format_labels(self.labels, label_values)}}} {count}")
+        return lines
+
+
+"""
+Gauge metric rendered in the Prometheus text format, a value that goes up and down.
+"""
+class Gauge:
+    def __init__(self, name: str, description: str, labels: list):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}  # label values -> value
+        self.lock = threading.Lock()
+
+    def set(self, value: float, *label_values):
+        with self.lock:
+            self.series[label_values] = value
+
+    def inc(self, amount: float, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        with self.lock:
+            for label_values, value in sorted(self.series.items()):
+                lines.append(f"{self.name}{{{format_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+def format_labels(names, values):
+    return ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+request_duration = Histogram(
+    "shelflyfe_http_request_duration_seconds", "Time spent answering HTTP requests.",
+    ["method", "route", "status"], LATENCY_BUCKETS
+)
+request_round_trips = Histogram(
+    "shelflyfe_http_request_mongodb_round_trips", "Number of MongoDB commands sent while answering one HTTP request.",
+    ["method", "route"], (0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+command_duration = Histogram(
+    "shelflyfe_mongodb_command_duration_seconds", "Time spent on MongoDB commands, the _count is the number of commands.",
+    ["collection", "command"], LATENCY_BUCKETS
+)
+command_failures = Counter(
+    "shelflyfe_mongodb_command_failures_total", "Number of MongoDB commands that failed.",
+    ["collection", "command"]
+)
+
+pool_max_size = Gauge(
+    "shelflyfe_mongodb_pool_max_size", "Largest number of connections the pool of a server can open (maxPoolSize).",
+    ["address"]
+)
+pool_connections = Gauge(
+    "shelflyfe_mongodb_pool_connections", "Connections open in the pool of a server.",
+    ["address"]
+)
+pool_checked_out = Gauge(
+    "shelflyfe_mongodb_pool_checked_out", "Connections of the pool in use by an operation. The pool is saturated when it reaches the max size.",
+    ["address"]
+)
+pool_waiting = Gauge(
+    "shelflyfe_mongodb_pool_waiting", "Operations waiting for a connection of the pool.",
+    ["address"]
+)
+pool_checkout_duration = Histogram(
+    "shelflyfe_mongodb_pool_checkout_duration_seconds", "Time spent waiting to check out a connection, including opening it.",
+    ["address"], LATENCY_BUCKETS
+)
+pool_checkout_failures = Counter(
+    "shelflyfe_mongodb_pool_checkout_failures_total", "Number of connection check outs that failed, e.g. timeout when the pool is saturated.",
+    ["address", "reason"]
+)
+
+
+"""
+Number of MongoDB commands sent for the HTTP request being answered.
+The middleware sets a fresh counter for every request. Motor copies the context to the thread that runs the command,
+so the command listener increments the counter of the request that triggered it. Commands sent outside of a request
+(e.g. the change stream watchers) see None and are only counted per collection.
+"""
+current_round_trips = ContextVar("current_round_trips", default=None)
+
+
+"""
+Per request counter of MongoDB commands, see current_round_trips.
+"""
+class RoundTripCounter:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def inc(self):
+        with self.lock:
+            self.count += 1
+
+
+"""
+pymongo command listener recording the duration of every command per collection and command name,
+and counting the commands sent for the current HTTP request.
+It is registered on the Motor client with event_listeners.
+"""
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self.collections = {}  # (connection id, request id) -> collection of the command in flight
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        with self.lock:
+            self.collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+        round_trips = current_round_trips.get()
+        if round_trips is not None:
+            round_trips.inc()
+
+    def succeeded(self, event):
+        command_duration.observe(event.duration_micros / 1e6, self._collection(event), event.command_name)
+
+    def failed(self, event):
+        collection = self._collection(event)
+        command_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+        command_failures.inc(collection, event.command_name)
+
+    def _collection(self, event):
+        with self.lock:
+            return self.collections.pop((event.connection_id, event.request_id), "")
+
+
+"""
+pymongo connection pool listener keeping the pool gauges of every server up to date, to see when the pool is saturated:
+open connections, connections in use, operations waiting for one and how long they waited.
+It is registered on the Motor client with event_listeners, max_pool_size is the maxPoolSize the client was created with.
+"""
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+
+    def pool_created(self, event):
+        pool_max_size.set(self.max_pool_size or float("inf"), address(event))
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        for gauge in (pool_max_size, pool_connections, pool_checked_out, pool_waiting):
+            gauge.set(0, address(event))
+
+    def connection_created(self, event):
+        pool_connections.inc(1, address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pool_connections.inc(-1, address(event))
+
+    def connection_check_out_started(self, event):
+        pool_waiting.inc(1, address(event))
+
+    def connection_check_out_failed(self, event):
+        pool_waiting.inc(-1, address(event))
+        pool_checkout_duration.observe(getattr(event, "duration", 0), address(event))
+        pool_checkout_failures.inc(address(event), event.reason)
+
+    def connection_checked_out(self, event):
+        pool_waiting.inc(-1, address(event))
+        pool_checked_out.inc(1, address(event))
+        pool_checkout_duration.observe(getattr(event, "duration", 0), address(event))
+
+    def connection_checked_in(self, event):
+        pool_checked_out.inc(-1, address(event))
+
+
+def address(event):
+    host, port = event.address
+    return f"{host}:{port}"
+
+
+"""
+Function that measures one HTTP request, used by the FastAPI middleware.
+The route is the path template (e.g. /get-ingredient) so every SKU does not get its own series.
+"""
+async def measure_request(request, call_next):
+    round_trips = RoundTripCounter()
+    token = current_round_trips.set(round_trips)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        route = route.path if route else "unmatched"
+        request_duration.observe(time.perf_counter() - start, request.method, route, status)
+        request_round_trips.observe(round_trips.count, request.method, route)
+        current_round_trips.reset(token)
+
+
+"""
+Function to render the cache statistics (see CollectionCache.stats) as Prometheus metrics.
+"""
+def render_cache_stats(caches: dict):
+    lines = []
+    for name, kind, key in (
+        ("shelflyfe_cache_hits_total", "counter", "hits"),
+        ("shelflyfe_cache_misses_total", "counter", "misses"),
+        ("shelflyfe_cache_size", "gauge", "size"),
+    ):
+        lines += [f"# HELP {name} Cache {key}.", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{cache="{cache}"}} {stats[key]}' for cache, stats in caches.items()]
+    return lines
+
+
+"""
+Function to render every metric in the Prometheus text format.
+"""
+def render_metrics(caches: dict = None):
+    lines = []
+    for metric in (
+        request_duration, request_round_trips, command_duration, command_failures,
+        pool_max_size, pool_connections, pool_checked_out, pool_waiting, pool_checkout_duration, pool_checkout_failures
+    ):
+        lines += metric.render()
+    if caches:
+        lines += render_cache_stats(caches)
+    return "\n".join(lines) + "\n"
@@ -9,24 +9,32 @@ Model classes for the menu items and ingredients.
 These classes are used to define the structure of the data that will be stored in the database.
 """
 
+class Lot(BaseModel):
+    quantity: float
+    expiry_date: datetime
+
+
 class Ingredient(BaseModel):
     sku: str = Field(..., alias="_id")
     name: str
     stock: int
     price: Optional[float] = None
-    expiry_date: datetime
+    expiry_date: datetime #Expiry date of the first lot to expire
+    lots: List[Lot] = [] #One lot per delivery, sorted by expiry date
     monthIncrease: Optional[str] = None
     yearIncrease: Optional[str] = None 
     orders: int
     stock_measurement: str
     warningStockAmount: int
+    version: int = 0
+    location: Optional[str] = None #Restaurant the ingredient is stocked at, the default location when missing
 
     class Config:
         populate_by_name = True
         arbitrary_types_allowed = True
 
     def __str__(self):
-        return f"sku: {self.sku}, name: {self.name}, stock: {self.stock}, price: {self.price}, expiry_date: {self.expiry_date}, monthIncrease: {self.monthIncrease}, yearIncrease: {self.yearIncrease}, orders: {self.orders}, stock_measurement: {self.stock_measurement}, warningStockAmount: {self.warningStockAmount}"
+        return f"sku: {self.sku}, name: {self.name}, stock: {self.stock}, price: {self.price}, expiry_date: {self.expiry_date}, monthIncrease: {self.monthIncrease}, yearIncrease: {self.yearIncrease}, orders: {self.orders}, stock_measurement: {self.stock_measurement}, warningStockAmount: {self.warningStockAmount}, version: {self.version}"
 
 
 class MenuItem(BaseModel):
@@ -38,6 +46,7 @@ class MenuItem(BaseModel):
     description: Optional[str] = None
     season: Optional[str] = None #Fall, Winter, Summer, All
     orders: int = 0
+    location: Optional[str] = None #Restaurant the menu item is served at, the default location when missing
 
     class Config:
         populate_by_name = True
@@ -53,6 +62,7 @@ class IngredientCreate(BaseModel):
     customUnit: str
     threshold: int
     unit: str
+    version: Optional[int] = None #Version the client loaded, used to reject stale updates
 
     def __str__(self):
         return f"sku: {self.sku}, name: {self.name}, stock: {self.stock}, price: {self.price}, expiry_date: {self.expiry_date}, customUnit: {self.customUnit}, threshold: {self.threshold}, unit: {self.unit}"
@@ -72,4 +82,9 @@ class ResupplyIngredientCreate(BaseModel):
     unit: str
 
     def __str__(self):
-        return f"sku: {self.sku}, name: {self.name}, stock: {self.stock}, price: {self.price}, expiry_date: {self.expiryDate}, customUnit: {self.customUnit}, threshold: {self.threshold}, unit: {self.unit}"
\ No newline at end of file
+        return f"sku: {self.sku}, name: {self.name}, stock: {self.stock}, price: {self.price}, expiry_date: {self.expiryDate}, customUnit: {self.customUnit}, threshold: {self.threshold}, unit: {self.unit}"
+
+class OrderTicket(BaseModel):
+    idempotency_key: str = Field(..., min_length=1, max_length=200) #Unique per ticket, a ticket sent again with the same key is not applied twice
+    orders: dict #Same structure as the /submit-orders payload: { recipe_id: { "name", "count" } }
+    created_at: Optional[datetime] = None #When the ticket was taken, e.g. by a POS that was offline, now by default
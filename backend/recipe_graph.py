@@ -0,0 +1,202 @@
+import numpy as np
+
+
+"""
+Compiled recipe graph: every menu item resolved to the ingredient SKUs it uses.
+Recipes reference ingredients by name with string amounts in their own units, so they are compiled once
+(when the menu or the ingredient list changes) into a sparse recipe x ingredient usage matrix, in stock units.
+Order depletion, capacity and cost queries then become one sparse matrix-vector product over NumPy arrays.
+"""
+
+
+"""
+Function to parse a recipe ingredient amount into a number.
+Amounts in data.json are stored as strings (e.g. "2"), so they have to be converted before any arithmetic.
+Anything that cannot be parsed counts as 0.
+"""
+def parse_amount(amount):
+    try:
+        amount = float(amount)
+        return int(amount) if amount.is_integer() else amount
+    except (TypeError, ValueError):
+        return 0
+
+
+"""
+Units that can be converted into each other: unit -> (dimension, size in the base unit of the dimension).
+Mass is in grams, volume in millilitres, anything counted one by one is a piece.
+"""
+UNITS = {
+    "g": ("mass", 1), "gram": ("mass", 1), "kg": ("mass", 1000), "kilogram": ("mass", 1000),
+    "oz": ("mass", 28.349523125), "ounce": ("mass", 28.349523125), "lb": ("mass", 453.59237), "pound": ("mass", 453.59237),
+    "ml": ("volume", 1), "l": ("volume", 1000), "litre": ("volume", 1000), "liter": ("volume", 1000),
+    "tsp": ("volume", 4.92892), "tbsp": ("volume", 14.7868), "cup": ("volume", 236.588),
+    "pc": ("count", 1), "piece": ("count", 1), "individual": ("count", 1), "each": ("count", 1), "unit": ("count", 1),
+}
+
+
+"""
+Helper to look up a unit, ignoring case and a plural "s" ("Kgs", "cups", "lbs").
+Unknown units are their own dimension, so "bunch" and "bunches" still match each other.
+"""
+def normalize_unit(unit):
+    unit = str(unit or "").strip().lower()
+    if unit.endswith(("ches", "shes", "xes")):
+        unit = unit[:-2]
+    elif unit.endswith("s") and len(unit) > 1:
+        unit = unit[:-1]
+    return UNITS.get(unit, (unit, 1))
+
+
+"""
+Function to get the factor converting an amount in the recipe unit into the unit the ingredient is stocked in.
+When the units cannot be converted (e.g. cloves of an ingredient stocked in bags) the amount is taken as is.
+"""
+def unit_factor(recipe_unit, stock_unit):
+    recipe_dimension, recipe_size = normalize_unit(recipe_unit)
+    stock_dimension, stock_size = normalize_unit(stock_unit)
+    if not recipe_unit or not stock_unit or recipe_dimension != stock_dimension:
+        return 1
+    return recipe_size / stock_size
+
+
+"""
+Sparse recipe x ingredient usage matrix, stored as three parallel arrays (one entry per recipe ingredient):
+row (the recipe), column (the ingredient) and amount (used by one dish, in the ingredient's stock unit).
+Entries are sorted by row, so the entries of a recipe are the slice indptr[row]:indptr[row + 1],
+and column_order/column_indptr index them by ingredient to find the recipes an ingredient is used in.
+Recipe rows can be found by the menu item _id or its numeric data.json id, ingredient columns by SKU.
+Recipe ingredients that match no ingredient are kept in unresolved, they cannot be depleted or counted.
+version identifies the menu and ingredient list the graph was built from (see get_recipe_graph_db).
+"""
+class RecipeGraph:
+    def __init__(self, menu_items: list, ingredients: list, version=None):
+        self.version = version
+        self.skus = [ingredient["_id"] for ingredient in ingredients]
+        # _id is prefixed with the location outside the default one, the sku field holds the SKU itself
+        self.bare_skus = [ingredient.get("sku", ingredient["_id"]) for ingredient in ingredients]
+        self.names = [ingredient["name"] for ingredient in ingredients]
+        self.columns = {sku: column for column, sku in enumerate(self.skus)}
+        by_name = {}
+        for column, ingredient in enumerate(ingredients):
+            by_name.setdefault(ingredient["name"].strip().casefold(), column)
+            by_name[ingredient["name"]] = column
+
+        self.recipes = []
+        self.rows = {}
+        self.unresolved = {}  # row -> [{ "name", "amount" }]
+        rows, columns, amounts = [], [], []
+        for row, menu_item in enumerate(menu_items):
+            self.recipes.append(menu_item)
+            self.rows[str(menu_item["_id"])] = row
+            if "id" in menu_item:
+                self.rows[str(menu_item["id"])] = row
+            recipe = {}  # column -> amount, an ingredient listed twice is counted once with both amounts
+            for ingredient in menu_item.get("ingredients", []):
+                name = ingredient.get("name")
+                amount = parse_amount(ingredient.get("amount", 0))
+                column = by_name.get(name, by_name.get(str(name).strip().casefold()))
+                if column is None:
+                    self.unresolved.setdefault(row, []).append({"name": name, "amount": amount})
+                elif amount > 0:
+                    factor = unit_factor(ingredient.get("units"), ingredients[column].get("stock_measurement"))
+                    recipe[column] = recipe.get(column, 0) + amount * factor
+            rows += [row] * len(recipe)
+            columns += recipe.keys()
+            amounts += recipe.values()
+
+        self.shape = (len(self.recipes), len(self.skus))
+        self.row = np.array(rows, dtype=np.int64)
+        self.column = np.array(columns, dtype=np.int64)
+        self.amount = np.array(amounts, dtype=np.float64)
+        self.indptr = np.searchsorted(self.row, np.arange(self.shape[0] + 1))
+        # Same entries sorted by ingredient, the entries of a column are column_order[column_indptr[column]:column_indptr[column + 1]]
+        self.column_order = np.argsort(self.column, kind="stable")
+        self.column_indptr = np.searchsorted(self.column[self.column_order], np.arange(self.shape[1] + 1))
+
+    """
+    Function to turn order counts ({ recipe_id: { "count": ... } }) into a vector of dishes per recipe row.
+    Unknown recipes and counts of 0 or less are ignored.
+    """
+    def order_vector(self, order_counts: dict):
+        counts = np.zeros(self.shape[0])
+        for recipe_id, order in order_counts.items():
+            row = self.rows.get(str(recipe_id))
+            count = order.get("count", 0)
+            if row is not None and count > 0:
+                counts[row] += count
+        return counts
+
+    """
+    Function to get the ingredient usage of a vector of dishes per recipe (the transposed matrix times the vector).
+    It returns the amount used per ingredient column.
+    """
+    def usage(self, counts: np.ndarray):
+        return np.bincount(self.column, weights=self.amount * counts[self.row], minlength=self.shape[1])
+
+    """
+    Function to get how many more of some recipes (all of them by default) can be made with the given stock per ingredient column,
+    and the SKU of the ingredient that runs out first for each of them.
+    Only the entries of the requested rows are read, so updating the recipes that use one ingredient is cheap.
+    The entries are sorted by recipe and then by how many dishes their stock allows, so the first entry of each recipe is the limit.
+    It returns the portions (inf for recipes with no resolved ingredient) and the limiting SKUs (None for those), in the order of rows.
+    """
+    def capacity(self, stock: np.ndarray, rows: np.ndarray = None):
+        rows = np.arange(self.shape[0]) if rows is None else np.asarray(rows, dtype=np.int64)
+        starts, lengths = self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows]
+        offsets = np.cumsum(lengths) - lengths
+        entries = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        local_rows = np.repeat(np.arange(len(rows)), lengths)
+        dishes = np.maximum(stock[self.column[entries]], 0) / self.amount[entries]
+
+        portions = np.full(len(rows), np.inf)
+        np.minimum.at(portions, local_rows, dishes)
+        order = np.lexsort((dishes, local_rows))
+        limited_by = [None] * len(rows)
+        for local_row, column in zip(np.flatnonzero(lengths).tolist(), self.column[entries[order[offsets[lengths > 0]]]].tolist()):
+            limited_by[local_row] = self.skus[column]
+        return np.floor(portions), limited_by
+
+    """
+    Function to get the recipe rows that use any of the given ingredient columns.
+    """
+    def recipes_using(self, columns: list):
+        columns = np.asarray(columns, dtype=np.int64)
+        starts, ends = self.column_indptr[columns], self.column_indptr[columns + 1]
+        entries = np.concatenate([self.column_order[start:end] for start, end in zip(starts.tolist(), ends.tolist())] or [np.empty(0, dtype=np.int64)])
+        return np.unique(self.row[entries])
+
+    """
+    Function to get the ingredient cost of every recipe from the price per stock unit of every ingredient column.
+    """
+    def cost(self, prices: np.ndarray):
+        return np.bincount(self.row, weights=self.amount * prices[self.column], minlength=self.shape[0])
+
+    """
+    Function to build an ingredient column vector from ingredient documents, e.g. the current stock or price.
+    Ingredients that are not in the graph are ignored, missing or unparsable values count as 0.
+    """
+    def ingredient_vector(self, ingredients: list, field: str):
+        vector = np.zeros(self.shape[1])
+        for ingredient in ingredients:
+            column = self.columns.get(ingredient["_id"])
+            if column is not None:
+                vector[column] = parse_amount(ingredient.get(field, 0))
+        return vector
+
+    """
+    Function to get the ingredients used by count dishes of one recipe row: [{ "sku", "name", "amount" }], with the SKU without location prefix.
+    """
+    def recipe_usage(self, row: int, count):
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return [
+            {"sku": self.bare_skus[column], "name": self.names[column], "amount": parse_amount(amount * count)}
+            for column, amount in zip(self.column[start:end].tolist(), self.amount[start:end].tolist())
+        ]
+
+    """
+    Function to turn an ingredient column vector into a dictionary of its non-zero values, keyed by SKU or by name.
+    """
+    def by_ingredient(self, vector: np.ndarray, key: str = "sku"):
+        keys = self.skus if key == "sku" else self.names
+        return {keys[column]: parse_amount(vector[column]) for column in np.flatnonzero(vector).tolist()}
@@ -0,0 +1,228 @@
+import bisect
+import heapq
+import re
+from collections import defaultdict
+from functools import lru_cache
+
+
+"""
+Helper to split a text into casefolded words, e.g. "Roma Tomatoes (canned)" -> ["roma", "tomatoes", "canned"].
+"""
+def tokenize(text):
+    return re.findall(r"\w+", str(text or "").casefold())
+
+
+"""
+Helper to get the trigrams of a word, padded so short words and the first and last letters count too ("^ab", "abc", ..., "yz$").
+"""
+@lru_cache(maxsize=100000)
+def trigrams(word: str):
+    word = f"^{word}$"
+    return frozenset(word[index:index + 3] for index in range(max(1, len(word) - 2)))
+
+
+"""
+Helper to get the similarity (Dice coefficient) of the trigrams of a query word and a word of the index, between 0 and 1.
+shared is the number of trigrams they have in common when it is already known.
+"""
+def similarity(grams: frozenset, word: str, shared: int = None):
+    other = trigrams(word)
+    if shared is None:
+        shared = len(grams & other)
+    return 2 * shared / (len(grams) + len(other))
+
+
+"""
+Fields searched for every kind of document and their weight in the ranking: a match on the SKU or the menu id
+ranks above a match on the name, which ranks above a match on the category.
+"""
+SEARCH_FIELDS = {
+    "ingredient": {"sku": 3, "name": 2},
+    "menu_item": {"id": 3, "name": 2, "category": 1},
+}
+
+
+"""
+Score of a query word matching a word of a document exactly, as a prefix (e.g. "tom" -> "tomatoes") or with typos (trigram similarity),
+multiplied by the weight of the field.
+"""
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.7
+FUZZY_SCORE = 0.5
+FUZZY_MIN_SIMILARITY = 0.5
+
+
+"""
+In-memory search index of the ingredients and menu items of a location, used by /search.
+- words is the sorted list of every distinct word, so the words starting with a prefix are a binary search and a slice
+  (a flattened trie, without a node object per letter)
+- postings maps every word to the documents containing it, with the weight of the best field it appears in
+- grams maps every trigram to the words containing it, for the typo tolerant fallback
+A document is re-indexed on every change, which only touches the structures when its words changed.
+A query matches the documents where every query word matches a word, ranked by the sum of the word scores
+(see EXACT_SCORE, PREFIX_SCORE, FUZZY_SCORE) plus a bonus when the whole query is the SKU/id or starts the name.
+The candidates come from the query word matching the fewest documents, and the other query words are only checked on them,
+so a query costs about the same whatever the size of the index. A word matching more than max_candidates documents
+(e.g. a one letter prefix) only ranks the first ones found, exact matches before prefixes.
+Typos are only looked for when exact and prefix matches give fewer results than asked for.
+"""
+class SearchIndex:
+    def __init__(self, ingredients: list = (), menu_items: list = (), max_candidates: int = 500):
+        self.max_candidates = max_candidates  # documents a short prefix can expand to
+        self.documents = {}  # (kind, _id) -> { "kind", "_id", ...fields shown in the results }
+        self.document_words = {}  # (kind, _id) -> { word: weight }
+        self.words = []
+        self.postings = defaultdict(dict)  # word -> { (kind, _id): weight }
+        self.grams = defaultdict(set)  # trigram -> words
+        for kind, documents in (("ingredient", ingredients), ("menu_item", menu_items)):
+            for document in documents:
+                key = (kind, str(document["_id"]))
+                self.document_words[key] = self._words(kind, document)
+                self.documents[key] = self._entry(kind, document)
+                for word, weight in self.document_words[key].items():
+                    self.postings[word][key] = weight
+        self.words = sorted(self.postings)  # sorted once, update keeps it sorted
+        for word in self.words:
+            for gram in trigrams(word):
+                self.grams[gram].add(word)
+
+    def _entry(self, kind: str, document: dict):
+        if kind == "ingredient":
+            fields = ("sku", "name", "stock", "stock_measurement")
+        else:
+            fields = ("id", "name", "category", "price")
+        return {"kind": kind, "_id": str(document["_id"]), **{field: document.get(field) for field in fields}}
+
+    def _words(self, kind: str, document: dict):
+        words = {}
+        for field, weight in SEARCH_FIELDS[kind].items():
+            for word in tokenize(document.get(field)):
+                words[word] = max(words.get(word, 0), weight)
+        return words
+
+    """
+    Function to index the new document of an ingredient or menu item (None when it was deleted).
+    """
+    def update(self, kind: str, id, document: dict = None):
+        key = (kind, str(id))
+        old = self.document_words.pop(key, {})
+        new = self._words(kind, document) if document else {}
+        for word in old.keys() - new.keys():
+            postings = self.postings[word]
+            postings.pop(key, None)
+            if not postings:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+                for gram in trigrams(word):
+                    self.grams[gram].discard(word)
+                    if not self.grams[gram]:
+                        del self.grams[gram]
+        for word, weight in new.items():
+            if word not in self.postings:
+                bisect.insort(self.words, word)
+                for gram in trigrams(word):
+                    self.grams[gram].add(word)
+            self.postings[word][key] = weight
+        if document:
+            self.document_words[key] = new
+            self.documents[key] = self._entry(kind, document)
+        else:
+            self.documents.pop(key, None)
+
+    def _prefix_words(self, prefix: str):
+        index = bisect.bisect_left(self.words, prefix)
+        while index < len(self.words) and self.words[index].startswith(prefix):
+            yield self.words[index]
+            index += 1
+
+    def _estimate(self, word: str):
+        # documents containing the word plus the number of longer words it is a prefix of, two dictionary lookups and two binary searches
+        prefixed = bisect.bisect_left(self.words, word + "\U0010ffff") - bisect.bisect_left(self.words, word)
+        return len(self.postings.get(word, ())) + prefixed
+
+    def _fuzzy_words(self, word: str):
+        grams = trigrams(word)
+        shared = defaultdict(int)
+        for gram in grams:
+            words = self.grams.get(gram, ())
+            if len(words) <= self.max_candidates:  # a gram found in too many words tells little and costs a lot
+                for candidate in words:
+                    shared[candidate] += 1
+        matches = [(similarity(grams, candidate, count), candidate) for candidate, count in shared.items()]
+        return sorted((match for match in matches if match[0] >= FUZZY_MIN_SIMILARITY), reverse=True)
+
+    def _candidates(self, word: str, kind: str, fuzzy: bool):
+        # documents matching one word: exact matches first, then prefixes in order, then typos, at most max_candidates
+        scores = {}
+
+        def add(candidate, score):
+            for key, weight in self.postings[candidate].items():
+                if len(scores) >= self.max_candidates:
+                    return False
+                if (kind is None or key[0] == kind) and score * weight > scores.get(key, 0):
+                    scores[key] = score * weight
+            return True
+
+        if word in self.postings and not add(word, EXACT_SCORE):
+            return scores
+        for candidate in self._prefix_words(word):
+            if candidate != word and not add(candidate, PREFIX_SCORE):
+                return scores
+        if fuzzy and not scores and len(word) >= 3:
+            for value, candidate in self._fuzzy_words(word):
+                if not add(candidate, FUZZY_SCORE * value):
+                    break
+        return scores
+
+    def _match(self, word: str, words: dict, fuzzy: bool):
+        best = 0
+        for candidate, weight in words.items():
+            if candidate == word:
+                score = EXACT_SCORE
+            elif candidate.startswith(word):
+                score = PREFIX_SCORE
+            elif fuzzy and len(word) >= 3:
+                value = similarity(trigrams(word), candidate)
+                score = FUZZY_SCORE * value if value >= FUZZY_MIN_SIMILARITY else 0
+            else:
+                score = 0
+            best = max(best, score * weight)
+        return best
+
+    def _search(self, words: list, kind: str, fuzzy: bool):
+        # the most selective word gives the candidates, the other words are checked on the few words of each candidate
+        driving = min(words, key=self._estimate)
+        others = [word for word in words if word != driving]
+        scores = {}
+        for key, score in self._candidates(driving, kind, fuzzy).items():
+            for word in others:
+                match = self._match(word, self.document_words[key], fuzzy)
+                if not match:
+                    break
+                score += match
+            else:
+                scores[key] = score
+        return scores
+
+    """
+    Function to get the limit best matches of a query, optionally of one kind ("ingredient" or "menu_item"), best first:
+    [{ "kind", "_id", "score", and the sku, name, stock and stock_measurement of an ingredient or the id, name, category and price of a menu item }]
+    """
+    def search(self, query: str, limit: int = 10, kind: str = None):
+        words = list(dict.fromkeys(tokenize(query)))
+        if not words:
+            return []
+        scores = self._search(words, kind, fuzzy=False)
+        if len(scores) < limit:
+            scores = self._search(words, kind, fuzzy=True)
+        text = " ".join(words)
+        results = []
+        for key, score in heapq.nlargest(limit * 4, scores.items(), key=lambda item: item[1]):
+            document = self.documents[key]
+            if " ".join(tokenize(document.get("sku", document.get("id")))) == text:
+                score += 10
+            elif " ".join(tokenize(document.get("name"))).startswith(text):
+                score += 1
+            results.append({**document, "score": round(score, 3)})
+        results.sort(key=lambda result: (-result["score"], str(result.get("name"))))
+        return results[:limit]
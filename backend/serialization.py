@@ -0,0 +1,30 @@
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+
+
+"""
+Function used by orjson for the values it does not know about.
+orjson already handles datetimes (ISO format) and dicts/lists natively, so only the BSON types need converting here.
+"""
+def bson_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+"""
+Function to serialize a MongoDB document (or a list of them) straight to JSON bytes.
+"""
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default=bson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+"""
+Response class for endpoints returning MongoDB documents.
+Returning it directly skips FastAPI's jsonable_encoder and the copy of every document it makes,
+the documents are serialized in a single orjson call instead.
+"""
+class MongoJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
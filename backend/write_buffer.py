@@ -0,0 +1,98 @@
+import asyncio
+from pymongo.errors import BulkWriteError
+
+
+"""
+In-process buffer that batches inserts into a collection.
+add() only appends the document to memory, so the caller does not wait for the database.
+The buffer is written with a single unordered insert_many when it holds max_size documents or every flush_interval seconds,
+whichever comes first. If a flush fails the documents are put back and retried with the next flush,
+unless more than max_pending documents are waiting, in which case the oldest ones are dropped and counted.
+Documents rejected as duplicates were already written by an earlier attempt and are not retried.
+on_flush, if given, is awaited with the documents of every successful write (e.g. to update aggregates).
+"""
+class WriteBuffer:
+    def __init__(self, collection, max_size: int = 500, flush_interval: float = 1.0, max_pending: int = 50000, on_flush=None):
+        self.collection = collection
+        self.on_flush = on_flush
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.documents = []
+        self.task = None
+        self.flushing = None
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.flushing:
+            await self.flushing
+        await self.flush()
+
+    def add(self, document: dict):
+        self.documents.append(document)
+        if len(self.documents) >= self.max_size and self.task is not None and self.flushing is None:
+            self.flushing = asyncio.create_task(self.flush())
+
+    def extend(self, documents: list):
+        for document in documents:
+            self.add(document)
+
+    async def flush(self):
+        try:
+            while self.documents:
+                batch, self.documents = self.documents[:self.max_size], self.documents[self.max_size:]
+                try:
+                    await self.collection.insert_many(batch, ordered=False)
+                    self.written += len(batch)
+                    self.flushes += 1
+                    await self._on_flush(batch)
+                except BulkWriteError as e:
+                    rejected = {error["index"] for error in e.details["writeErrors"]}
+                    failed = {error["index"] for error in e.details["writeErrors"] if error["code"] != 11000}
+                    self.written += e.details["nInserted"]
+                    self.documents = [document for index, document in enumerate(batch) if index in failed] + self.documents
+                    await self._on_flush([document for index, document in enumerate(batch) if index not in rejected])
+                    if failed:
+                        print(f"Failed to write {len(failed)} documents to '{self.collection.name}', will retry")
+                        return
+                except Exception as e:
+                    print(f"Failed to write {len(batch)} documents to '{self.collection.name}', will retry: {e}")
+                    self.documents = batch + self.documents
+                    if len(self.documents) > self.max_pending:
+                        self.dropped += len(self.documents) - self.max_pending
+                        self.documents = self.documents[-self.max_pending:]
+                    return
+        finally:
+            self.flushing = None
+
+    def stats(self):
+        return {
+            "pending": len(self.documents),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes
+        }
+
+    async def _on_flush(self, documents: list):
+        if self.on_flush and documents:
+            try:
+                await self.on_flush(documents)
+            except Exception as e:
+                print(f"Failed to process {len(documents)} documents written to '{self.collection.name}': {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.flushing is None:
+                self.flushing = asyncio.create_task(self.flush())
+            await asyncio.shield(self.flushing)
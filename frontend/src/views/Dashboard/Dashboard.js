@@ -38,22 +38,34 @@ ChartJS.register(
 
 export default function DashboardPage() {
   const [activeTab, setActiveTab] = useState("categories");
-  const [expiryAlerts, setExpiryAlerts] = useState([]);
-  const [lowStockAlerts, setLowStockAlerts] = useState([]);
+  const [alerts, setAlerts] = useState({});
 
+  // The server sends every active alert once, then only the alerts that change
   useEffect(() => {
-    fetch("http://localhost:8000/get-expiring-ingredients")
-      .then((res) => res.json())
-      .then((data) => setExpiryAlerts(data))
-      .catch((err) => console.error(err));
+    const source = new EventSource("http://localhost:8000/inventory-alerts/stream");
+    source.addEventListener("snapshot", (event) => {
+      const snapshot = {};
+      JSON.parse(event.data).forEach((item) => (snapshot[item._id] = item));
+      setAlerts(snapshot);
+    });
+    source.addEventListener("alert", (event) => {
+      const changes = JSON.parse(event.data);
+      setAlerts((current) => {
+        const next = { ...current };
+        changes.forEach((item) => {
+          if (item.low_stock || item.expiry) next[item._id] = item;
+          else delete next[item._id];
+        });
+        return next;
+      });
+    });
+    source.onerror = (err) => console.error(err);
+    return () => source.close();
   }, []);
 
-  useEffect(() => {
-    fetch("http://localhost:8000/get-low-stock-ingredients")
-      .then((res) => res.json())
-      .then((data) => setLowStockAlerts(data))
-      .catch((err) => console.error(err));
-  }, []);
+  // Expired items are not listed here, like the /get-expiring-ingredients list this card used to show
+  const expiryAlerts = Object.values(alerts).filter((item) => item.expiry === "expiring");
+  const lowStockAlerts = Object.values(alerts).filter((item) => item.low_stock);
 
   const getExpiryLabel = (expiryDateStr) => {
     const expiryDate = new Date(expiryDateStr);